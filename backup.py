@@ -0,0 +1,115 @@
+"""
+Онлайн-бэкап bot.db через sqlite3 backup API.
+
+Копирование идёт небольшими порциями страниц с паузой между шагами: блокировка
+чтения держится только на время одного шага, и писатели под _DB_LOCK не ждут
+весь бэкап. Запись в базу другим соединением (а у бота каждая запись — своё
+соединение) перезапускает копию сначала; не уложившаяся в max_seconds копия
+бросается (BackupSkipped) и повторяется позже — целиком одним шагом под
+_DB_LOCK не копируем никогда. Каждый снимок проверяется PRAGMA integrity_check,
+старые удаляются по политике хранения.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from db import _connect, _get_db_path
+
+logger = logging.getLogger("bot.backup")
+
+BACKUP_PREFIX = "bot-"
+BACKUP_SUFFIX = ".db"
+
+
+def _get_backup_dir() -> str:
+    return os.getenv("BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(_get_db_path())), "backups"))
+
+
+class BackupError(Exception):
+    pass
+
+
+class BackupSkipped(BackupError):
+    """Пошаговая копия не успела за отведённое время (база всё время менялась)."""
+
+
+def _copy_in_steps(src: sqlite3.Connection, dst: sqlite3.Connection, pages: int, pause: float, deadline: float) -> None:
+    def _progress(status: int, remaining: int, total: int) -> None:
+        if time.monotonic() > deadline:
+            # исключение из progress прерывает backup; копия остаётся неполной
+            raise BackupSkipped(f"stepped copy did not finish in time ({remaining}/{total} pages left)")
+        # уступаем писателям между шагами
+        if remaining and pause > 0:
+            time.sleep(pause)
+
+    src.backup(dst, pages=pages, progress=_progress)
+
+
+def rotate_backups(directory: str, keep: int) -> List[str]:
+    """Удаляет самые старые снимки сверх keep. Возвращает удалённые пути."""
+    snapshots = sorted(
+        name for name in os.listdir(directory)
+        if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)
+    )
+    removed: List[str] = []
+    for name in snapshots[:max(len(snapshots) - keep, 0)]:
+        path = os.path.join(directory, name)
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError as e:
+            logger.error(f"Failed to remove old backup {path}: {e}")
+    return removed
+
+
+def create_backup(
+    directory: Optional[str] = None,
+    *,
+    pages: int = 256,
+    pause: float = 0.005,
+    max_seconds: float = 60.0,
+    keep: int = 7,
+) -> Dict[str, Any]:
+    """
+    Делает проверенный снимок базы и применяет ротацию.
+    Возвращает сведения о снимке: path, size, seconds, removed.
+    """
+    directory = directory or _get_backup_dir()
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    final_path = os.path.join(directory, f"{BACKUP_PREFIX}{stamp}{BACKUP_SUFFIX}")
+    tmp_path = final_path + ".part"
+
+    started = time.monotonic()
+    src = _connect()
+    dst = sqlite3.connect(tmp_path)
+    try:
+        _copy_in_steps(src, dst, pages, pause, started + max_seconds)
+        result = dst.execute("PRAGMA integrity_check").fetchone()
+        if not result or result[0] != "ok":
+            raise BackupError(f"integrity_check failed: {result[0] if result else 'no result'}")
+    except Exception:
+        dst.close()
+        src.close()
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    dst.close()
+    src.close()
+
+    os.replace(tmp_path, final_path)
+    removed = rotate_backups(directory, keep)
+    info = {
+        "path": final_path,
+        "size": os.path.getsize(final_path),
+        "seconds": round(time.monotonic() - started, 3),
+        "removed": removed,
+    }
+    logger.info(f"Backup created: {final_path} ({info['size']} bytes, {info['seconds']}s), rotated {len(removed)}")
+    return info
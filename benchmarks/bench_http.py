@@ -0,0 +1,171 @@
+"""
+Пропускная способность sendMessage при разных настройках HTTP-клиента
+(http_settings.HttpSettings) против локального поддельного Bot API.
+
+Сервер — минимальный HTTP/1.1 с keep-alive на asyncio: отвечает на getMe и
+sendMessage после искусственной задержки (--latency-ms), имитируя сетевой
+RTT до api.telegram.org, а новое соединение впервые отвечает ещё на
+--handshake-ms позже (TCP + TLS; по умолчанию три RTT), иначе локальное
+соединение бесплатно и keep-alive ничего не даёт. Бот шлёт --messages
+сообщений, держа в полёте до --concurrency вызовов; для каждой конфигурации
+печатаются сообщения/с, p50/p95 и число TCP-соединений, которые открыл клиент.
+
+    python benchmarks/bench_http.py [--messages 1000] [--concurrency 64] [--latency-ms 20]
+
+Клиент и сервер делят один процесс, поэтому цифры — про накладные расходы
+клиента и очередь пула, а не про сеть: httpcore на каждый запрос обходит все
+соединения пула, и слишком большой пул стоит процессорного времени.
+
+HTTP/2 здесь не меряется: поддельный сервер говорит только HTTP/1.1.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Bot  # noqa: E402
+
+from http_settings import HttpSettings  # noqa: E402
+
+TOKEN = "123456:bench"
+
+_ME = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+
+class FakeBotApi:
+    def __init__(self, latency: float, handshake: float) -> None:
+        self.latency = latency
+        self.handshake = handshake
+        self.connections = 0
+        self.requests = 0
+        self._message_id = 0
+        self._server: asyncio.AbstractServer
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    def _result(self, method: str) -> object:
+        if method == "getMe":
+            return _ME
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": _ME,
+            "text": "ok",
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        delay = self.latency + self.handshake
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                path = lines[0].split(" ")[1]
+                headers = {k.strip().lower(): v.strip() for k, _, v in (ln.partition(":") for ln in lines[1:] if ln)}
+                length = int(headers.get("content-length", "0"))
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                if delay:
+                    await asyncio.sleep(delay)
+                delay = self.latency
+                body = json.dumps({"ok": True, "result": self._result(path.rsplit("/", 1)[-1])}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+async def run_config(settings: HttpSettings, port: int, messages: int, concurrency: int) -> Tuple[float, List[float]]:
+    bot = Bot(
+        TOKEN,
+        base_url=f"http://127.0.0.1:{port}/bot",
+        request=settings.build_request(),
+        get_updates_request=settings.build_request(for_polling=True),
+    )
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            await bot.send_message(chat_id=1, text=f"message {i}")
+            latencies.append(time.perf_counter() - started)
+
+    async with bot:
+        started = time.perf_counter()
+        await asyncio.gather(*(send(i) for i in range(messages)))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies
+
+
+CONFIGS = [
+    ("pool=1", dict(pool_size=1)),
+    ("pool=4", dict(pool_size=4)),
+    ("pool=16", dict(pool_size=16)),
+    ("pool=64", dict(pool_size=64)),
+    ("pool=256", dict(pool_size=256)),
+    ("pool=16 keepalive=0", dict(pool_size=16, keepalive_expiry=0.0)),
+]
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    handshake_ms = args.latency_ms * 3 if args.handshake_ms is None else args.handshake_ms
+    server = FakeBotApi(args.latency_ms / 1000, handshake_ms / 1000)
+    port = await server.start()
+    print(
+        f"fake Bot API on :{port}, latency {args.latency_ms} ms, handshake {handshake_ms} ms, "
+        f"{args.messages} messages, {args.concurrency} in flight"
+    )
+    try:
+        for label, overrides in CONFIGS:
+            # пул ждёт свободное соединение; с маленьким пулом этого ожидания много
+            settings = HttpSettings(pool_timeout=60.0, **overrides)
+            connections_before = server.connections
+            elapsed, latencies = await run_config(settings, port, args.messages, args.concurrency)
+            latencies.sort()
+            p50 = statistics.median(latencies) * 1000
+            p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+            print(
+                f"{label:>20}: {args.messages / elapsed:8.0f} msg/s   p50 {p50:7.1f} ms   p95 {p95:7.1f} ms   "
+                f"connections {server.connections - connections_before}"
+            )
+    finally:
+        await server.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=64, help="вызовов в полёте одновременно")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка ответа сервера")
+    parser.add_argument("--handshake-ms", type=float, default=None, help="цена нового соединения (3 × latency)")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Микробенчмарк маршрутизации текста группы: прежняя цепочка (filters.Regex с
+re.search + lower() и проверки по кортежам в on_menu_text) против
+routing.route_text().
+
+Корпус — типичная переписка в чате с небольшой долей пунктов меню и дат.
+
+    python benchmarks/bench_routing.py [--repeat 5] [--number 200]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from routing import route_text  # noqa: E402
+
+CHATTER = [
+    "привет",
+    "Привет всем!",
+    "ок",
+    "да",
+    "нет, я не смогу в пятницу",
+    "кто идёт сегодня?",
+    "я опаздываю минут на 10",
+    "😂😂😂",
+    "👍",
+    "+",
+    "ахах",
+    "Смотрите какая статья https://example.com/article/12345",
+    "а может в суши?",
+    "Давайте в субботу, у меня в воскресенье дела",
+    "в прошлый раз было очень вкусно, особенно десерты",
+    "Где встречаемся?",
+    "на месте в 19:30",
+    "спасибо!",
+    "Ну такое...",
+    "Мне кажется там слишком дорого для обеда в будний день",
+    "ok see you there",
+    "lol",
+    "who's in?",
+    "Upcoming meeting moved to Thursday",
+    "Статистику потом посмотрим",
+    "меню у них поменялось",
+    "Старт в 8 утра, не проспите",
+    "12 человек это много",
+    "2 часа ехать",
+    "18.00 норм?",
+    "Я взял столик на 3 человек на 20:00, подтверждение пришло на почту, если что пишите мне",
+]
+
+HITS = [
+    "меню",
+    "Статистика",
+    "🎲 Случайный ресторан",
+    "Предстоящие события",
+    "25.12.2025 19:00",
+    " 01.02.2026 13-30 ",
+]
+
+# прежняя реализация: filters.Regex (re.search) и on_menu_text
+_OLD_RE = re.compile(r"^\s*\d{1,2}\.\d{1,2}\.\d{4}\s+\d{1,2}[:\.\-]\d{2}\s*$")
+
+
+def old_route(text: str):
+    if _OLD_RE.search(text):
+        return "datetime"
+    t = text.strip().lower()
+    if t in ("start", "старт", "help", "помощь"):
+        return "start"
+    if t in ("menu", "меню"):
+        return "menu"
+    if t in ("предстоящие события", "upcoming", "upcomming"):
+        return "upcoming"
+    if t in ("🎲 случайный ресторан", "случайный ресторан"):
+        return "random"
+    if t in ("📊 статистика", "статистика"):
+        return "stats"
+    return None
+
+
+def build_corpus(size: int, hit_ratio: float, seed: int) -> list:
+    rng = random.Random(seed)
+    return [rng.choice(HITS) if rng.random() < hit_ratio else rng.choice(CHATTER) for _ in range(size)]
+
+
+def bench(fn, corpus: list, repeat: int, number: int) -> float:
+    def run() -> None:
+        for text in corpus:
+            fn(text)
+
+    best = min(timeit.repeat(run, repeat=repeat, number=number))
+    return best / (number * len(corpus)) * 1e9
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1000, help="сообщений в корпусе")
+    parser.add_argument("--hits", type=float, default=0.02, help="доля пунктов меню и дат")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.size, args.hits, args.seed)
+    mismatches = [t for t in set(corpus) | set(CHATTER) | set(HITS) if old_route(t) != route_text(t)]
+    if mismatches:
+        raise SystemExit(f"routing differs from the old handler chain for: {mismatches}")
+
+    chatter = [t for t in corpus if route_text(t) is None]
+    print(f"corpus: {len(corpus)} messages, {len(corpus) - len(chatter)} routed")
+    for label, sample in (("all messages", corpus), ("chatter only", chatter)):
+        old_ns = bench(old_route, sample, args.repeat, args.number)
+        new_ns = bench(route_text, sample, args.repeat, args.number)
+        print(f"{label:>13}: old {old_ns:7.1f} ns/msg   new {new_ns:7.1f} ns/msg   x{old_ns / new_ns:.1f}")
+
+
+if __name__ == "__main__":
+    main()
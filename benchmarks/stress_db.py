@@ -0,0 +1,216 @@
+"""
+Нагрузочная проверка db.py: участие и отзывы из многих потоков и процессов
+над одним файлом БД.
+
+Каждый рабочий поток выполняет случайную последовательность операций над
+небольшим набором событий и пользователей (много столкновений):
+
+- join    — toggle_participation (запись / «передумал»);
+- cancel  — cancel_participation (отмена со штрафом);
+- review  — save_review, затем, как бот, отметка completed, если у события
+            набралось 3 разных автора отзывов.
+
+_DB_LOCK защищает только потоки одного процесса, поэтому процессы
+(--processes) проверяют, что сами транзакции SQLite держат инварианты:
+
+1. у события не больше 3 участников с joined = 1;
+2. review_left = 1 ровно у тех участников, у кого есть отзыв, и у каждого
+   отзыва есть строка участника;
+3. completed = 1 только у событий с отзывами от 3 разных пользователей;
+4. restaurant_ratings совпадает с пересчётом по отзывам.
+
+Инварианты проверяются во время прогона (отдельная читающая транзакция раз в
+--check-interval секунд) и в конце. Выводится число операций в секунду по
+видам; код возврата 1, если нашлись нарушения.
+
+    python benchmarks/stress_db.py [--processes 4] [--threads 4] [--ops 500] [--events 8] [--users 6]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Set, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+OPS = ("join", "cancel", "review")
+OP_WEIGHTS = (45, 15, 40)
+
+INVARIANT_QUERIES: Dict[str, str] = {
+    "more than 3 joined": """
+        SELECT event_id, COUNT(*) FROM participants WHERE joined = 1
+        GROUP BY event_id HAVING COUNT(*) > 3
+    """,
+    "review_left without review": """
+        SELECT p.event_id, p.user_id FROM participants p
+        WHERE p.review_left = 1
+          AND NOT EXISTS (SELECT 1 FROM reviews r WHERE r.event_id = p.event_id AND r.user_id = p.user_id)
+    """,
+    "review without review_left": """
+        SELECT r.event_id, r.user_id FROM reviews r
+        LEFT JOIN participants p ON p.event_id = r.event_id AND p.user_id = r.user_id
+        WHERE p.id IS NULL OR p.review_left = 0
+    """,
+    "completed before 3 reviewers": """
+        SELECT e.id, (SELECT COUNT(DISTINCT user_id) FROM reviews r WHERE r.event_id = e.id)
+        FROM events e
+        WHERE e.completed = 1
+          AND (SELECT COUNT(DISTINCT user_id) FROM reviews r WHERE r.event_id = e.id) < 3
+    """,
+    "rating aggregate drift": """
+        SELECT e.restaurant_id, COALESCE(rr.rating_sum, 0), SUM(rv.rating)
+        FROM reviews rv JOIN events e ON e.id = rv.event_id
+        LEFT JOIN restaurant_ratings rr ON rr.restaurant_id = e.restaurant_id
+        WHERE rv.rating IS NOT NULL
+        GROUP BY e.restaurant_id
+        HAVING COALESCE(MAX(rr.rating_sum), 0) != SUM(rv.rating)
+            OR COALESCE(MAX(rr.rating_count), 0) != COUNT(rv.rating)
+    """,
+}
+
+
+def check_invariants(path: str) -> List[Tuple[str, tuple]]:
+    """Все запросы в одной читающей транзакции: видим согласованное состояние."""
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        violations = [(name, tuple(row)) for name, sql in INVARIANT_QUERIES.items() for row in conn.execute(sql)]
+        conn.execute("COMMIT")
+        return violations
+    finally:
+        conn.close()
+
+
+def prepare_db(events: int) -> List[int]:
+    from db import _get_db_path, create_event, import_restaurants_from_json, init_db, migrate_schema
+
+    init_db()
+    migrate_schema()
+    import_restaurants_from_json(
+        [{"name": f"Ресторан {i}", "address": f"ул. Стресса, {i}", "cuisine": "тест"} for i in range(events)]
+    )
+    with sqlite3.connect(_get_db_path()) as conn:
+        restaurant_ids = [rid for (rid,) in conn.execute("SELECT id FROM restaurants ORDER BY id LIMIT ?", (events,))]
+    return [create_event(chat_id=-1000 - i, restaurant_id=rid, message_id=i) for i, rid in enumerate(restaurant_ids)]
+
+
+def _worker(seed: int, ops: int, event_ids: List[int], users: List[int], counts: Counter, errors: Counter) -> None:
+    from db import cancel_participation, count_distinct_reviews, mark_event_completed, save_review, toggle_participation
+
+    rng = random.Random(seed)
+    for _ in range(ops):
+        op = rng.choices(OPS, OP_WEIGHTS)[0]
+        event_id = rng.choice(event_ids)
+        user_id = rng.choice(users)
+        try:
+            if op == "join":
+                toggle_participation(event_id, user_id, f"user{user_id}", None)
+            elif op == "cancel":
+                cancel_participation(event_id, user_id)
+            else:
+                ok, _ = save_review(event_id, user_id, f"user{user_id}", f"отзыв {rng.random():.6f}", rng.randint(1, 5))
+                if ok and count_distinct_reviews(event_id) >= 3:
+                    mark_event_completed(event_id)
+        except sqlite3.OperationalError as e:
+            errors[f"{op}: {e}"] += 1
+            continue
+        counts[op] += 1
+
+
+def run_process(index: int, threads: int, ops: int, event_ids: List[int], users: List[int]) -> Tuple[Counter, Counter]:
+    """Один процесс: threads потоков по ops операций (потоки делят _DB_LOCK процесса)."""
+    counts: Counter = Counter()
+    errors: Counter = Counter()
+    workers = [
+        threading.Thread(target=_worker, args=(index * 1000 + t, ops, event_ids, users, counts, errors))
+        for t in range(threads)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return counts, errors
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4, help="потоков в каждом процессе")
+    parser.add_argument("--ops", type=int, default=500, help="операций на поток")
+    parser.add_argument("--events", type=int, default=8)
+    parser.add_argument("--users", type=int, default=6, help="пользователей на все события (больше 3 — есть конкуренция)")
+    parser.add_argument("--check-interval", type=float, default=0.05)
+    parser.add_argument("--db", help="файл БД (по умолчанию — новый во временном каталоге)")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="stress_db_"), "bot.db")
+    # процессы (spawn) наследуют окружение и открывают тот же файл
+    os.environ["DB_PATH"] = path
+    event_ids = prepare_db(args.events)
+    users = list(range(1, args.users + 1))
+
+    seen: Dict[Tuple[str, tuple], int] = {}
+    checks = 0
+    stop = threading.Event()
+
+    def checker() -> None:
+        nonlocal checks
+        while not stop.wait(args.check_interval):
+            for violation in check_invariants(path):
+                seen[violation] = seen.get(violation, 0) + 1
+            checks += 1
+
+    checker_thread = threading.Thread(target=checker, daemon=True)
+    checker_thread.start()
+    started = time.perf_counter()
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(args.processes) as pool:
+        results = pool.starmap(
+            run_process,
+            [(i, args.threads, args.ops, event_ids, users) for i in range(args.processes)],
+        )
+    elapsed = time.perf_counter() - started
+    stop.set()
+    checker_thread.join()
+
+    counts: Counter = Counter()
+    errors: Counter = Counter()
+    for c, e in results:
+        counts.update(c)
+        errors.update(e)
+    final = check_invariants(path)
+
+    total = sum(counts.values())
+    print(f"db: {path}")
+    print(
+        f"{args.processes} processes x {args.threads} threads x {args.ops} ops, "
+        f"{len(event_ids)} events, {len(users)} users: {elapsed:.2f} s"
+    )
+    print(f"  total   {total:7d} ops  {total / elapsed:8.0f} ops/s")
+    for op in OPS:
+        print(f"  {op:<7} {counts[op]:7d} ops  {counts[op] / elapsed:8.0f} ops/s")
+    for message, count in errors.most_common():
+        print(f"  error x{count}: {message}")
+    print(f"invariant checks during run: {checks}")
+
+    violations: Set[Tuple[str, tuple]] = set(seen) | set(final)
+    if not violations:
+        print("OK: invariants held")
+        return
+    for name in INVARIANT_QUERIES:
+        rows = sorted(row for violation_name, row in violations if violation_name == name)
+        if rows:
+            examples = ", ".join(map(str, rows[:5]))
+            print(f"VIOLATION {name}: {len(rows)} distinct, e.g. {examples}")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,45 @@
 import os
+import re
+import math
+import json
+import random
 import sqlite3
 import threading
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
 from datetime import datetime, timedelta, timezone
 
 _DB_LOCK = threading.Lock()
+_T = TypeVar("_T")
 
 
 def _get_db_path() -> str:
 	return os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "bot.db"))
 
 
+# Число COMMIT в этом процессе: по нему снимок аналитики (snapshot.py) решает, что устарел
+_COMMITS = 0
+
+
+def _note_commit() -> None:
+	global _COMMITS
+	_COMMITS += 1
+
+
+def commit_count() -> int:
+	return _COMMITS
+
+
+class _CountingConnection(sqlite3.Connection):
+	def commit(self) -> None:
+		pending = self.in_transaction
+		super().commit()
+		if pending:
+			_note_commit()
+
+
 def _connect() -> sqlite3.Connection:
-	conn = sqlite3.connect(_get_db_path(), check_same_thread=False)
+	conn = sqlite3.connect(_get_db_path(), check_same_thread=False, factory=_CountingConnection)
 	conn.row_factory = sqlite3.Row
 	try:
 		conn.execute("PRAGMA foreign_keys = ON")
@@ -21,11 +48,153 @@ def _connect() -> sqlite3.Connection:
 	return conn
 
 
+def _read(query: Callable[..., _T], *args: Any) -> _T:
+	"""Выполняет query(cur, *args) на свежем соединении с bot.db."""
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			return query(conn.cursor(), *args)
+		finally:
+			conn.close()
+
+
+# Таблицы со ссылками на родителя: удаление события каскадно чистит участников и отзывы.
+# Ресторан с событиями (живыми или в архиве) удалить нельзя (RESTRICT): вместе с ним
+# пропала бы история походов и отзывов.
+# {table} подставляется, чтобы тем же DDL пересобирать таблицы старых БД.
+_TABLE_DDL: Dict[str, str] = {
+	"events": """
+		CREATE TABLE IF NOT EXISTS {table} (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			chat_id INTEGER NOT NULL,
+			restaurant_id INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE RESTRICT,
+			message_id INTEGER NOT NULL,
+			reminder_at_utc TEXT,
+			reminder_sent INTEGER DEFAULT 0,
+			feedback_prompt_sent INTEGER DEFAULT 0,
+			feedback_message_id INTEGER,
+			created_at_utc TEXT NOT NULL,
+			completed INTEGER DEFAULT 0
+		)
+	""",
+	"participants": """
+		CREATE TABLE IF NOT EXISTS {table} (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+			user_id INTEGER NOT NULL REFERENCES users(user_id),
+			joined INTEGER NOT NULL DEFAULT 1,
+			joined_at_utc TEXT,
+			review_left INTEGER DEFAULT 0,
+			cancelled INTEGER DEFAULT 0,
+			penalty_amount INTEGER DEFAULT 0,
+			UNIQUE(event_id, user_id)
+		)
+	""",
+	"reviews": """
+		CREATE TABLE IF NOT EXISTS {table} (
+			id INTEGER PRIMARY KEY AUTOINCREMENT,
+			event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+			user_id INTEGER NOT NULL REFERENCES users(user_id),
+			text TEXT NOT NULL,
+			rating INTEGER,
+			created_at_utc TEXT NOT NULL,
+			UNIQUE(event_id, user_id)
+		)
+	""",
+	# Архив завершённых/брошенных событий: компактная сводка вместо живых строк.
+	# id совпадает с id исходного события (AUTOINCREMENT не переиспользует id).
+	"event_archive": """
+		CREATE TABLE IF NOT EXISTS {table} (
+			id INTEGER PRIMARY KEY,
+			chat_id INTEGER NOT NULL,
+			restaurant_id INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE RESTRICT,
+			outcome TEXT NOT NULL,
+			reminder_at_utc TEXT,
+			created_at_utc TEXT NOT NULL,
+			archived_at_utc TEXT NOT NULL,
+			participants_count INTEGER NOT NULL DEFAULT 0,
+			reviews_count INTEGER NOT NULL DEFAULT 0,
+			rating_sum INTEGER NOT NULL DEFAULT 0,
+			rating_count INTEGER NOT NULL DEFAULT 0
+		)
+	""",
+	"review_archive": """
+		CREATE TABLE IF NOT EXISTS {table} (
+			id INTEGER PRIMARY KEY,
+			event_id INTEGER NOT NULL REFERENCES event_archive(id) ON DELETE CASCADE,
+			user_id INTEGER NOT NULL REFERENCES users(user_id),
+			text TEXT NOT NULL,
+			rating INTEGER,
+			created_at_utc TEXT NOT NULL
+		)
+	""",
+}
+
+# Родительская таблица и действие ON DELETE для каждой ссылки (используется при пересборке)
+_TABLE_PARENTS: Dict[str, Tuple[str, str, str]] = {
+	"events": ("restaurant_id", "restaurants", "RESTRICT"),
+	"event_archive": ("restaurant_id", "restaurants", "RESTRICT"),
+	"participants": ("event_id", "events", "CASCADE"),
+	"reviews": ("event_id", "events", "CASCADE"),
+	"review_archive": ("event_id", "event_archive", "CASCADE"),
+}
+
+PENALTY_AMOUNT = 500
+
+# Байесовская оценка ресторана: RATING_PRIOR_WEIGHT «виртуальных» оценок RATING_PRIOR_MEAN
+# подмешиваются к настоящим, чтобы одна пятёрка не обгоняла десяток четвёрок.
+# Априорное среднее фиксировано — иначе каждая оценка меняла бы score всех ресторанов.
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_WEIGHT = 3
+
+# PRAGMA auto_vacuum: 0 — NONE, 1 — FULL, 2 — INCREMENTAL
+AUTO_VACUUM_INCREMENTAL = 2
+
+# amount в журнале знаковый: charge > 0, clear < 0
+_PENALTY_BALANCE_TRIGGER = """
+	CREATE TRIGGER IF NOT EXISTS penalty_ledger_ai AFTER INSERT ON penalty_ledger BEGIN
+		INSERT INTO penalty_balances (user_id, balance, updated_at_utc)
+		VALUES (new.user_id, new.amount, new.created_at_utc)
+		ON CONFLICT(user_id) DO UPDATE SET
+			balance = balance + excluded.balance,
+			updated_at_utc = excluded.updated_at_utc;
+	END
+"""
+
+_INDEXES: Tuple[str, ...] = (
+	"CREATE INDEX IF NOT EXISTS idx_restaurants_cuisine_price ON restaurants(cuisine_id, avg_check_max)",
+	"CREATE INDEX IF NOT EXISTS idx_restaurants_price ON restaurants(avg_check_max)",
+	"CREATE INDEX IF NOT EXISTS idx_restaurants_geo_cell ON restaurants(geo_cell)",
+	"CREATE INDEX IF NOT EXISTS idx_restaurants_norm_key ON restaurants(norm_key)",
+	"CREATE INDEX IF NOT EXISTS idx_restaurant_trigrams_restaurant ON restaurant_trigrams(restaurant_id)",
+	"CREATE INDEX IF NOT EXISTS idx_events_chat ON events(chat_id)",
+	"CREATE INDEX IF NOT EXISTS idx_events_restaurant ON events(restaurant_id)",
+	"CREATE INDEX IF NOT EXISTS idx_participants_event_joined ON participants(event_id, joined)",
+	"CREATE INDEX IF NOT EXISTS idx_participants_event_user ON participants(event_id, user_id)",
+	# ключ постраничного просмотра отзывов: (created_at_utc, id) внутри события
+	"CREATE INDEX IF NOT EXISTS idx_reviews_event_created ON reviews(event_id, created_at_utc, id)",
+	"CREATE INDEX IF NOT EXISTS idx_reviews_event_user ON reviews(event_id, user_id)",
+	"CREATE INDEX IF NOT EXISTS idx_event_archive_chat ON event_archive(chat_id, outcome)",
+	"CREATE INDEX IF NOT EXISTS idx_event_archive_restaurant ON event_archive(restaurant_id)",
+	"CREATE INDEX IF NOT EXISTS idx_review_archive_event_created ON review_archive(event_id, created_at_utc, id)",
+	"CREATE INDEX IF NOT EXISTS idx_penalty_ledger_user ON penalty_ledger(user_id, id)",
+	"CREATE INDEX IF NOT EXISTS idx_restaurant_ratings_score ON restaurant_ratings(score DESC, rating_count DESC)",
+)
+
+# Индексы, которые перекрыты более широкими из _INDEXES
+_OBSOLETE_INDEXES: Tuple[str, ...] = (
+	"idx_reviews_event",
+	"idx_review_archive_event",
+)
+
+
 def init_db() -> None:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
+			# действует только на пустом файле (до первой таблицы); старые БД переводит migrate_schema
+			cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
 			cur.execute(
 				"""
 				CREATE TABLE IF NOT EXISTS restaurants (
@@ -36,54 +205,117 @@ def init_db() -> None:
 					cuisine TEXT,
 					description TEXT,
 					average_check TEXT,
+					cuisine_id INTEGER REFERENCES cuisines(id),
+					avg_check_min INTEGER,
+					avg_check_max INTEGER,
+					latitude REAL,
+					longitude REAL,
+					geo_cell INTEGER,
+					norm_key TEXT,
 					UNIQUE(name, address)
 				)
 				"""
 			)
+			# Справочник кухонь: key — нормализованное название для поиска по индексу
 			cur.execute(
 				"""
-				CREATE TABLE IF NOT EXISTS events (
+				CREATE TABLE IF NOT EXISTS cuisines (
 					id INTEGER PRIMARY KEY AUTOINCREMENT,
-					chat_id INTEGER NOT NULL,
-					restaurant_id INTEGER NOT NULL,
-					message_id INTEGER NOT NULL,
-					reminder_at_utc TEXT,
-					reminder_sent INTEGER DEFAULT 0,
-					feedback_prompt_sent INTEGER DEFAULT 0,
-					feedback_message_id INTEGER,
-					created_at_utc TEXT NOT NULL,
-					completed INTEGER DEFAULT 0
+					name TEXT NOT NULL,
+					key TEXT NOT NULL UNIQUE
 				)
 				"""
 			)
+			# Профили Telegram-пользователей: участники и отзывы ссылаются сюда по user_id
 			cur.execute(
 				"""
-				CREATE TABLE IF NOT EXISTS participants (
-					id INTEGER PRIMARY KEY AUTOINCREMENT,
-					event_id INTEGER NOT NULL,
-					user_id INTEGER NOT NULL,
+				CREATE TABLE IF NOT EXISTS users (
+					user_id INTEGER PRIMARY KEY,
 					username TEXT,
 					first_name TEXT,
-					joined INTEGER NOT NULL DEFAULT 1,
-					joined_at_utc TEXT,
-					review_left INTEGER DEFAULT 0,
-					cancelled INTEGER DEFAULT 0,
-					penalty_amount INTEGER DEFAULT 0,
-					UNIQUE(event_id, user_id)
+					updated_at_utc TEXT NOT NULL
 				)
 				"""
 			)
+			for table in ("events", "participants", "reviews"):
+				cur.execute(_TABLE_DDL[table].format(table=table))
+			for table in ("event_archive", "review_archive"):
+				cur.execute(_TABLE_DDL[table].format(table=table))
+			# Журнал штрафов: только добавление строк (charge — начисление, clear — списание
+			# всего остатка). Баланс пользователя ведёт триггер в той же транзакции.
 			cur.execute(
 				"""
-				CREATE TABLE IF NOT EXISTS reviews (
+				CREATE TABLE IF NOT EXISTS penalty_ledger (
 					id INTEGER PRIMARY KEY AUTOINCREMENT,
-					event_id INTEGER NOT NULL,
 					user_id INTEGER NOT NULL,
-					username TEXT,
-					text TEXT NOT NULL,
-					rating INTEGER,
-					created_at_utc TEXT NOT NULL,
-					UNIQUE(event_id, user_id)
+					event_id INTEGER,
+					kind TEXT NOT NULL,
+					amount INTEGER NOT NULL,
+					created_at_utc TEXT NOT NULL
+				)
+				"""
+			)
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS penalty_balances (
+					user_id INTEGER PRIMARY KEY,
+					balance INTEGER NOT NULL DEFAULT 0,
+					updated_at_utc TEXT NOT NULL
+				)
+				"""
+			)
+			cur.execute(_PENALTY_BALANCE_TRIGGER)
+			# Триграммы нормализованного названия ресторана: поиск похожих при импорте
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS restaurant_trigrams (
+					trigram TEXT NOT NULL,
+					restaurant_id INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+					PRIMARY KEY (trigram, restaurant_id)
+				) WITHOUT ROWID
+				"""
+			)
+			# Пары «вероятно, тот же ресторан», найденные при импорте (для ручного разбора)
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS restaurant_duplicates (
+					restaurant_id INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+					duplicate_of INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+					similarity REAL NOT NULL,
+					detected_at_utc TEXT NOT NULL,
+					PRIMARY KEY (restaurant_id, duplicate_of)
+				) WITHOUT ROWID
+				"""
+			)
+			# Оценки ресторана по всем чатам (живые и архивные отзывы) — для /top.
+			# Обновляется в транзакциях, которые добавляют или удаляют отзывы.
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS restaurant_ratings (
+					restaurant_id INTEGER PRIMARY KEY REFERENCES restaurants(id) ON DELETE CASCADE,
+					rating_sum INTEGER NOT NULL DEFAULT 0,
+					rating_count INTEGER NOT NULL DEFAULT 0,
+					score REAL NOT NULL,
+					updated_at_utc TEXT NOT NULL
+				)
+				"""
+			)
+			# настройки чатов (часовой пояс и т.п.)
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS chat_settings (
+					chat_id INTEGER PRIMARY KEY,
+					timezone TEXT,
+					updated_at_utc TEXT NOT NULL
+				)
+				"""
+			)
+			# служебные ключи (отпечаток seed-файла и т.п.)
+			cur.execute(
+				"""
+				CREATE TABLE IF NOT EXISTS meta (
+					key TEXT PRIMARY KEY,
+					value TEXT
 				)
 				"""
 			)
@@ -91,7 +323,7 @@ def init_db() -> None:
 			cur.execute("CREATE INDEX IF NOT EXISTS idx_events_chat ON events(chat_id)")
 			cur.execute("CREATE INDEX IF NOT EXISTS idx_participants_event_joined ON participants(event_id, joined)")
 			cur.execute("CREATE INDEX IF NOT EXISTS idx_participants_event_user ON participants(event_id, user_id)")
-			cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_event ON reviews(event_id)")
+			cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_event_created ON reviews(event_id, created_at_utc, id)")
 			cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_event_user ON reviews(event_id, user_id)")
 			conn.commit()
 		finally:
@@ -121,94 +353,798 @@ def migrate_schema() -> None:
                     )
                     """
                 )
+            # restaurants: числовой средний чек и ссылка на справочник кухонь
+            cur.execute("PRAGMA table_info(restaurants)")
+            cols = {r[1] for r in cur.fetchall()}
+            if "cuisine_id" not in cols:
+                cur.execute("ALTER TABLE restaurants ADD COLUMN cuisine_id INTEGER REFERENCES cuisines(id)")
+                cur.execute("ALTER TABLE restaurants ADD COLUMN avg_check_min INTEGER")
+                cur.execute("ALTER TABLE restaurants ADD COLUMN avg_check_max INTEGER")
+                _backfill_restaurant_filters(cur)
+            if "geo_cell" not in cols:
+                cur.execute("ALTER TABLE restaurants ADD COLUMN latitude REAL")
+                cur.execute("ALTER TABLE restaurants ADD COLUMN longitude REAL")
+                cur.execute("ALTER TABLE restaurants ADD COLUMN geo_cell INTEGER")
+            if "norm_key" not in cols:
+                cur.execute("ALTER TABLE restaurants ADD COLUMN norm_key TEXT")
+            # имена пользователей переезжают из participants/reviews в users
+            _backfill_users(cur)
+            conn.commit()
+            # старые БД создавались без FOREIGN KEY (или с каскадом от ресторанов) и с копиями имён —
+            # пересобираем таблицы (родители раньше детей)
+            for table in ("events", "event_archive", "participants", "reviews", "review_archive"):
+                if not _has_foreign_key(cur, table) or "username" in _table_columns(cur, table):
+                    _rebuild_table(conn, table)
             # ensure indexes created in init
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_events_chat ON events(chat_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_participants_event_joined ON participants(event_id, joined)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_participants_event_user ON participants(event_id, user_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_event ON reviews(event_id)")
-            cur.execute("CREATE INDEX IF NOT EXISTS idx_reviews_event_user ON reviews(event_id, user_id)")
+            for ddl in _INDEXES:
+                cur.execute(ddl)
+            for name in _OBSOLETE_INDEXES:
+                cur.execute(f"DROP INDEX IF EXISTS {name}")
+            # нормализованные ключи и триграммы для ресторанов, добавленных до их появления
+            _index_new_restaurants(cur)
+            # архив хранит исходные id событий и отзывов: новые id не должны с ними совпасть
+            # (ранние пересборки таблиц могли сбросить счётчики AUTOINCREMENT)
+            for table, archive in (("events", "event_archive"), ("reviews", "review_archive")):
+                cur.execute(f"SELECT MAX(id) FROM {archive}")
+                max_archived = cur.fetchone()[0]
+                if max_archived is not None:
+                    _raise_sequence(cur, table, int(max_archived))
+            # полнотекстовый индекс создаётся после пересборки: DROP TABLE удаляет триггеры
+            _ensure_search_index(cur)
+            _backfill_penalty_ledger(cur)
+            _ensure_restaurant_ratings(cur)
             conn.commit()
+            _enable_incremental_vacuum(cur)
         finally:
             conn.close()
 
 
-def import_restaurants_from_json(data: Dict[str, Any]) -> int:
-	inserted = 0
-	restaurants = data.get("restaurants", [])
+def _enable_incremental_vacuum(cur: sqlite3.Cursor) -> None:
+    """
+    Переводит БД в auto_vacuum=INCREMENTAL: освобождённые страницы можно
+    возвращать файловой системе порциями (maintenance.py). Для существующей БД
+    режим вступает в силу только после полного VACUUM — один раз, при старте.
+    """
+    cur.execute("PRAGMA auto_vacuum")
+    if int(cur.fetchone()[0]) == AUTO_VACUUM_INCREMENTAL:
+        return
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cur.execute("VACUUM")
+
+
+# Полнотекстовый поиск: restaurants_fts — external content над restaurants,
+# reviews_fts хранит текст живых и архивных отзывов (rowid = id отзыва).
+_FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+
+_SEARCH_TRIGGERS: Tuple[str, ...] = (
+    """
+    CREATE TRIGGER IF NOT EXISTS restaurants_fts_ai AFTER INSERT ON restaurants BEGIN
+        INSERT INTO restaurants_fts (rowid, name, cuisine, description, address)
+        VALUES (new.id, new.name, new.cuisine, new.description, new.address);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS restaurants_fts_ad AFTER DELETE ON restaurants BEGIN
+        INSERT INTO restaurants_fts (restaurants_fts, rowid, name, cuisine, description, address)
+        VALUES ('delete', old.id, old.name, old.cuisine, old.description, old.address);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS restaurants_fts_au AFTER UPDATE OF name, cuisine, description, address ON restaurants BEGIN
+        INSERT INTO restaurants_fts (restaurants_fts, rowid, name, cuisine, description, address)
+        VALUES ('delete', old.id, old.name, old.cuisine, old.description, old.address);
+        INSERT INTO restaurants_fts (rowid, name, cuisine, description, address)
+        VALUES (new.id, new.name, new.cuisine, new.description, new.address);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_ai AFTER INSERT ON reviews BEGIN
+        INSERT INTO reviews_fts (rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_au AFTER UPDATE OF text ON reviews BEGIN
+        UPDATE reviews_fts SET text = new.text WHERE rowid = new.id;
+    END
+    """,
+    # при архивации отзыв сначала копируется в review_archive — его строку в индексе сохраняем
+    """
+    CREATE TRIGGER IF NOT EXISTS reviews_fts_ad AFTER DELETE ON reviews BEGIN
+        DELETE FROM reviews_fts
+        WHERE rowid = old.id AND NOT EXISTS (SELECT 1 FROM review_archive WHERE id = old.id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS review_archive_fts_ad AFTER DELETE ON review_archive BEGIN
+        DELETE FROM reviews_fts WHERE rowid = old.id;
+    END
+    """,
+)
+
+
+def _ensure_search_index(cur: sqlite3.Cursor) -> None:
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('restaurants_fts', 'reviews_fts')")
+    existing = {r[0] for r in cur.fetchall()}
+    if "restaurants_fts" not in existing:
+        cur.execute(
+            f"""
+            CREATE VIRTUAL TABLE restaurants_fts USING fts5(
+                name, cuisine, description, address,
+                content='restaurants', content_rowid='id', tokenize='{_FTS_TOKENIZER}'
+            )
+            """
+        )
+        cur.execute("INSERT INTO restaurants_fts (restaurants_fts) VALUES ('rebuild')")
+    if "reviews_fts" not in existing:
+        cur.execute(f"CREATE VIRTUAL TABLE reviews_fts USING fts5(text, tokenize='{_FTS_TOKENIZER}')")
+        cur.execute(
+            """
+            INSERT INTO reviews_fts (rowid, text)
+            SELECT id, text FROM reviews
+            UNION ALL
+            SELECT id, text FROM review_archive
+            """
+        )
+    for ddl in _SEARCH_TRIGGERS:
+        cur.execute(ddl)
+
+
+def _raise_sequence(cur: sqlite3.Cursor, table: str, seq: int) -> None:
+    """Поднимает счётчик AUTOINCREMENT таблицы не ниже seq."""
+    cur.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq, table))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq))
+
+
+def _table_columns(cur: sqlite3.Cursor, table: str) -> List[str]:
+    cur.execute(f"PRAGMA table_info({table})")
+    return [r[1] for r in cur.fetchall()]
+
+
+def _backfill_users(cur: sqlite3.Cursor) -> None:
+    """Заполняет users из старых колонок username/first_name (берётся самый свежий профиль)."""
+    profiles: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+    # порядок важен: более поздние строки перекрывают ранние, участники — самый полный источник
+    for table in ("review_archive", "reviews", "participants"):
+        cols = _table_columns(cur, table)
+        if "username" not in cols:
+            continue
+        first_name = "first_name" if "first_name" in cols else "NULL"
+        cur.execute(f"SELECT user_id, username, {first_name} AS first_name FROM {table} ORDER BY id")
+        for r in cur.fetchall():
+            old_username, old_first_name = profiles.get(r["user_id"], (None, None))
+            profiles[r["user_id"]] = (r["username"] or old_username, r["first_name"] or old_first_name)
+    if not profiles:
+        return
+    now = datetime.now(timezone.utc).isoformat()
+    cur.executemany(
+        """
+        INSERT INTO users (user_id, username, first_name, updated_at_utc) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id) DO NOTHING
+        """,
+        [(user_id, username, first_name, now) for user_id, (username, first_name) in profiles.items()],
+    )
+
+
+def _backfill_penalty_ledger(cur: sqlite3.Cursor) -> None:
+    """Переносит непогашенные штрафы из participants в журнал (один раз, пока журнал пуст)."""
+    cur.execute("SELECT 1 FROM penalty_ledger LIMIT 1")
+    if cur.fetchone():
+        return
+    # раньше действовал последний непогашенный штраф — переносим его как одно начисление
+    cur.execute(
+        """
+        INSERT INTO penalty_ledger (user_id, event_id, kind, amount, created_at_utc)
+        SELECT p.user_id, p.event_id, 'charge', p.penalty_amount, ?
+        FROM participants p
+        WHERE p.cancelled = 1 AND p.penalty_amount > 0
+          AND p.id = (
+              SELECT MAX(p2.id) FROM participants p2
+              WHERE p2.user_id = p.user_id AND p2.cancelled = 1 AND p2.penalty_amount > 0
+          )
+        ORDER BY p.id
+        """,
+        (datetime.now(timezone.utc).isoformat(),),
+    )
+
+
+_SCORE_SQL = "(:prior_sum + {sum}) * 1.0 / (:prior_weight + {count})"
+
+
+def _rating_params(**params: Any) -> Dict[str, Any]:
+    params["prior_sum"] = RATING_PRIOR_MEAN * RATING_PRIOR_WEIGHT
+    params["prior_weight"] = RATING_PRIOR_WEIGHT
+    return params
+
+
+RATINGS_BUILT_KEY = "restaurant_ratings_built"
+
+
+def _ensure_restaurant_ratings(cur: sqlite3.Cursor) -> None:
+    """
+    Один раз заполняет restaurant_ratings по отзывам (отметка в meta); дальше таблица
+    ведётся приращениями, и полный пересчёт на каждом старте не нужен. Удалить
+    отметку — пересчитать заново при следующем запуске.
+    """
+    cur.execute("SELECT 1 FROM meta WHERE key = ?", (RATINGS_BUILT_KEY,))
+    if cur.fetchone() is not None:
+        return
+    _rebuild_restaurant_ratings(cur)
+    cur.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (RATINGS_BUILT_KEY, datetime.now(timezone.utc).isoformat()),
+    )
+
+
+def _rebuild_restaurant_ratings(cur: sqlite3.Cursor) -> None:
+    """Пересчитывает restaurant_ratings целиком (дальше таблица ведётся приращениями)."""
+    now = datetime.now(timezone.utc).isoformat()
+    cur.execute("DELETE FROM restaurant_ratings")
+    cur.execute(
+        f"""
+        INSERT INTO restaurant_ratings (restaurant_id, rating_sum, rating_count, score, updated_at_utc)
+        SELECT restaurant_id, SUM(rating), COUNT(rating),
+               {_SCORE_SQL.format(sum="SUM(rating)", count="COUNT(rating)")}, :now
+        FROM (
+            SELECT e.restaurant_id, rv.rating
+            FROM reviews rv JOIN events e ON e.id = rv.event_id
+            WHERE rv.rating IS NOT NULL
+            UNION ALL
+            SELECT a.restaurant_id, ra.rating
+            FROM review_archive ra JOIN event_archive a ON a.id = ra.event_id
+            WHERE ra.rating IS NOT NULL
+        )
+        GROUP BY restaurant_id
+        """,
+        _rating_params(now=now),
+    )
+
+
+def _add_restaurant_rating(cur: sqlite3.Cursor, restaurant_id: int, sum_delta: int, count_delta: int) -> None:
+    """Прибавляет к агрегату ресторана (отрицательные приращения — при удалении отзывов)."""
+    if not sum_delta and not count_delta:
+        return
+    # новая строка получает только неотрицательные приращения; MAX нужен, чтобы score
+    # во VALUES не стал NULL при вычитании (тогда срабатывает DO UPDATE)
+    cur.execute(
+        f"""
+        INSERT INTO restaurant_ratings (restaurant_id, rating_sum, rating_count, score, updated_at_utc)
+        VALUES (:rid, :sum, :count, {_SCORE_SQL.format(sum="MAX(:sum, 0)", count="MAX(:count, 0)")}, :now)
+        ON CONFLICT(restaurant_id) DO UPDATE SET
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_count = rating_count + excluded.rating_count,
+            score = {_SCORE_SQL.format(sum="rating_sum + excluded.rating_sum", count="rating_count + excluded.rating_count")},
+            updated_at_utc = excluded.updated_at_utc
+        """,
+        _rating_params(
+            rid=restaurant_id, sum=sum_delta, count=count_delta, now=datetime.now(timezone.utc).isoformat()
+        ),
+    )
+
+
+def _subtract_event_ratings(cur: sqlite3.Cursor, event_filter: str, params: Tuple[Any, ...]) -> None:
+    """Вычитает оценки живых событий, которые сейчас будут удалены (event_filter — условие по e)."""
+    cur.execute(
+        f"""
+        SELECT e.restaurant_id, SUM(rv.rating), COUNT(rv.rating)
+        FROM events e JOIN reviews rv ON rv.event_id = e.id
+        WHERE {event_filter} AND rv.rating IS NOT NULL
+        GROUP BY e.restaurant_id
+        """,
+        params,
+    )
+    for restaurant_id, rating_sum, rating_count in cur.fetchall():
+        _add_restaurant_rating(cur, int(restaurant_id), -int(rating_sum), -int(rating_count))
+
+
+def _has_foreign_key(cur: sqlite3.Cursor, table: str) -> bool:
+    """Есть ли у таблицы ссылка на родителя с нужным действием ON DELETE."""
+    column, parent, on_delete = _TABLE_PARENTS[table]
+    cur.execute(f"PRAGMA foreign_key_list({table})")
+    return any(
+        r["from"] == column and r["table"] == parent and r["on_delete"].upper() == on_delete
+        for r in cur.fetchall()
+    )
+
+
+def _rebuild_table(conn: sqlite3.Connection, table: str) -> None:
+    """Пересоздаёт таблицу по актуальному DDL (SQLite не умеет добавлять FOREIGN KEY через ALTER)."""
+    column, parent, _ = _TABLE_PARENTS[table]
+    cur = conn.cursor()
+    # foreign_keys нельзя переключить внутри транзакции
+    conn.commit()
+    cur.execute("PRAGMA foreign_keys = OFF")
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute(f"PRAGMA table_info({table})")
+        old_cols = [r[1] for r in cur.fetchall()]
+        # счётчик AUTOINCREMENT удаляется вместе с таблицей — сохраним, чтобы id не пошли заново
+        cur.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+        seq_row = cur.fetchone()
+        tmp = f"{table}__new"
+        cur.execute(f"DROP TABLE IF EXISTS {tmp}")
+        cur.execute(_TABLE_DDL[table].format(table=tmp))
+        cur.execute(f"PRAGMA table_info({tmp})")
+        new_cols = {r[1] for r in cur.fetchall()}
+        cols = ", ".join(c for c in old_cols if c in new_cols)
+        # строки-сироты (родитель уже удалён) не переносим
+        cur.execute(
+            f"INSERT INTO {tmp} ({cols}) SELECT {cols} FROM {table} "
+            f"WHERE {column} IN (SELECT id FROM {parent})"
+        )
+        cur.execute(f"DROP TABLE {table}")
+        cur.execute(f"ALTER TABLE {tmp} RENAME TO {table}")
+        if seq_row is not None:
+            _raise_sequence(cur, table, int(seq_row["seq"]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("PRAGMA foreign_keys = ON")
+
+
+_PRICE_RE = re.compile(r"\d+(?:[ \u00a0]\d{3})*")
+
+
+def parse_average_check(text: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+	"""'1500-2500 руб' -> (1500, 2500); '2000 руб' -> (2000, 2000); без чисел -> (None, None)."""
+	numbers = [int(re.sub(r"\D", "", m)) for m in _PRICE_RE.findall(text or "")]
+	if not numbers:
+		return None, None
+	return min(numbers), max(numbers)
+
+
+def cuisine_key(name: Optional[str]) -> str:
+	return " ".join((name or "").replace("ё", "е").replace("Ё", "Е").split()).casefold()
+
+
+_KEY_TOKEN_RE = re.compile(r"\w+(?:-\w+)*")
+
+# Сокращения в адресах -> одна форма; пустая строка — служебное слово выбрасывается
+_ADDRESS_ABBREVIATIONS: Dict[str, str] = {
+	"ул": "", "улица": "",
+	"д": "", "дом": "",
+	"г": "", "город": "",
+	"пр": "пр", "пр-т": "пр", "пр-кт": "пр", "просп": "пр", "проспект": "пр",
+	"пр-д": "проезд", "проезд": "проезд",
+	"пер": "пер", "переулок": "пер",
+	"пл": "пл", "площадь": "пл",
+	"ш": "ш", "шоссе": "ш",
+	"наб": "наб", "набережная": "наб",
+	"б-р": "бул", "бульв": "бул", "бульвар": "бул",
+	"туп": "туп", "тупик": "туп",
+	"мкр": "мкр", "микрорайон": "мкр",
+	"стр": "стр", "строение": "стр",
+	"к": "к", "корп": "к", "корпус": "к",
+}
+
+
+def _key_tokens(text: Optional[str]) -> List[str]:
+	return _KEY_TOKEN_RE.findall((text or "").casefold().replace("ё", "е"))
+
+
+def normalize_name(name: Optional[str]) -> str:
+	"""'«Мама Италия»!' -> 'мама италия'."""
+	return " ".join(_key_tokens(name))
+
+
+def normalize_address(address: Optional[str]) -> str:
+	"""'ул. Петровка, д. 25' -> '25 петровка': без пунктуации и служебных слов, слова по алфавиту."""
+	tokens = (_ADDRESS_ABBREVIATIONS.get(t, t) for t in _key_tokens(address))
+	return " ".join(sorted(t for t in tokens if t))
+
+
+def restaurant_key(name: Optional[str], address: Optional[str]) -> str:
+	"""Значение restaurants.norm_key: одинаково у записей, отличающихся только написанием."""
+	return f"{normalize_name(name)}|{normalize_address(address)}"
+
+
+def _ensure_cuisine_ids(cur: sqlite3.Cursor, names: List[Optional[str]]) -> Dict[str, int]:
+	"""Добавляет новые кухни в справочник и возвращает отображение key -> id."""
+	by_key: Dict[str, str] = {}
+	for name in names:
+		key = cuisine_key(name)
+		if key and key not in by_key:
+			by_key[key] = " ".join((name or "").split())
+	if not by_key:
+		return {}
+	cur.executemany(
+		"INSERT OR IGNORE INTO cuisines (name, key) VALUES (?, ?)",
+		[(name, key) for key, name in by_key.items()],
+	)
+	cur.execute(
+		"SELECT id, key FROM cuisines WHERE key IN (SELECT value FROM json_each(?))",
+		(json.dumps(list(by_key)),),
+	)
+	return {r["key"]: int(r["id"]) for r in cur.fetchall()}
+
+
+def _backfill_restaurant_filters(cur: sqlite3.Cursor) -> None:
+	cur.execute("SELECT id, cuisine, average_check FROM restaurants")
+	rows = cur.fetchall()
+	cuisine_ids = _ensure_cuisine_ids(cur, [r["cuisine"] for r in rows])
+	cur.executemany(
+		"UPDATE restaurants SET cuisine_id = ?, avg_check_min = ?, avg_check_max = ? WHERE id = ?",
+		[
+			(cuisine_ids.get(cuisine_key(r["cuisine"])), *parse_average_check(r["average_check"]), r["id"])
+			for r in rows
+		],
+	)
+
+
+# Сетка для поиска «рядом»: ячейка GEO_CELL_DEG×GEO_CELL_DEG градусов (~1.1 км по широте).
+# Номер ячейки = строка по широте * _GEO_ROW_SPAN + столбец по долготе, поэтому
+# соседние по долготе ячейки одной строки образуют непрерывный диапазон номеров.
+GEO_CELL_DEG = 0.01
+_GEO_ROW_SPAN = int(round(360 / GEO_CELL_DEG)) + 1
+_EARTH_RADIUS_KM = 6371.0088
+
+
+def _geo_row(lat: float) -> int:
+	return int(math.floor((lat + 90.0) / GEO_CELL_DEG))
+
+
+def _geo_col(lon: float) -> int:
+	return int(math.floor((lon + 180.0) / GEO_CELL_DEG))
+
+
+def geo_cell(lat: Optional[float], lon: Optional[float]) -> Optional[int]:
+	if lat is None or lon is None:
+		return None
+	return _geo_row(lat) * _GEO_ROW_SPAN + _geo_col(lon)
+
+
+def _parse_coord(value: Any, limit: float) -> Optional[float]:
+	if value is None or value == "":
+		return None
+	try:
+		coord = float(str(value).replace(",", "."))
+	except ValueError:
+		return None
+	return coord if -limit <= coord <= limit else None
+
+
+def _item_coords(item: Dict[str, Any]) -> Tuple[Optional[float], Optional[float]]:
+	"""Координаты из JSON/CSV: lat/latitude и lon/lng/longitude; неполная пара отбрасывается."""
+	lat = _parse_coord(item.get("latitude", item.get("lat")), 90.0)
+	lon = _parse_coord(item.get("longitude", item.get("lon", item.get("lng"))), 180.0)
+	if lat is None or lon is None:
+		return None, None
+	return lat, lon
+
+
+def _restaurant_params(item: Dict[str, Any], cuisine_ids: Dict[str, int]) -> Optional[Tuple[Any, ...]]:
+	name = (item.get("name") or "").strip()
+	address = (item.get("address") or "").strip()
+	if not name:
+		return None
+	avg_min, avg_max = parse_average_check(item.get("average_check"))
+	lat, lon = _item_coords(item)
+	return (
+		item.get("id"),
+		name,
+		address,
+		item.get("cuisine"),
+		item.get("description"),
+		item.get("average_check"),
+		cuisine_ids.get(cuisine_key(item.get("cuisine"))),
+		avg_min,
+		avg_max,
+		lat,
+		lon,
+		geo_cell(lat, lon),
+	)
+
+
+def _insert_restaurants(cur: sqlite3.Cursor, items: List[Dict[str, Any]], *, upsert: bool = False) -> int:
+	"""Пакетная вставка ресторанов одним executemany. Возвращает число изменённых строк."""
+	cuisine_ids = _ensure_cuisine_ids(cur, [item.get("cuisine") for item in items])
+	params = [p for p in (_restaurant_params(item, cuisine_ids) for item in items) if p is not None]
+	if not upsert:
+		params = _skip_known_restaurants(cur, params)
+	if not params:
+		return 0
+	columns = (
+		"source_id, name, address, cuisine, description, average_check, cuisine_id, "
+		"avg_check_min, avg_check_max, latitude, longitude, geo_cell"
+	)
+	if upsert:
+		# seed-файл — источник истины: обновляем поля уже существующих ресторанов
+		sql = f"""
+			INSERT INTO restaurants ({columns})
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			ON CONFLICT(name, address) DO UPDATE SET
+				source_id = excluded.source_id,
+				cuisine = excluded.cuisine,
+				description = excluded.description,
+				average_check = excluded.average_check,
+				cuisine_id = excluded.cuisine_id,
+				avg_check_min = excluded.avg_check_min,
+				avg_check_max = excluded.avg_check_max,
+				latitude = COALESCE(excluded.latitude, latitude),
+				longitude = COALESCE(excluded.longitude, longitude),
+				geo_cell = COALESCE(excluded.geo_cell, geo_cell)
+		"""
+	else:
+		sql = f"""
+			INSERT OR IGNORE INTO restaurants ({columns})
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+		"""
+	cur.executemany(sql, params)
+	changed = max(cur.rowcount, 0)
+	if changed:
+		_index_new_restaurants(cur)
+		_bump_catalogue_version(cur)
+	return changed
+
+
+def _skip_known_restaurants(cur: sqlite3.Cursor, params: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+	"""Убирает строки, чей norm_key уже есть в каталоге или встречался выше в том же файле."""
+	by_key: Dict[str, Tuple[Any, ...]] = {}
+	for p in params:
+		by_key.setdefault(restaurant_key(p[1], p[2]), p)
+	cur.execute(
+		"SELECT norm_key FROM restaurants WHERE norm_key IN (SELECT value FROM json_each(?))",
+		(json.dumps(list(by_key)),),
+	)
+	for (key,) in cur.fetchall():
+		by_key.pop(key, None)
+	return list(by_key.values())
+
+
+# Триграмма, встречающаяся у большего числа ресторанов, не опрашивается («стоп-триграмма»):
+# проверка одной строки ограничена сверху и не растёт вместе с каталогом.
+_TRIGRAM_POSTING_LIMIT = 200
+_DUPLICATE_CANDIDATES = 20
+NAME_SIMILARITY = 0.5
+ADDRESS_SIMILARITY = 0.5
+
+
+def _trigrams(text: str) -> Set[str]:
+	padded = f"  {text} "
+	return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+	if not a or not b:
+		return 0.0
+	return len(a & b) / len(a | b)
+
+
+def _address_similarity(a: str, b: str) -> float:
+	"""Сходство нормализованных адресов; разные номера домов — разные адреса."""
+	numbers_a = {t for t in a.split() if t[0].isdigit()}
+	numbers_b = {t for t in b.split() if t[0].isdigit()}
+	if numbers_a and numbers_b and not numbers_a & numbers_b:
+		return 0.0
+	return _jaccard(_trigrams(a), _trigrams(b))
+
+
+def _is_stop_gram(cur: sqlite3.Cursor, gram: str, postings: Dict[str, int]) -> bool:
+	"""postings — длины списков (не больше лимита + 1), общие на весь импорт."""
+	size = postings.get(gram)
+	if size is None:
+		cur.execute(
+			"SELECT COUNT(*) FROM (SELECT 1 FROM restaurant_trigrams WHERE trigram = ? LIMIT ?)",
+			(gram, _TRIGRAM_POSTING_LIMIT + 1),
+		)
+		size = postings[gram] = int(cur.fetchone()[0])
+	return size > _TRIGRAM_POSTING_LIMIT
+
+
+def _find_near_duplicates(
+	cur: sqlite3.Cursor, name_grams: Set[str], address_key: str, postings: Dict[str, int]
+) -> List[Tuple[int, float]]:
+	"""Похожие рестораны из каталога: (id, сходство). Кандидаты — по общим триграммам названия."""
+	probe = [gram for gram in name_grams if not _is_stop_gram(cur, gram, postings)]
+	if not probe:
+		return []
+	# сходство Жаккара не выше shared / |grams|; пропущенные стоп-триграммы могли быть общими
+	min_shared = NAME_SIMILARITY * len(name_grams) - (len(name_grams) - len(probe))
+	cur.execute(
+		"""
+		SELECT restaurant_id FROM restaurant_trigrams
+		WHERE trigram IN (SELECT value FROM json_each(?))
+		GROUP BY restaurant_id
+		HAVING COUNT(*) >= ?
+		ORDER BY COUNT(*) DESC
+		LIMIT ?
+		""",
+		(json.dumps(probe), max(min_shared, 1), _DUPLICATE_CANDIDATES),
+	)
+	candidates = [row[0] for row in cur.fetchall()]
+	if not candidates:
+		return []
+	cur.execute(
+		"SELECT id, norm_key FROM restaurants WHERE id IN (SELECT value FROM json_each(?))",
+		(json.dumps(candidates),),
+	)
+	found: List[Tuple[int, float]] = []
+	for row in cur.fetchall():
+		other_name, _, other_address = (row["norm_key"] or "").partition("|")
+		similarity = _jaccard(name_grams, _trigrams(other_name))
+		if similarity < NAME_SIMILARITY:
+			continue
+		# адрес сравнивается, только если он есть у обоих
+		if address_key and other_address:
+			address_similarity = _address_similarity(address_key, other_address)
+			if address_similarity < ADDRESS_SIMILARITY:
+				continue
+			similarity = (similarity + address_similarity) / 2
+		found.append((int(row["id"]), round(similarity, 3)))
+	return found
+
+
+def _index_new_restaurants(cur: sqlite3.Cursor) -> int:
+	"""
+	Заполняет norm_key и триграммы для ресторанов без ключа и помечает похожие на уже
+	проиндексированные в restaurant_duplicates. Возвращает число помеченных ресторанов.
+	"""
+	cur.execute("SELECT id, name, address FROM restaurants WHERE norm_key IS NULL ORDER BY id")
+	rows = cur.fetchall()
+	if not rows:
+		return 0
+	now = datetime.now(timezone.utc).isoformat()
+	flagged = 0
+	postings: Dict[str, int] = {}
+	for row in rows:
+		restaurant_id = int(row["id"])
+		name_key = normalize_name(row["name"])
+		address_key = normalize_address(row["address"])
+		name_grams = _trigrams(name_key)
+		duplicates = _find_near_duplicates(cur, name_grams, address_key, postings)
+		if duplicates:
+			flagged += 1
+			cur.executemany(
+				"""
+				INSERT OR IGNORE INTO restaurant_duplicates (restaurant_id, duplicate_of, similarity, detected_at_utc)
+				VALUES (?, ?, ?, ?)
+				""",
+				[(restaurant_id, other_id, similarity, now) for other_id, similarity in duplicates],
+			)
+		cur.execute("UPDATE restaurants SET norm_key = ? WHERE id = ?", (f"{name_key}|{address_key}", restaurant_id))
+		cur.executemany(
+			"INSERT OR IGNORE INTO restaurant_trigrams (trigram, restaurant_id) VALUES (?, ?)",
+			[(gram, restaurant_id) for gram in name_grams],
+		)
+		for gram in name_grams:
+			postings[gram] += 1
+	return flagged
+
+
+def count_restaurant_duplicates() -> int:
+	"""Сколько ресторанов помечено как вероятные дубликаты."""
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			for item in restaurants:
-				name = (item.get("name") or "").strip()
-				address = (item.get("address") or "").strip()
-				if not name:
-					continue
-				cur.execute(
-					"""
-					INSERT OR IGNORE INTO restaurants (source_id, name, address, cuisine, description, average_check)
-					VALUES (?, ?, ?, ?, ?, ?)
-					""",
-					(
-						item.get("id"),
-						name,
-						address,
-						item.get("cuisine"),
-						item.get("description"),
-						item.get("average_check"),
-					),
-				)
-				if cur.rowcount > 0:
-					inserted += 1
+			cur.execute("SELECT COUNT(DISTINCT restaurant_id) FROM restaurant_duplicates")
+			return int(cur.fetchone()[0])
+		finally:
+			conn.close()
+
+
+CATALOGUE_VERSION_KEY = "catalogue_version"
+
+
+def _bump_catalogue_version(cur: sqlite3.Cursor) -> None:
+	"""Версия каталога меняется при каждом изменении ресторанов — по ней сбрасываются кэши."""
+	cur.execute(
+		"INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+		(CATALOGUE_VERSION_KEY, str(time.time_ns())),
+	)
+
+
+def import_restaurants_from_json(data: Any) -> int:
+	"""Принимает как список ресторанов, так и объект вида {"restaurants": [...]}."""
+	restaurants = data.get("restaurants", []) if isinstance(data, dict) else (data or [])
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			inserted = _insert_restaurants(conn.cursor(), restaurants)
 			conn.commit()
+			return inserted
 		finally:
 			conn.close()
-	return inserted
 
 
 def import_restaurants_from_csv_rows(rows: List[Dict[str, str]]) -> int:
-	inserted = 0
+	# в CSV нет внешнего id — source_id остаётся пустым
+	items = [{k: v for k, v in row.items() if k != "id"} for row in rows]
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			inserted = _insert_restaurants(conn.cursor(), items)
+			conn.commit()
+			return inserted
+		finally:
+			conn.close()
+
+
+def get_meta(key: str) -> Optional[str]:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			for row in rows:
-				name = (row.get("name") or "").strip()
-				address = (row.get("address") or "").strip()
-				if not name:
-					continue
-				cur.execute(
-					"""
-					INSERT OR IGNORE INTO restaurants (name, address, cuisine, description, average_check)
-					VALUES (?, ?, ?, ?, ?)
-					""",
-					(
-						name,
-						address,
-						row.get("cuisine"),
-						row.get("description"),
-						row.get("average_check"),
-					),
-				)
-				if cur.rowcount > 0:
-					inserted += 1
+			cur.execute("SELECT value FROM meta WHERE key = ?", (key,))
+			row = cur.fetchone()
+			return row[0] if row else None
+		finally:
+			conn.close()
+
+
+def set_meta(key: str, value: str) -> None:
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			conn.execute(
+				"INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+				(key, value),
+			)
 			conn.commit()
 		finally:
 			conn.close()
-	return inserted
 
 
-def count_restaurants() -> int:
+def get_chat_timezone(chat_id: int) -> Optional[str]:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			cur.execute("SELECT COUNT(*) FROM restaurants")
-			return int(cur.fetchone()[0])
+			cur.execute("SELECT timezone FROM chat_settings WHERE chat_id = ?", (chat_id,))
+			row = cur.fetchone()
+			return row["timezone"] if row else None
+		finally:
+			conn.close()
+
+
+def set_chat_timezone(chat_id: int, tz_name: str) -> None:
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			conn.execute(
+				"""
+				INSERT INTO chat_settings (chat_id, timezone, updated_at_utc) VALUES (?, ?, ?)
+				ON CONFLICT(chat_id) DO UPDATE SET timezone = excluded.timezone, updated_at_utc = excluded.updated_at_utc
+				""",
+				(chat_id, tz_name, datetime.now(timezone.utc).isoformat()),
+			)
+			conn.commit()
+		finally:
+			conn.close()
+
+
+def import_seed_restaurants(items: List[Dict[str, Any]], fingerprint_key: str, fingerprint: str) -> int:
+	"""Загружает seed одной транзакцией и сохраняет его отпечаток в той же транзакции."""
+	with _DB_LOCK:
+		conn = _connect()
+		try:
+			cur = conn.cursor()
+			cur.execute("BEGIN IMMEDIATE")
+			changed = _insert_restaurants(cur, items, upsert=True)
+			cur.execute(
+				"INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+				(fingerprint_key, fingerprint),
+			)
+			conn.commit()
+			return changed
+		except Exception:
+			conn.rollback()
+			raise
 		finally:
 			conn.close()
 
 
+def _query_count_restaurants(cur: sqlite3.Cursor) -> int:
+	cur.execute("SELECT COUNT(*) FROM restaurants")
+	return int(cur.fetchone()[0])
+
+
+def count_restaurants() -> int:
+	return _read(_query_count_restaurants)
+
+
 def get_random_restaurant() -> Optional[sqlite3.Row]:
 	"""Возвращает ресторан, который ещё не считается посещённым (>=3 уникальных отзывов)."""
 	with _DB_LOCK:
@@ -226,6 +1162,7 @@ def get_random_restaurant() -> Optional[sqlite3.Row]:
 				    GROUP BY e.id
 				    HAVING COUNT(DISTINCT rv.user_id) >= 3
 				)
+				AND r.id NOT IN (SELECT restaurant_id FROM event_archive WHERE outcome = 'completed')
 				ORDER BY RANDOM()
 				LIMIT 1
 				"""
@@ -274,6 +1211,32 @@ def get_latest_event_for_chat(chat_id: int) -> Optional[sqlite3.Row]:
 			conn.close()
 
 
+# Последний записанный в users профиль: повторные нажатия того же пользователя не пишут в БД.
+# Доступ только под _DB_LOCK; запись в кэш — после commit, чтобы откат не оставил «фантом».
+_USER_CACHE: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+
+
+def _upsert_user(cur: sqlite3.Cursor, user_id: int, username: Optional[str], first_name: Optional[str]) -> None:
+	"""Создаёт/обновляет профиль пользователя, только если он изменился."""
+	if _USER_CACHE.get(user_id) == (username, first_name):
+		return
+	cur.execute(
+		"""
+		INSERT INTO users (user_id, username, first_name, updated_at_utc) VALUES (?, ?, ?, ?)
+		ON CONFLICT(user_id) DO UPDATE SET
+			username = excluded.username,
+			first_name = excluded.first_name,
+			updated_at_utc = excluded.updated_at_utc
+		WHERE users.username IS NOT excluded.username OR users.first_name IS NOT excluded.first_name
+		""",
+		(user_id, username, first_name, datetime.now(timezone.utc).isoformat()),
+	)
+
+
+def _remember_user(user_id: int, username: Optional[str], first_name: Optional[str]) -> None:
+	_USER_CACHE[user_id] = (username, first_name)
+
+
 def toggle_participation(event_id: int, user_id: int, username: Optional[str], first_name: Optional[str]) -> tuple[bool, Optional[str]]:
 	"""
 	Переключает участие пользователя.
@@ -284,6 +1247,8 @@ def toggle_participation(event_id: int, user_id: int, username: Optional[str], f
 		conn = _connect()
 		try:
 			cur = conn.cursor()
+			# _DB_LOCK не защищает от других процессов: подсчёт мест и запись — одна транзакция
+			cur.execute("BEGIN IMMEDIATE")
 			cur.execute(
 				"SELECT id, joined FROM participants WHERE event_id = ? AND user_id = ?",
 				(event_id, user_id),
@@ -299,14 +1264,16 @@ def toggle_participation(event_id: int, user_id: int, username: Optional[str], f
 				if current_count >= 3:
 					return False, "Уже набрано максимум 3 участника"
 				
+				_upsert_user(cur, user_id, username, first_name)
 				cur.execute(
 					"""
-					INSERT INTO participants (event_id, user_id, username, first_name, joined, joined_at_utc)
-					VALUES (?, ?, ?, ?, 1, ?)
+					INSERT INTO participants (event_id, user_id, joined, joined_at_utc)
+					VALUES (?, ?, 1, ?)
 					""",
-					(event_id, user_id, username, first_name, joined_at),
+					(event_id, user_id, joined_at),
 				)
 				conn.commit()
+				_remember_user(user_id, username, first_name)
 				return True, None
 			else:
 				new_joined = 0 if int(existing["joined"]) == 1 else 1
@@ -320,11 +1287,13 @@ def toggle_participation(event_id: int, user_id: int, username: Optional[str], f
 					if current_count >= 3:
 						return False, "Уже набрано максимум 3 участника"
 				
+				_upsert_user(cur, user_id, username, first_name)
 				cur.execute(
-					"UPDATE participants SET joined = ?, joined_at_utc = ?, username = ?, first_name = ? WHERE id = ?",
-					(new_joined, joined_at, username, first_name, int(existing["id"])),
+					"UPDATE participants SET joined = ?, joined_at_utc = ? WHERE id = ?",
+					(new_joined, joined_at, int(existing["id"])),
 				)
 				conn.commit()
+				_remember_user(user_id, username, first_name)
 				return bool(new_joined), None
 		finally:
 			conn.close()
@@ -336,7 +1305,13 @@ def list_participant_usernames(event_id: int) -> List[str]:
 		try:
 			cur = conn.cursor()
 			cur.execute(
-				"SELECT username, first_name FROM participants WHERE event_id = ? AND joined = 1 ORDER BY joined_at_utc ASC",
+				"""
+				SELECT u.username, u.first_name
+				FROM participants p
+				JOIN users u ON u.user_id = p.user_id
+				WHERE p.event_id = ? AND p.joined = 1
+				ORDER BY p.joined_at_utc ASC
+				""",
 				(event_id,),
 			)
 			result: List[str] = []
@@ -354,15 +1329,33 @@ def list_participant_usernames(event_id: int) -> List[str]:
 			conn.close()
 
 
+# Мелкие служебные записи: _-функции работают на готовом курсоре и не коммитят —
+# их же пакетами выполняет writer.GroupCommitWriter.
+
+
+def _set_reminder(cur: sqlite3.Cursor, event_id: int, dt_utc: datetime) -> None:
+	cur.execute(
+		"UPDATE events SET reminder_at_utc = ?, reminder_sent = 0 WHERE id = ?",
+		(dt_utc.isoformat(), event_id),
+	)
+
+
+def _mark_reminder_sent(cur: sqlite3.Cursor, event_id: int) -> None:
+	cur.execute("UPDATE events SET reminder_sent = 1 WHERE id = ?", (event_id,))
+
+
+def _mark_feedback_prompt_sent(cur: sqlite3.Cursor, event_id: int, feedback_message_id: int) -> None:
+	cur.execute(
+		"UPDATE events SET feedback_prompt_sent = 1, feedback_message_id = ? WHERE id = ?",
+		(feedback_message_id, event_id),
+	)
+
+
 def set_reminder(event_id: int, dt_utc: datetime) -> None:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
-			cur = conn.cursor()
-			cur.execute(
-				"UPDATE events SET reminder_at_utc = ?, reminder_sent = 0 WHERE id = ?",
-				(dt_utc.isoformat(), event_id),
-			)
+			_set_reminder(conn.cursor(), event_id, dt_utc)
 			conn.commit()
 		finally:
 			conn.close()
@@ -372,8 +1365,7 @@ def mark_reminder_sent(event_id: int) -> None:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
-			cur = conn.cursor()
-			cur.execute("UPDATE events SET reminder_sent = 1 WHERE id = ?", (event_id,))
+			_mark_reminder_sent(conn.cursor(), event_id)
 			conn.commit()
 		finally:
 			conn.close()
@@ -383,11 +1375,7 @@ def mark_feedback_prompt_sent(event_id: int, feedback_message_id: int) -> None:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
-			cur = conn.cursor()
-			cur.execute(
-				"UPDATE events SET feedback_prompt_sent = 1, feedback_message_id = ? WHERE id = ?",
-				(feedback_message_id, event_id),
-			)
+			_mark_feedback_prompt_sent(conn.cursor(), event_id, feedback_message_id)
 			conn.commit()
 		finally:
 			conn.close()
@@ -408,7 +1396,14 @@ def is_participant(event_id: int, user_id: int) -> bool:
 			conn.close()
 
 
-def save_review(event_id: int, user_id: int, username: Optional[str], text: str, rating: Optional[int] = None) -> tuple[bool, str]:
+def save_review(
+	event_id: int,
+	user_id: int,
+	username: Optional[str],
+	text: str,
+	rating: Optional[int] = None,
+	first_name: Optional[str] = None,
+) -> tuple[bool, str]:
 	"""
 	Сохраняет или обновляет отзыв.
 	Возвращает (success: bool, message: str)
@@ -418,18 +1413,35 @@ def save_review(event_id: int, user_id: int, username: Optional[str], text: str,
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			# Проверяем участие
-			if not is_participant(event_id, user_id):
+			# проверка участия, прежний отзыв и приращение рейтинга — одна транзакция и для других процессов
+			cur.execute("BEGIN IMMEDIATE")
+			# Проверяем участие (тем же соединением: _DB_LOCK не реентерабелен)
+			cur.execute(
+				"SELECT id FROM participants WHERE event_id = ? AND user_id = ? AND joined = 1",
+				(event_id, user_id),
+			)
+			if cur.fetchone() is None:
 				return False, "Вы не участвовали в этом походе"
 			
+			_upsert_user(cur, user_id, username, first_name)
+			cur.execute(
+				"""
+				SELECT e.restaurant_id, rv.id AS review_id, rv.rating
+				FROM events e LEFT JOIN reviews rv ON rv.event_id = e.id AND rv.user_id = ?
+				WHERE e.id = ?
+				""",
+				(user_id, event_id),
+			)
+			prev = cur.fetchone()
+			old_rating = prev["rating"] if prev is not None and prev["review_id"] is not None else None
 			# Пытаемся вставить, если есть - обновляем
 			try:
 				cur.execute(
 					"""
-					INSERT INTO reviews (event_id, user_id, username, text, rating, created_at_utc)
-					VALUES (?, ?, ?, ?, ?, ?)
+					INSERT INTO reviews (event_id, user_id, text, rating, created_at_utc)
+					VALUES (?, ?, ?, ?, ?)
 					""",
-					(event_id, user_id, username, text, rating, created_at),
+					(event_id, user_id, text, rating, created_at),
 				)
 				message = "Спасибо за отзыв!"
 			except sqlite3.IntegrityError:
@@ -437,10 +1449,10 @@ def save_review(event_id: int, user_id: int, username: Optional[str], text: str,
 				cur.execute(
 					"""
 					UPDATE reviews
-					SET text = ?, rating = ?, username = ?, created_at_utc = ?
+					SET text = ?, rating = ?, created_at_utc = ?
 					WHERE event_id = ? AND user_id = ?
 					""",
-					(text, rating, username, created_at, event_id, user_id),
+					(text, rating, created_at, event_id, user_id),
 				)
 				message = "Ваш отзыв обновлён!"
 			
@@ -449,13 +1461,56 @@ def save_review(event_id: int, user_id: int, username: Optional[str], text: str,
 				"UPDATE participants SET review_left = 1 WHERE event_id = ? AND user_id = ?",
 				(event_id, user_id),
 			)
+			if prev is not None:
+				_add_restaurant_rating(
+					cur,
+					int(prev["restaurant_id"]),
+					(rating or 0) - (old_rating or 0),
+					(rating is not None) - (old_rating is not None),
+				)
 			conn.commit()
+			_remember_user(user_id, username, first_name)
 			return True, message
 		finally:
 			conn.close()
 
 
-def get_event_with_details(event_id: int) -> Optional[sqlite3.Row]:
+def _query_event_with_details(cur: sqlite3.Cursor, event_id: int, include_archived: bool = False) -> Optional[sqlite3.Row]:
+	cur.execute(
+		"""
+		SELECT e.*, r.name AS r_name, r.address AS r_address, r.cuisine AS r_cuisine,
+		       r.description AS r_description, r.average_check AS r_avg_check
+		FROM events e JOIN restaurants r ON r.id = e.restaurant_id
+		WHERE e.id = ?
+		""",
+		(event_id,),
+	)
+	row = cur.fetchone()
+	if row is None and include_archived:
+		cur.execute(
+			"""
+			SELECT a.id, a.chat_id, a.restaurant_id, a.reminder_at_utc, a.created_at_utc,
+			       a.outcome = 'completed' AS completed,
+			       r.name AS r_name, r.address AS r_address, r.cuisine AS r_cuisine,
+			       r.description AS r_description, r.average_check AS r_avg_check
+			FROM event_archive a JOIN restaurants r ON r.id = a.restaurant_id
+			WHERE a.id = ?
+			""",
+			(event_id,),
+		)
+		row = cur.fetchone()
+	return row
+
+
+def get_event_with_details(event_id: int, *, include_archived: bool = False) -> Optional[sqlite3.Row]:
+	"""
+	Событие с данными ресторана. С include_archived=True ищет и в архиве
+	(для просмотра истории); задачи-напоминания архив не видят.
+	"""
+	return _read(_query_event_with_details, event_id, include_archived)
+
+
+def get_event_by_feedback_message(chat_id: int, feedback_message_id: int) -> Optional[sqlite3.Row]:
 	with _DB_LOCK:
 		conn = _connect()
 		try:
@@ -465,31 +1520,59 @@ def get_event_with_details(event_id: int) -> Optional[sqlite3.Row]:
 				SELECT e.*, r.name AS r_name, r.address AS r_address, r.cuisine AS r_cuisine,
 				       r.description AS r_description, r.average_check AS r_avg_check
 				FROM events e JOIN restaurants r ON r.id = e.restaurant_id
-				WHERE e.id = ?
+				WHERE e.chat_id = ? AND e.feedback_message_id = ?
+				LIMIT 1
 				""",
-				(event_id,),
+				(chat_id, feedback_message_id),
 			)
 			return cur.fetchone()
 		finally:
 			conn.close()
 
 
-def get_event_by_feedback_message(chat_id: int, feedback_message_id: int) -> Optional[sqlite3.Row]:
+def load_event_snapshot(
+	*, event_id: Optional[int] = None, chat_id: Optional[int] = None
+) -> Optional[Tuple[sqlite3.Row, List[sqlite3.Row], List[int]]]:
+	"""
+	Живое событие (по id или последнее в чате) одним заходом в БД:
+	(событие с данными ресторана, участники с профилями, id оставивших отзыв).
+	"""
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
+			if event_id is None:
+				cur.execute("SELECT id FROM events WHERE chat_id = ? ORDER BY id DESC LIMIT 1", (chat_id,))
+				row = cur.fetchone()
+				if row is None:
+					return None
+				event_id = int(row["id"])
 			cur.execute(
 				"""
 				SELECT e.*, r.name AS r_name, r.address AS r_address, r.cuisine AS r_cuisine,
 				       r.description AS r_description, r.average_check AS r_avg_check
 				FROM events e JOIN restaurants r ON r.id = e.restaurant_id
-				WHERE e.chat_id = ? AND e.feedback_message_id = ?
-				LIMIT 1
+				WHERE e.id = ?
 				""",
-				(chat_id, feedback_message_id),
+				(event_id,),
 			)
-			return cur.fetchone()
+			event = cur.fetchone()
+			if event is None:
+				return None
+			cur.execute(
+				"""
+				SELECT p.user_id, u.username, u.first_name, p.joined, p.joined_at_utc, p.review_left
+				FROM participants p
+				JOIN users u ON u.user_id = p.user_id
+				WHERE p.event_id = ?
+				ORDER BY p.joined_at_utc ASC
+				""",
+				(event_id,),
+			)
+			participants = cur.fetchall()
+			cur.execute("SELECT DISTINCT user_id FROM reviews WHERE event_id = ?", (event_id,))
+			reviewers = [int(r["user_id"]) for r in cur.fetchall()]
+			return event, participants, reviewers
 		finally:
 			conn.close()
 
@@ -551,153 +1634,281 @@ def get_all_feedback_to_schedule() -> List[sqlite3.Row]:
 			conn.close()
 
 
-def get_stats() -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+def get_open_feedback_prompts() -> List[sqlite3.Row]:
+	"""Отправленные просьбы об отзыве по незавершённым событиям: (id, chat_id, feedback_message_id)."""
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			# Visited: events with at least one review
 			cur.execute(
 				"""
-				SELECT e.id, r.name, r.address, COUNT(rv.id) AS reviews_count,
-					AVG(CASE WHEN rv.rating IS NOT NULL THEN rv.rating END) AS avg_rating
-				FROM events e
-				JOIN restaurants r ON r.id = e.restaurant_id
-				LEFT JOIN reviews rv ON rv.event_id = e.id
-				GROUP BY e.id
-				HAVING COUNT(rv.id) > 0
-				ORDER BY e.id DESC
+				SELECT id, chat_id, feedback_message_id FROM events
+				WHERE feedback_message_id IS NOT NULL AND completed = 0
 				"""
 			)
-			visited = cur.fetchall()
-			# Upcoming: events scheduled but no reviews yet
-			cur.execute(
-				"""
-				SELECT e.id, r.name, r.address, e.reminder_at_utc
-				FROM events e JOIN restaurants r ON r.id = e.restaurant_id
-				LEFT JOIN reviews rv ON rv.event_id = e.id
-				GROUP BY e.id
-				HAVING COUNT(rv.id) = 0
-				ORDER BY e.id DESC
-				"""
-			)
-			upcoming = cur.fetchall()
-			return visited, upcoming
+			return cur.fetchall()
 		finally:
 			conn.close()
 
 
-def get_stats_for_chat(chat_id: int) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
-    with _DB_LOCK:
-        conn = _connect()
-        try:
-            cur = conn.cursor()
-            # Visited for a chat: события, завершённые (completed=1) или с >=3 уникальных отзывов
-            cur.execute(
-                """
-                SELECT e.id, r.name, r.address, COUNT(rv.id) AS reviews_count,
-                    AVG(CASE WHEN rv.rating IS NOT NULL THEN rv.rating END) AS avg_rating
-                FROM events e
-                JOIN restaurants r ON r.id = e.restaurant_id
-                LEFT JOIN reviews rv ON rv.event_id = e.id
-                WHERE e.chat_id = ?
-                GROUP BY e.id
-                HAVING COUNT(DISTINCT rv.user_id) >= 3 OR MAX(e.completed) = 1
-                ORDER BY e.id DESC
-                """,
-                (chat_id,),
-            )
-            visited = cur.fetchall()
+def _query_stats(cur: sqlite3.Cursor) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+	# Visited: events with at least one review (архив — по готовым агрегатам)
+	cur.execute(
+		"""
+		SELECT id, name, address, reviews_count, avg_rating FROM (
+			SELECT a.id, r.name, r.address, a.reviews_count,
+				a.rating_sum * 1.0 / NULLIF(a.rating_count, 0) AS avg_rating
+			FROM event_archive a
+			JOIN restaurants r ON r.id = a.restaurant_id
+			WHERE a.reviews_count > 0
+			UNION ALL
+			SELECT e.id, r.name, r.address, COUNT(rv.id) AS reviews_count,
+				AVG(CASE WHEN rv.rating IS NOT NULL THEN rv.rating END) AS avg_rating
+			FROM events e
+			JOIN restaurants r ON r.id = e.restaurant_id
+			JOIN reviews rv ON rv.event_id = e.id
+			GROUP BY e.id
+		)
+		ORDER BY id DESC
+		"""
+	)
+	visited = cur.fetchall()
+	# Upcoming: events scheduled but no reviews yet
+	cur.execute(
+		"""
+		SELECT e.id, r.name, r.address, e.reminder_at_utc
+		FROM events e JOIN restaurants r ON r.id = e.restaurant_id
+		LEFT JOIN reviews rv ON rv.event_id = e.id
+		GROUP BY e.id
+		HAVING COUNT(rv.id) = 0
+		ORDER BY e.id DESC
+		"""
+	)
+	upcoming = cur.fetchall()
+	return visited, upcoming
 
-            # Upcoming for a chat: >=3 joined and <3 distinct reviews
-            cur.execute(
-                """
-                SELECT e.id, r.name, r.address, e.reminder_at_utc
-                FROM events e
-                JOIN restaurants r ON r.id = e.restaurant_id
-                LEFT JOIN participants p ON p.event_id = e.id AND p.joined = 1
-                LEFT JOIN reviews rv ON rv.event_id = e.id
-                WHERE e.chat_id = ?
-                GROUP BY e.id
-                HAVING COUNT(DISTINCT p.user_id) >= 3 AND COUNT(DISTINCT rv.user_id) < 3 AND MAX(e.completed) = 0
-                ORDER BY e.id DESC
-                """,
-                (chat_id,),
-            )
-            upcoming = cur.fetchall()
-            return visited, upcoming
-        finally:
-            conn.close()
+
+def get_stats() -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+	return _read(_query_stats)
+
+
+def _query_stats_for_chat(cur: sqlite3.Cursor, chat_id: int) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+    # Visited for a chat: завершённые события из архива (готовые агрегаты)
+    # плюс ещё не заархивированные живые (completed=1 или >=3 уникальных отзывов)
+    cur.execute(
+        """
+        SELECT id, name, address, reviews_count, avg_rating FROM (
+            SELECT a.id, r.name, r.address, a.reviews_count,
+                a.rating_sum * 1.0 / NULLIF(a.rating_count, 0) AS avg_rating
+            FROM event_archive a
+            JOIN restaurants r ON r.id = a.restaurant_id
+            WHERE a.chat_id = ? AND a.outcome = 'completed'
+            UNION ALL
+            SELECT e.id, r.name, r.address, COUNT(rv.id) AS reviews_count,
+                AVG(CASE WHEN rv.rating IS NOT NULL THEN rv.rating END) AS avg_rating
+            FROM events e
+            JOIN restaurants r ON r.id = e.restaurant_id
+            LEFT JOIN reviews rv ON rv.event_id = e.id
+            WHERE e.chat_id = ?
+            GROUP BY e.id
+            HAVING COUNT(DISTINCT rv.user_id) >= 3 OR MAX(e.completed) = 1
+        )
+        ORDER BY id DESC
+        """,
+        (chat_id, chat_id),
+    )
+    visited = cur.fetchall()
+
+    # Upcoming for a chat: >=3 joined and <3 distinct reviews
+    cur.execute(
+        """
+        SELECT e.id, r.name, r.address, e.reminder_at_utc
+        FROM events e
+        JOIN restaurants r ON r.id = e.restaurant_id
+        LEFT JOIN participants p ON p.event_id = e.id AND p.joined = 1
+        LEFT JOIN reviews rv ON rv.event_id = e.id
+        WHERE e.chat_id = ?
+        GROUP BY e.id
+        HAVING COUNT(DISTINCT p.user_id) >= 3 AND COUNT(DISTINCT rv.user_id) < 3 AND MAX(e.completed) = 0
+        ORDER BY e.id DESC
+        """,
+        (chat_id,),
+    )
+    upcoming = cur.fetchall()
+    return visited, upcoming
 
 
-def get_reviews_for_event(event_id: int) -> List[sqlite3.Row]:
+def get_stats_for_chat(chat_id: int) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+    return _read(_query_stats_for_chat, chat_id)
+
+
+def _query_review_summary(cur: sqlite3.Cursor, event_id: int) -> Tuple[int, Optional[float]]:
+	cur.execute(
+		"""
+		SELECT COUNT(*), AVG(rating) FROM (
+			SELECT rating FROM reviews WHERE event_id = ?
+			UNION ALL
+			SELECT rating FROM review_archive WHERE event_id = ?
+		)
+		""",
+		(event_id, event_id),
+	)
+	count, avg = cur.fetchone()
+	return int(count), (float(avg) if avg is not None else None)
+
+
+def get_review_summary(event_id: int) -> Tuple[int, Optional[float]]:
+	"""Число отзывов события и средняя оценка (None, если оценок нет); архив учитывается."""
+	return _read(_query_review_summary, event_id)
+
+
+# Страница отзывов по ключу (created_at_utc, id). Отзывы события лежат либо в reviews,
+# либо в review_archive; каждая ветка — диапазон по idx_*_event_created с LIMIT.
+# Якорь — id отзыва на краю соседней страницы; {op}/{order} задают направление.
+_REVIEWS_PAGE_SQL = """
+	SELECT * FROM (
+		SELECT rv.id, u.username, rv.text, rv.rating, rv.created_at_utc
+		FROM reviews rv JOIN users u ON u.user_id = rv.user_id
+		WHERE rv.event_id = ?1 {reviews_anchor}
+		ORDER BY rv.created_at_utc {order}, rv.id {order}
+		LIMIT ?3
+	)
+	UNION ALL
+	SELECT * FROM (
+		SELECT ra.id, u.username, ra.text, ra.rating, ra.created_at_utc
+		FROM review_archive ra JOIN users u ON u.user_id = ra.user_id
+		WHERE ra.event_id = ?1 {archive_anchor}
+		ORDER BY ra.created_at_utc {order}, ra.id {order}
+		LIMIT ?3
+	)
+	ORDER BY created_at_utc {order}, id {order}
+	LIMIT ?3
+"""
+
+
+def _reviews_page_sql(*, backward: bool, anchored: bool) -> str:
+	op, order = ("<", "DESC") if backward else (">", "ASC")
+	anchor = "AND ({alias}.created_at_utc, {alias}.id) {op} (SELECT created_at_utc, id FROM {table} WHERE id = ?2)"
+	return _REVIEWS_PAGE_SQL.format(
+		order=order,
+		reviews_anchor=anchor.format(alias="rv", op=op, table="reviews") if anchored else "",
+		archive_anchor=anchor.format(alias="ra", op=op, table="review_archive") if anchored else "",
+	)
+
+
+def get_reviews_page(
+	event_id: int,
+	*,
+	after_id: Optional[int] = None,
+	before_id: Optional[int] = None,
+	limit: int = 5,
+) -> Tuple[List[sqlite3.Row], bool, bool]:
+	"""
+	Одна страница отзывов события в хронологическом порядке.
+	after_id — следующая страница после отзыва, before_id — предыдущая перед ним;
+	без якоря — первая страница. Возвращает (строки, есть_предыдущая, есть_следующая).
+	Стоимость не зависит от общего числа отзывов: читается не больше limit + 1 строк.
+	"""
+	backward = before_id is not None
+	anchor_id = before_id if backward else after_id
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
+			# лишняя строка показывает, есть ли что-то дальше в этом направлении
 			cur.execute(
-				"""
-				SELECT username, text, rating, created_at_utc
-				FROM reviews
-				WHERE event_id = ?
-				ORDER BY created_at_utc ASC
-				""",
-				(event_id,),
+				_reviews_page_sql(backward=backward, anchored=anchor_id is not None),
+				(event_id, anchor_id, limit + 1),
 			)
-			return cur.fetchall()
+			rows = cur.fetchall()
+			if not rows and anchor_id is not None:
+				# якорный отзыв удалён (например, /clear_reviews) — начинаем сначала
+				cur.execute(_reviews_page_sql(backward=False, anchored=False), (event_id, None, limit + 1))
+				rows = cur.fetchall()
+				backward, anchor_id = False, None
 		finally:
 			conn.close()
+	more = len(rows) > limit
+	rows = rows[:limit]
+	if backward:
+		rows.reverse()
+		return rows, more, True
+	return rows, anchor_id is not None, more
 
 
-def cancel_participation(event_id: int, user_id: int) -> None:
-	"""Отменяет участие с установкой штрафа 500₽."""
+def cancel_participation(event_id: int, user_id: int) -> bool:
+	"""
+	Отменяет участие и начисляет штраф PENALTY_AMOUNT₽ в журнал.
+	Возвращает True, если участие действительно было отменено (повторная отмена штраф не начисляет).
+	"""
+	now = datetime.now(timezone.utc).isoformat()
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
 			cur.execute(
-				"UPDATE participants SET joined = 0, cancelled = 1, penalty_amount = 500 WHERE event_id = ? AND user_id = ?",
-				(event_id, user_id),
+				"""
+				UPDATE participants SET joined = 0, cancelled = 1, penalty_amount = ?
+				WHERE event_id = ? AND user_id = ? AND joined = 1
+				""",
+				(PENALTY_AMOUNT, event_id, user_id),
 			)
+			cancelled = cur.rowcount > 0
+			if cancelled:
+				cur.execute(
+					"""
+					INSERT INTO penalty_ledger (user_id, event_id, kind, amount, created_at_utc)
+					VALUES (?, ?, 'charge', ?, ?)
+					""",
+					(user_id, event_id, PENALTY_AMOUNT, now),
+				)
 			conn.commit()
+			return cancelled
 		finally:
 			conn.close()
 
 
 def get_user_penalty(user_id: int) -> int:
-	"""Возвращает текущий штраф пользователя."""
+	"""Возвращает текущий штраф пользователя (остаток по журналу)."""
 	with _DB_LOCK:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			# берём последний штраф (если есть cancelled=1 и penalty_amount > 0)
-			cur.execute(
-				"""
-				SELECT penalty_amount
-				FROM participants
-				WHERE user_id = ? AND cancelled = 1 AND penalty_amount > 0
-				ORDER BY id DESC
-				LIMIT 1
-				""",
-				(user_id,),
-			)
+			cur.execute("SELECT balance FROM penalty_balances WHERE user_id = ?", (user_id,))
 			row = cur.fetchone()
-			return int(row["penalty_amount"]) if row else 0
+			return int(row["balance"]) if row else 0
 		finally:
 			conn.close()
 
 
-def clear_user_penalty(user_id: int) -> None:
-	"""Сбрасывает штраф после успешного похода."""
+def _clear_user_penalty(cur: sqlite3.Cursor, user_id: int) -> bool:
+	# обычно штрафа нет — обходимся чтением по первичному ключу, без блокировки на запись
+	cur.execute("SELECT balance FROM penalty_balances WHERE user_id = ?", (user_id,))
+	row = cur.fetchone()
+	if not row or int(row["balance"]) <= 0:
+		return False
+	cur.execute(
+		"""
+		INSERT INTO penalty_ledger (user_id, event_id, kind, amount, created_at_utc)
+		VALUES (?, NULL, 'clear', ?, ?)
+		""",
+		(user_id, -int(row["balance"]), datetime.now(timezone.utc).isoformat()),
+	)
+	return True
+
+
+def clear_user_penalty(user_id: int) -> bool:
+	"""
+	Сбрасывает штраф после успешного похода: одна строка clear на весь остаток.
+	Без штрафа ничего не пишет. Возвращает True, если штраф был списан.
+	"""
 	with _DB_LOCK:
 		conn = _connect()
 		try:
-			cur = conn.cursor()
-			cur.execute(
-				"UPDATE participants SET penalty_amount = 0 WHERE user_id = ? AND cancelled = 1",
-				(user_id,),
-			)
-			conn.commit()
+			cleared = _clear_user_penalty(conn.cursor(), user_id)
+			if cleared:
+				conn.commit()
+			return cleared
 		finally:
 			conn.close()
 
@@ -710,9 +1921,10 @@ def get_participants_without_review(event_id: int) -> List[sqlite3.Row]:
 			cur = conn.cursor()
 			cur.execute(
 				"""
-				SELECT user_id, username, first_name
-				FROM participants
-				WHERE event_id = ? AND joined = 1 AND review_left = 0
+				SELECT p.user_id, u.username, u.first_name
+				FROM participants p
+				JOIN users u ON u.user_id = p.user_id
+				WHERE p.event_id = ? AND p.joined = 1 AND p.review_left = 0
 				""",
 				(event_id,),
 			)
@@ -743,8 +1955,8 @@ def delete_event_with_relations(event_id: int) -> None:
 		conn = _connect()
 		try:
 			cur = conn.cursor()
-			cur.execute("DELETE FROM participants WHERE event_id = ?", (event_id,))
-			cur.execute("DELETE FROM reviews WHERE event_id = ?", (event_id,))
+			_subtract_event_ratings(cur, "e.id = ?", (event_id,))
+			# participants и reviews удаляются каскадом (ON DELETE CASCADE)
 			cur.execute("DELETE FROM events WHERE id = ?", (event_id,))
 			conn.commit()
 		finally:
@@ -770,29 +1982,27 @@ def get_joined_participants_count(event_id: int) -> int:
             conn.close()
 
 
+def _query_upcoming_events(cur: sqlite3.Cursor, chat_id: int) -> List[sqlite3.Row]:
+    cur.execute(
+        """
+        SELECT e.id, e.chat_id, e.reminder_at_utc, r.name AS r_name
+        FROM events e
+        JOIN restaurants r ON r.id = e.restaurant_id
+        LEFT JOIN participants p ON p.event_id = e.id AND p.joined = 1
+        LEFT JOIN reviews rv ON rv.event_id = e.id
+        WHERE e.chat_id = ?
+        GROUP BY e.id
+        HAVING COUNT(DISTINCT p.user_id) >= 3 AND COUNT(DISTINCT rv.user_id) < 3 AND MAX(e.completed) = 0
+        ORDER BY e.id DESC
+        """,
+        (chat_id,),
+    )
+    return cur.fetchall()
+
+
 def get_upcoming_events(chat_id: int) -> List[sqlite3.Row]:
     """События текущего чата с >=3 участниками и без отзывов (предстоящие)."""
-    with _DB_LOCK:
-        conn = _connect()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                """
-                SELECT e.id, e.chat_id, e.reminder_at_utc, r.name AS r_name
-                FROM events e
-                JOIN restaurants r ON r.id = e.restaurant_id
-                LEFT JOIN participants p ON p.event_id = e.id AND p.joined = 1
-                LEFT JOIN reviews rv ON rv.event_id = e.id
-                WHERE e.chat_id = ?
-                GROUP BY e.id
-                HAVING COUNT(DISTINCT p.user_id) >= 3 AND COUNT(DISTINCT rv.user_id) < 3 AND MAX(e.completed) = 0
-                ORDER BY e.id DESC
-                """,
-                (chat_id,),
-            )
-            return cur.fetchall()
-        finally:
-            conn.close()
+    return _read(_query_upcoming_events, chat_id)
 
 
 # ---------------------------------------------------------------------------
@@ -845,23 +2055,27 @@ def ensure_demo_visit() -> None:
 			]
 
 			for user_id, username, first_name, rating, review_text in participants:
+				_upsert_user(cur, user_id, username, first_name)
 				cur.execute(
 					"""
-					INSERT INTO participants (event_id, user_id, username, first_name,
+					INSERT INTO participants (event_id, user_id,
 											  joined, joined_at_utc, review_left, cancelled, penalty_amount)
-					VALUES (?, ?, ?, ?, 1, ?, 1, 0, 0)
+					VALUES (?, ?, 1, ?, 1, 0, 0)
 					""",
-					(event_id, user_id, username, first_name, now),
+					(event_id, user_id, now),
 				)
 				cur.execute(
 					"""
-					INSERT INTO reviews (event_id, user_id, username, text, rating, created_at_utc)
-					VALUES (?, ?, ?, ?, ?, ?)
+					INSERT INTO reviews (event_id, user_id, text, rating, created_at_utc)
+					VALUES (?, ?, ?, ?, ?)
 					""",
-					(event_id, user_id, username, review_text, rating, now),
+					(event_id, user_id, review_text, rating, now),
 				)
+			_add_restaurant_rating(cur, restaurant_id, sum(p[3] for p in participants), len(participants))
 
 			conn.commit()
+			for user_id, username, first_name, _, _ in participants:
+				_remember_user(user_id, username, first_name)
 		finally:
 			conn.close()
 
@@ -872,13 +2086,9 @@ def cleanup_demo_data() -> None:
         conn = _connect()
         try:
             cur = conn.cursor()
-            # Сначала находим события с chat_id=0 (наши демо)
-            cur.execute("SELECT id FROM events WHERE chat_id = 0")
-            ids = [int(r[0]) for r in cur.fetchall()]
-            for eid in ids:
-                cur.execute("DELETE FROM participants WHERE event_id = ?", (eid,))
-                cur.execute("DELETE FROM reviews WHERE event_id = ?", (eid,))
-                cur.execute("DELETE FROM events WHERE id = ?", (eid,))
+            _subtract_event_ratings(cur, "e.chat_id = 0", ())
+            # события с chat_id=0 (наши демо); участники и отзывы уходят каскадом
+            cur.execute("DELETE FROM events WHERE chat_id = 0")
             conn.commit()
         finally:
             conn.close()
@@ -932,64 +2142,585 @@ def count_distinct_reviews(event_id: int) -> int:
 
 
 def clear_reviews_by_restaurant_name(restaurant_name: str) -> int:
-    """Удаляет отзывы по ресторану (для админа). Возвращает количество удалённых отзывов."""
+    """
+    Удаляет отзывы по ресторану (для админа), включая архив — ресторан снова
+    считается непосещённым. Название ищется через полнотекстовый индекс.
+    Возвращает количество удалённых отзывов.
+    """
     with _DB_LOCK:
         conn = _connect()
         try:
             cur = conn.cursor()
-            # Найти события этого ресторана
+            ids = _resolve_restaurant_ids(cur, restaurant_name)
+            if not ids:
+                return 0
+            ids_json = json.dumps(ids)
+            # События этого ресторана выбираются подзапросом по idx_events_restaurant
+            events_of_restaurant = "SELECT id FROM events WHERE restaurant_id IN (SELECT value FROM json_each(?))"
+            archived_of_restaurant = "SELECT id FROM event_archive WHERE restaurant_id IN (SELECT value FROM json_each(?))"
+            cur.execute(f"DELETE FROM reviews WHERE event_id IN ({events_of_restaurant})", (ids_json,))
+            deleted_reviews = max(cur.rowcount, 0)
+            cur.execute(f"DELETE FROM review_archive WHERE event_id IN ({archived_of_restaurant})", (ids_json,))
+            deleted_reviews += max(cur.rowcount, 0)
+            # у этих ресторанов не осталось ни одного отзыва
             cur.execute(
-                """
-                SELECT e.id FROM events e
-                JOIN restaurants r ON r.id = e.restaurant_id
-                WHERE lower(r.name) = lower(?)
+                "DELETE FROM restaurant_ratings WHERE restaurant_id IN (SELECT value FROM json_each(?))",
+                (ids_json,),
+            )
+            # Сбросить флаги участников и снять completed
+            cur.execute(
+                f"UPDATE participants SET review_left = 0 WHERE review_left = 1 AND event_id IN ({events_of_restaurant})",
+                (ids_json,),
+            )
+            cur.execute(
+                f"UPDATE events SET completed = 0 WHERE completed = 1 AND id IN ({events_of_restaurant})",
+                (ids_json,),
+            )
+            cur.execute(
+                f"""
+                UPDATE event_archive
+                SET outcome = 'abandoned', reviews_count = 0, rating_sum = 0, rating_count = 0
+                WHERE id IN ({archived_of_restaurant})
                 """,
-                (restaurant_name,)
+                (ids_json,),
             )
-            event_ids = [row[0] for row in cur.fetchall()]
-            
-            if not event_ids:
-                return 0
-            
-            deleted_reviews = 0
-            for eid in event_ids:
-                # Удалить отзывы
-                cur.execute("DELETE FROM reviews WHERE event_id = ?", (eid,))
-                deleted_reviews += cur.rowcount
-                # Сбросить флаги участников
-                cur.execute("UPDATE participants SET review_left = 0 WHERE event_id = ?", (eid,))
-                # Снять completed
-                cur.execute("UPDATE events SET completed = 0 WHERE id = ?", (eid,))
-            
             conn.commit()
             return deleted_reviews
         finally:
             conn.close()
 
 
-def get_random_restaurant_for_chat(chat_id: int) -> Optional[sqlite3.Row]:
-    """Ресторан, ещё не посещённый ЭТИМ чатом (завершённые события или >=3 отзывов исключаются)."""
+# Рестораны, посещённые чатом: завершённые живые события (completed=1 или >=3 отзывов)
+# и завершённые события из архива. Параметры: chat_id, chat_id.
+_VISITED_BY_CHAT_SQL = """
+    SELECT e.restaurant_id
+    FROM events e
+    LEFT JOIN reviews rv ON rv.event_id = e.id
+    WHERE e.chat_id = ?
+    GROUP BY e.id
+    HAVING COUNT(DISTINCT rv.user_id) >= 3 OR MAX(e.completed) = 1
+    UNION
+    SELECT restaurant_id FROM event_archive WHERE chat_id = ? AND outcome = 'completed'
+"""
+
+
+def get_random_restaurant_for_chat(
+    chat_id: int,
+    cuisine_ids: Optional[List[int]] = None,
+    max_price: Optional[int] = None,
+) -> Optional[sqlite3.Row]:
+    """
+    Ресторан, ещё не посещённый ЭТИМ чатом (завершённые события или >=3 отзывов исключаются).
+    Фильтры по кухне и потолку среднего чека идут через idx_restaurants_cuisine_price / idx_restaurants_price.
+    """
+    filters: List[str] = []
+    params: List[Any] = [chat_id, chat_id]
+    if cuisine_ids:
+        filters.append("r.cuisine_id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps([int(c) for c in cuisine_ids]))
+    if max_price is not None:
+        filters.append("r.avg_check_max <= ?")
+        params.append(int(max_price))
+    extra = "".join(f"\n                AND {f}" for f in filters)
     with _DB_LOCK:
         conn = _connect()
         try:
             cur = conn.cursor()
             cur.execute(
-                """
+                f"""
                 SELECT r.id, r.name, r.address, r.cuisine, r.description, r.average_check
                 FROM restaurants r
-                WHERE r.id NOT IN (
-                    SELECT e.restaurant_id
-                    FROM events e
-                    LEFT JOIN reviews rv ON rv.event_id = e.id
-                    WHERE e.chat_id = ?
-                    GROUP BY e.id
-                    HAVING COUNT(DISTINCT rv.user_id) >= 3 OR MAX(e.completed) = 1
-                )
+                WHERE r.id NOT IN ({_VISITED_BY_CHAT_SQL}){extra}
                 ORDER BY RANDOM()
                 LIMIT 1
                 """,
-                (chat_id,),
+                params,
+            )
+            return cur.fetchone()
+        finally:
+            conn.close()
+
+
+def find_cuisine_ids(text: str) -> List[int]:
+    """
+    Кухни по названию или его началу ("итальян" -> "Итальянская") — диапазонный
+    поиск по уникальному индексу cuisines.key. Падежное окончание ("итальянскую")
+    отбрасывается, если точного совпадения нет.
+    """
+    key = cuisine_key(text)
+    if not key:
+        return []
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            candidates = [key]
+            if len(key) > 5:
+                candidates.append(key[:-2])
+            for prefix in candidates:
+                cur.execute(
+                    "SELECT id FROM cuisines WHERE key >= ? AND key < ?",
+                    (prefix, prefix + "\U0010ffff"),
+                )
+                ids = [int(r[0]) for r in cur.fetchall()]
+                if ids:
+                    return ids
+            return []
+        finally:
+            conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Event archive
+# ---------------------------------------------------------------------------
+
+
+def _archive_events(cur: sqlite3.Cursor, event_ids: List[int], archived_at: str) -> int:
+    """
+    Переносит события в архив набором из трёх запросов со сводкой оценок;
+    участники и отзывы живых таблиц удаляются каскадом.
+    """
+    if not event_ids:
+        return 0
+    ids_json = json.dumps([int(eid) for eid in event_ids])
+    cur.execute(
+        """
+        INSERT INTO event_archive (id, chat_id, restaurant_id, outcome, reminder_at_utc, created_at_utc,
+                                   archived_at_utc, participants_count, reviews_count, rating_sum, rating_count)
+        SELECT e.id, e.chat_id, e.restaurant_id,
+               CASE WHEN e.completed = 1 OR COALESCE(rv.distinct_users, 0) >= 3
+                    THEN 'completed' ELSE 'abandoned' END,
+               e.reminder_at_utc, e.created_at_utc, ?,
+               (SELECT COUNT(*) FROM participants p WHERE p.event_id = e.id AND p.joined = 1),
+               COALESCE(rv.reviews_count, 0), COALESCE(rv.rating_sum, 0), COALESCE(rv.rating_count, 0)
+        FROM events e
+        LEFT JOIN (
+            SELECT event_id, COUNT(DISTINCT user_id) AS distinct_users, COUNT(*) AS reviews_count,
+                   SUM(rating) AS rating_sum, COUNT(rating) AS rating_count
+            FROM reviews
+            WHERE event_id IN (SELECT value FROM json_each(?))
+            GROUP BY event_id
+        ) rv ON rv.event_id = e.id
+        WHERE e.id IN (SELECT value FROM json_each(?))
+        """,
+        (archived_at, ids_json, ids_json),
+    )
+    archived = max(cur.rowcount, 0)
+    cur.execute(
+        """
+        INSERT INTO review_archive (id, event_id, user_id, text, rating, created_at_utc)
+        SELECT id, event_id, user_id, text, rating, created_at_utc
+        FROM reviews WHERE event_id IN (SELECT value FROM json_each(?))
+        """,
+        (ids_json,),
+    )
+    cur.execute("DELETE FROM events WHERE id IN (SELECT value FROM json_each(?))", (ids_json,))
+    return archived
+
+
+def archive_event(event_id: int) -> bool:
+    """Архивирует событие (completed/abandoned определяется по отзывам). True, если событие было."""
+    archived_at = datetime.now(timezone.utc).isoformat()
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            archived = _archive_events(conn.cursor(), [event_id], archived_at)
+            conn.commit()
+            return archived > 0
+        finally:
+            conn.close()
+
+
+def archive_stale_events(older_than_utc: datetime) -> List[Tuple[int, int]]:
+    """
+    Архивирует события, не менявшиеся с older_than_utc: дата встречи (или создание,
+    если дата не назначена) раньше порога. Возвращает (id события, chat_id) заархивированных.
+    """
+    archived_at = datetime.now(timezone.utc).isoformat()
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT id, chat_id FROM events
+                WHERE datetime(COALESCE(reminder_at_utc, created_at_utc)) < datetime(?)
+                """,
+                (older_than_utc.isoformat(),),
+            )
+            archived = [(int(r[0]), int(r[1])) for r in cur.fetchall()]
+            _archive_events(cur, [event_id for event_id, _ in archived], archived_at)
+            conn.commit()
+            return archived
+        finally:
+            conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Full-text search
+# ---------------------------------------------------------------------------
+
+# Маркеры подсветки в snippet(): управляющие символы не встречаются в тексте
+# и переживают html.escape, поэтому их безопасно заменять на теги при выводе.
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _fts_query(text: str, *, prefix: bool = True) -> Optional[str]:
+    """Превращает пользовательский ввод в безопасный запрос FTS5 (все слова, опционально по префиксу)."""
+    tokens = _TOKEN_RE.findall(text or "")
+    if not tokens:
+        return None
+    suffix = "*" if prefix else ""
+    return " ".join(f'"{tok}"{suffix}' for tok in tokens)
+
+
+def _resolve_restaurant_ids(cur: sqlite3.Cursor, name: str) -> List[int]:
+    """id ресторанов с точно таким названием (без учёта регистра), найденные через restaurants_fts."""
+    query = _fts_query(name, prefix=False)
+    if not query:
+        return []
+    cur.execute(
+        """
+        SELECT r.id, r.name FROM restaurants_fts
+        JOIN restaurants r ON r.id = restaurants_fts.rowid
+        WHERE restaurants_fts MATCH ?
+        """,
+        (f"name : ({query})",),
+    )
+    wanted = " ".join(name.split()).casefold()
+    return [int(r["id"]) for r in cur.fetchall() if " ".join(r["name"].split()).casefold() == wanted]
+
+
+def find_restaurant_ids_by_name(name: str) -> List[int]:
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            return _resolve_restaurant_ids(conn.cursor(), name)
+        finally:
+            conn.close()
+
+
+def search_restaurants(text: str, limit: int = 5) -> List[sqlite3.Row]:
+    """Рестораны по релевантности (bm25, название весомее описания) со сниппетом совпадения."""
+    query = _fts_query(text)
+    if not query:
+        return []
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT r.id, r.name, r.address, r.cuisine,
+                       snippet(restaurants_fts, -1, ?, ?, '…', 12) AS snippet,
+                       bm25(restaurants_fts, 10.0, 4.0, 1.0, 2.0) AS score
+                FROM restaurants_fts
+                JOIN restaurants r ON r.id = restaurants_fts.rowid
+                WHERE restaurants_fts MATCH ?
+                ORDER BY score
+                LIMIT ?
+                """,
+                (SNIPPET_OPEN, SNIPPET_CLOSE, query, limit),
+            )
+            return cur.fetchall()
+        finally:
+            conn.close()
+
+
+def search_reviews(chat_id: int, text: str, limit: int = 5) -> List[sqlite3.Row]:
+    """Отзывы этого чата (живые и архивные) по релевантности со сниппетом."""
+    query = _fts_query(text)
+    if not query:
+        return []
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT f.rowid AS review_id,
+                       COALESCE(rv.event_id, ra.event_id) AS event_id,
+                       u.username,
+                       COALESCE(rv.rating, ra.rating) AS rating,
+                       r.name AS r_name,
+                       snippet(reviews_fts, 0, ?, ?, '…', 16) AS snippet,
+                       bm25(reviews_fts) AS score
+                FROM reviews_fts f
+                LEFT JOIN reviews rv ON rv.id = f.rowid
+                LEFT JOIN events e ON e.id = rv.event_id
+                LEFT JOIN review_archive ra ON ra.id = f.rowid
+                LEFT JOIN event_archive a ON a.id = ra.event_id
+                JOIN restaurants r ON r.id = COALESCE(e.restaurant_id, a.restaurant_id)
+                JOIN users u ON u.user_id = COALESCE(rv.user_id, ra.user_id)
+                WHERE reviews_fts MATCH ? AND COALESCE(e.chat_id, a.chat_id) = ?
+                ORDER BY score
+                LIMIT ?
+                """,
+                (SNIPPET_OPEN, SNIPPET_CLOSE, query, chat_id, limit),
+            )
+            return cur.fetchall()
+        finally:
+            conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Recommendation inputs
+# ---------------------------------------------------------------------------
+
+
+def get_catalogue_features() -> List[sqlite3.Row]:
+    """Компактные признаки всего каталога для рекомендательной модели."""
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id, cuisine_id, avg_check_min, avg_check_max FROM restaurants ORDER BY id")
+            return cur.fetchall()
+        finally:
+            conn.close()
+
+
+def get_chat_ratings(chat_id: int) -> List[sqlite3.Row]:
+    """Все оценки чата (живые и архивные отзывы) с рестораном события."""
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT rv.event_id, rv.user_id, e.restaurant_id, rv.rating
+                FROM reviews rv JOIN events e ON e.id = rv.event_id
+                WHERE e.chat_id = ? AND rv.rating IS NOT NULL
+                UNION ALL
+                SELECT ra.event_id, ra.user_id, a.restaurant_id, ra.rating
+                FROM review_archive ra JOIN event_archive a ON a.id = ra.event_id
+                WHERE a.chat_id = ? AND ra.rating IS NOT NULL
+                """,
+                (chat_id, chat_id),
+            )
+            return cur.fetchall()
+        finally:
+            conn.close()
+
+
+def _query_top_restaurants(cur: sqlite3.Cursor, limit: int = 10, min_count: int = 1) -> List[sqlite3.Row]:
+    cur.execute(
+        """
+        SELECT r.id, r.name, r.address, rr.score, rr.rating_count,
+               rr.rating_sum * 1.0 / rr.rating_count AS avg_rating
+        FROM restaurant_ratings rr JOIN restaurants r ON r.id = rr.restaurant_id
+        WHERE rr.rating_count >= ?
+        ORDER BY rr.score DESC, rr.rating_count DESC
+        LIMIT ?
+        """,
+        (max(min_count, 1), limit),
+    )
+    return cur.fetchall()
+
+
+def get_top_restaurants(limit: int = 10, min_count: int = 1) -> List[sqlite3.Row]:
+    """Лучшие рестораны по всем чатам: готовые агрегаты, чтение по idx_restaurant_ratings_score."""
+    return _read(_query_top_restaurants, limit, min_count)
+
+
+def get_visited_restaurant_ids(chat_id: int) -> List[int]:
+    """id ресторанов, уже посещённых чатом (те же правила, что в get_random_restaurant_for_chat)."""
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(_VISITED_BY_CHAT_SQL, (chat_id, chat_id))
+            return [int(r[0]) for r in cur.fetchall()]
+        finally:
+            conn.close()
+
+
+def get_restaurant(restaurant_id: int) -> Optional[sqlite3.Row]:
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT id, name, address, cuisine, description, average_check FROM restaurants WHERE id = ?",
+                (restaurant_id,),
             )
             return cur.fetchone()
         finally:
             conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Nearby selection
+# ---------------------------------------------------------------------------
+
+
+def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _geo_cell_ranges(lat: float, lon: float, radius_km: float) -> List[Tuple[int, int]]:
+    """Диапазоны номеров ячеек, покрывающих круг радиуса radius_km: по одному на строку сетки."""
+    dlat = radius_km / 111.32
+    cos_lat = max(math.cos(math.radians(min(abs(lat) + dlat, 89.9))), 1e-6)
+    dlon = min(radius_km / (111.32 * cos_lat), 180.0)
+    col_lo = _geo_col(max(lon - dlon, -180.0))
+    col_hi = _geo_col(min(lon + dlon, 180.0))
+    ranges: List[Tuple[int, int]] = []
+    for row in range(_geo_row(max(lat - dlat, -90.0)), _geo_row(min(lat + dlat, 90.0)) + 1):
+        base = row * _GEO_ROW_SPAN
+        ranges.append((base + col_lo, base + col_hi))
+    return ranges
+
+
+def get_random_nearby_restaurant_for_chat(
+    chat_id: int,
+    lat: float,
+    lon: float,
+    radius_km: float,
+) -> Optional[Tuple[sqlite3.Row, float]]:
+    """
+    Случайный непосещённый чатом ресторан в радиусе radius_km от точки и расстояние до него.
+    Читаются только ячейки сетки вокруг точки (idx_restaurants_geo_cell), точное
+    расстояние считается лишь для них.
+    """
+    ranges = _geo_cell_ranges(lat, lon, radius_km)
+    cells_sql = " OR ".join("r.geo_cell BETWEEN ? AND ?" for _ in ranges)
+    params: List[Any] = [v for rng in ranges for v in rng]
+    with _DB_LOCK:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                f"""
+                SELECT r.id, r.name, r.address, r.cuisine, r.description, r.average_check,
+                       r.latitude, r.longitude
+                FROM restaurants r
+                WHERE ({cells_sql})
+                  AND r.id NOT IN ({_VISITED_BY_CHAT_SQL})
+                """,
+                params + [chat_id, chat_id],
+            )
+            rows = cur.fetchall()
+        finally:
+            conn.close()
+    nearby: List[Tuple[sqlite3.Row, float]] = []
+    for row in rows:
+        dist = _haversine_km(lat, lon, row["latitude"], row["longitude"])
+        if dist <= radius_km:
+            nearby.append((row, dist))
+    return random.choice(nearby) if nearby else None
+
+
+# ---------------------------------------------------------------------------
+# Export
+# ---------------------------------------------------------------------------
+
+# Единый набор колонок для всех типов записей экспорта (record — тип записи)
+EXPORT_FIELDS: Tuple[str, ...] = (
+    "record",
+    "event_id",
+    "status",
+    "restaurant",
+    "address",
+    "created_at_utc",
+    "reminder_at_utc",
+    "user_id",
+    "username",
+    "first_name",
+    "joined",
+    "cancelled",
+    "rating",
+    "text",
+    "participants_count",
+    "reviews_count",
+    "avg_rating",
+)
+
+_EXPORT_QUERIES: Tuple[Tuple[str, str], ...] = (
+    (
+        "event",
+        """
+        SELECT e.id AS event_id, CASE WHEN e.completed = 1 THEN 'completed' ELSE 'active' END AS status,
+               r.name AS restaurant, r.address, e.created_at_utc, e.reminder_at_utc,
+               (SELECT COUNT(*) FROM participants p WHERE p.event_id = e.id AND p.joined = 1) AS participants_count,
+               (SELECT COUNT(*) FROM reviews rv WHERE rv.event_id = e.id) AS reviews_count,
+               (SELECT AVG(rv.rating) FROM reviews rv WHERE rv.event_id = e.id) AS avg_rating
+        FROM events e JOIN restaurants r ON r.id = e.restaurant_id
+        WHERE e.chat_id = ?
+        UNION ALL
+        SELECT a.id, a.outcome, r.name, r.address, a.created_at_utc, a.reminder_at_utc,
+               a.participants_count, a.reviews_count, a.rating_sum * 1.0 / NULLIF(a.rating_count, 0)
+        FROM event_archive a JOIN restaurants r ON r.id = a.restaurant_id
+        WHERE a.chat_id = ?
+        ORDER BY event_id
+        """,
+    ),
+    (
+        "participant",
+        """
+        SELECT p.event_id, r.name AS restaurant, p.joined_at_utc AS created_at_utc, p.user_id,
+               u.username, u.first_name, p.joined, p.cancelled
+        FROM participants p
+        JOIN users u ON u.user_id = p.user_id
+        JOIN events e ON e.id = p.event_id
+        JOIN restaurants r ON r.id = e.restaurant_id
+        WHERE e.chat_id = ?
+        ORDER BY p.event_id, p.id
+        """,
+    ),
+    (
+        "review",
+        """
+        SELECT rv.event_id, r.name AS restaurant, rv.created_at_utc, rv.user_id, u.username, rv.rating, rv.text
+        FROM reviews rv
+        JOIN users u ON u.user_id = rv.user_id
+        JOIN events e ON e.id = rv.event_id
+        JOIN restaurants r ON r.id = e.restaurant_id
+        WHERE e.chat_id = ?
+        UNION ALL
+        SELECT ra.event_id, r.name, ra.created_at_utc, ra.user_id, u.username, ra.rating, ra.text
+        FROM review_archive ra
+        JOIN users u ON u.user_id = ra.user_id
+        JOIN event_archive a ON a.id = ra.event_id
+        JOIN restaurants r ON r.id = a.restaurant_id
+        WHERE a.chat_id = ?
+        ORDER BY 1, 3
+        """,
+    ),
+)
+
+
+def iter_chat_export(chat_id: int) -> Iterator[Dict[str, Any]]:
+    """
+    Построчно отдаёт историю чата: события (с агрегатами оценок), участников и отзывы.
+    Строки читаются курсором по мере потребления, поэтому память не растёт с историей.
+    Все проходы идут в одной читающей транзакции и видят один согласованный снимок:
+    событие, ушедшее в архив между проходами, не попадёт в выгрузку дважды или со
+    старыми счётчиками. Генератор работает на отдельном соединении без _DB_LOCK, но
+    в режиме rollback-журнала открытое чтение (SHARED) не даёт зафиксировать ни одну
+    запись, пока выгрузка не закончится, — не держите его открытым дольше нужного.
+    """
+    conn = _connect()
+    # транзакцией управляем сами: BEGIN ... COMMIT вокруг всех проходов
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN")
+        for record, sql in _EXPORT_QUERIES:
+            # все параметры запросов — chat_id
+            cur = conn.execute(sql, (chat_id,) * sql.count("?"))
+            for row in cur:
+                item = dict.fromkeys(EXPORT_FIELDS)
+                item.update(dict(row))
+                item["record"] = record
+                yield item
+        conn.execute("COMMIT")
+    finally:
+        # брошенный на середине генератор: закрытие соединения откатывает транзакцию
+        conn.close()
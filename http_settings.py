@@ -0,0 +1,119 @@
+"""
+HTTP-клиент для вызовов Bot API (httpx через telegram.request.HTTPXRequest).
+
+Отправки и long polling идут разными пулами: getUpdates держит соединение до
+конца таймаута опроса, и sendMessage не должен стоять за ним в очереди пула.
+Параметры задаются переменными окружения:
+
+    HTTP_POOL_SIZE            соединений для вызовов Bot API (16; httpcore обходит
+                              весь пул на каждый запрос, см. benchmarks/bench_http.py)
+    HTTP_POLL_POOL_SIZE       соединений для getUpdates (1)
+    HTTP_VERSION              "1.1" или "2" (HTTP/2 требует пакет h2, без него — 1.1)
+    HTTP_KEEPALIVE_EXPIRY     сколько секунд держать простаивающее соединение (30)
+    HTTP_CONNECT_TIMEOUT      таймауты одного вызова, секунды (5 / 5 / 5 / 1)
+    HTTP_READ_TIMEOUT
+    HTTP_WRITE_TIMEOUT
+    HTTP_POOL_TIMEOUT         ожидание свободного соединения в пуле
+    HTTP_MEDIA_WRITE_TIMEOUT  запись при отправке файлов (20)
+    HTTP_POLL_READ_TIMEOUT    чтение getUpdates сверх таймаута опроса (5)
+"""
+
+import logging
+import os
+from typing import Mapping, Optional
+
+import httpx
+from telegram.ext import ApplicationBuilder
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger("bot.http")
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class HttpSettings:
+    def __init__(
+        self,
+        *,
+        pool_size: int = 16,
+        poll_pool_size: int = 1,
+        http_version: str = "1.1",
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 5.0,
+        write_timeout: float = 5.0,
+        pool_timeout: float = 1.0,
+        media_write_timeout: float = 20.0,
+        poll_read_timeout: float = 5.0,
+    ) -> None:
+        if http_version not in ("1.1", "2"):
+            raise ValueError(f"HTTP_VERSION must be '1.1' or '2', got {http_version!r}")
+        self.pool_size = max(pool_size, 1)
+        self.poll_pool_size = max(poll_pool_size, 1)
+        self.http_version = http_version
+        self.keepalive_expiry = keepalive_expiry
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+        self.media_write_timeout = media_write_timeout
+        self.poll_read_timeout = poll_read_timeout
+
+    @classmethod
+    def from_env(cls, environ: Optional[Mapping[str, str]] = None) -> "HttpSettings":
+        env = os.environ if environ is None else environ
+        http_version = env.get("HTTP_VERSION", "1.1").strip()
+        if http_version == "2.0":
+            http_version = "2"
+        if http_version == "2" and not _http2_available():
+            logger.warning("HTTP_VERSION=2 requires the h2 package; falling back to HTTP/1.1")
+            http_version = "1.1"
+        return cls(
+            pool_size=int(env.get("HTTP_POOL_SIZE", "16")),
+            poll_pool_size=int(env.get("HTTP_POLL_POOL_SIZE", "1")),
+            http_version=http_version,
+            keepalive_expiry=float(env.get("HTTP_KEEPALIVE_EXPIRY", "30")),
+            connect_timeout=float(env.get("HTTP_CONNECT_TIMEOUT", "5")),
+            read_timeout=float(env.get("HTTP_READ_TIMEOUT", "5")),
+            write_timeout=float(env.get("HTTP_WRITE_TIMEOUT", "5")),
+            pool_timeout=float(env.get("HTTP_POOL_TIMEOUT", "1")),
+            media_write_timeout=float(env.get("HTTP_MEDIA_WRITE_TIMEOUT", "20")),
+            poll_read_timeout=float(env.get("HTTP_POLL_READ_TIMEOUT", "5")),
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"HttpSettings(pool={self.pool_size}, poll_pool={self.poll_pool_size}, http={self.http_version}, "
+            f"keepalive={self.keepalive_expiry}s, timeouts={self.connect_timeout}/{self.read_timeout}/"
+            f"{self.write_timeout}/{self.pool_timeout}s)"
+        )
+
+    def build_request(self, *, for_polling: bool = False) -> HTTPXRequest:
+        """Отдельный HTTPXRequest (свой пул httpx) для отправок или для getUpdates."""
+        pool_size = self.poll_pool_size if for_polling else self.pool_size
+        # Limits передаём сами: HTTPXRequest не даёт задать keepalive_expiry
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+        return HTTPXRequest(
+            connection_pool_size=pool_size,
+            http_version=self.http_version,
+            connect_timeout=self.connect_timeout,
+            # для getUpdates PTB прибавляет к read_timeout таймаут самого опроса
+            read_timeout=self.poll_read_timeout if for_polling else self.read_timeout,
+            write_timeout=self.write_timeout,
+            pool_timeout=self.pool_timeout,
+            media_write_timeout=self.media_write_timeout,
+            httpx_kwargs={"limits": limits},
+        )
+
+    def apply(self, builder: ApplicationBuilder) -> ApplicationBuilder:
+        return builder.request(self.build_request()).get_updates_request(self.build_request(for_polling=True))
@@ -0,0 +1,124 @@
+"""
+Приём апдейтов: что просить у Telegram и что пускать в диспетчер.
+
+- allowed_updates() выводит список типов апдейтов из обработчиков,
+  зарегистрированных в приложении, и передаётся в getUpdates/setWebhook:
+  остальные типы (изменения сообщений, вступления в чат, реакции, опросы)
+  Telegram не присылает вовсе.
+- UpdateIntake до постановки в очередь отбрасывает апдейты, которые не
+  взял бы ни один обработчик: при отключённом privacy-режиме это почти вся
+  переписка группы. IntakeQueue — очередь приложения с этим фильтром.
+
+Счётчики по стадиям (received / type / unhandled / passed) показывает
+команда /intake.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from telegram import Update
+from telegram.constants import UpdateType
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler
+
+logger = logging.getLogger("bot.intake")
+
+# Тип обработчика -> типы апдейтов, которые ему нужны. Изменённые сообщения
+# не запрашиваем: обработчики читают update.message, а повторно разбирать
+# исправленную дату или отзыв не нужно.
+_HANDLER_UPDATE_TYPES = (
+    (CommandHandler, (UpdateType.MESSAGE,)),
+    (MessageHandler, (UpdateType.MESSAGE,)),
+    (CallbackQueryHandler, (UpdateType.CALLBACK_QUERY,)),
+)
+
+STAGE_RECEIVED = "received"
+STAGE_TYPE = "type"
+STAGE_UNHANDLED = "unhandled"
+STAGE_PASSED = "passed"
+
+
+def allowed_updates(application: Application) -> List[str]:
+    """Типы апдейтов, которые могут понадобиться обработчикам приложения."""
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            for handler_cls, update_types in _HANDLER_UPDATE_TYPES:
+                if isinstance(handler, handler_cls):
+                    types.update(update_types)
+                    break
+            else:
+                logger.warning(f"Unknown handler {type(handler).__name__}; requesting all update types")
+                return list(Update.ALL_TYPES)
+    return sorted(str(t) for t in types)
+
+
+def _update_type(update: Update) -> Optional[str]:
+    for name in Update.ALL_TYPES:
+        if getattr(update, name, None) is not None:
+            return name
+    return None
+
+
+class UpdateIntake:
+    def __init__(self) -> None:
+        self._application: Optional[Application] = None
+        self.allowed_updates: List[str] = []
+        self._allowed: frozenset = frozenset()
+        self.stages: Dict[str, int] = dict.fromkeys((STAGE_RECEIVED, STAGE_TYPE, STAGE_UNHANDLED, STAGE_PASSED), 0)
+        self.dropped_by_type: Dict[str, int] = {}
+
+    def bind(self, application: Application) -> None:
+        """Вызывается после регистрации всех обработчиков."""
+        self._application = application
+        self.allowed_updates = allowed_updates(application)
+        self._allowed = frozenset(self.allowed_updates)
+
+    def _has_handler(self, update: Update) -> bool:
+        # та же проверка, что делает диспетчер (Application.process_update)
+        for handlers in self._application.handlers.values():
+            for handler in handlers:
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    return True
+        return False
+
+    def accept(self, update: Update) -> bool:
+        self.stages[STAGE_RECEIVED] += 1
+        if self._application is None:
+            self.stages[STAGE_PASSED] += 1
+            return True
+        kind = _update_type(update)
+        if kind not in self._allowed:
+            # пришло до смены allowed_updates или вебхук настроен не нами
+            stage = STAGE_TYPE
+        elif not self._has_handler(update):
+            stage = STAGE_UNHANDLED
+        else:
+            self.stages[STAGE_PASSED] += 1
+            return True
+        self.stages[stage] += 1
+        key = f"{stage}:{kind}"
+        self.dropped_by_type[key] = self.dropped_by_type.get(key, 0) + 1
+        return False
+
+    def summary(self) -> str:
+        received = self.stages[STAGE_RECEIVED]
+        parts = [f"{stage}={count}" for stage, count in self.stages.items()]
+        if received:
+            parts.append(f"dropped={100 * (received - self.stages[STAGE_PASSED]) / received:.0f}%")
+        return " ".join(parts)
+
+
+class IntakeQueue(asyncio.Queue):
+    """update_queue приложения: апдейты без обработчика в очередь не попадают."""
+
+    def __init__(self, intake: UpdateIntake) -> None:
+        super().__init__()
+        self.intake = intake
+
+    def put_nowait(self, item: object) -> None:
+        # служебные объекты (сигнал остановки Application) пропускаем как есть
+        if isinstance(item, Update) and not self.intake.accept(item):
+            return
+        super().put_nowait(item)
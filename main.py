@@ -4,9 +4,10 @@ import csv
 import json
 import asyncio
 import html
+import tempfile
+import weakref
 from typing import List, Optional
 from datetime import datetime, timedelta, timezone
-from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 import logging
 
@@ -30,63 +31,85 @@ from telegram.ext import (
 	ContextTypes,
 	filters,
 )
+from telegram.error import BadRequest
 
 from db import (
     init_db,
     migrate_schema,
     import_restaurants_from_json,
     import_restaurants_from_csv_rows,
-    count_restaurants,
     get_random_restaurant,
-    create_event,
-    get_latest_event_for_chat,
-    toggle_participation,
-    list_participant_usernames,
-    set_reminder,
-    mark_reminder_sent,
-    mark_feedback_prompt_sent,
-    save_review,
     get_event_with_details,
     get_due_reminders,
     get_due_feedback_prompts,
     get_stats,
-    get_stats_for_chat,
     get_all_feedback_to_schedule,
-    get_event_by_feedback_message,
-    get_reviews_for_event,
-    cancel_participation,
-    get_user_penalty,
-    clear_user_penalty,
-    get_participants_without_review,
-    is_participant,
-    is_event_completed,
-    get_joined_participants_count,
-    get_upcoming_events,
+    get_review_summary,
+    get_reviews_page,
+    PENALTY_AMOUNT,
     delete_event_with_relations,
-    mark_event_completed,
-    count_distinct_reviews,
     clear_reviews_by_restaurant_name,
     ensure_demo_visit,
     cleanup_demo_data,
     get_random_restaurant_for_chat,
+    archive_event,
+    archive_stale_events,
+    search_restaurants,
+    search_reviews,
+    SNIPPET_OPEN,
+    SNIPPET_CLOSE,
+    find_cuisine_ids,
+    get_restaurant,
+    count_restaurant_duplicates,
+    get_random_nearby_restaurant_for_chat,
+    iter_chat_export,
+    EXPORT_FIELDS,
 )
+from seed import ensure_seed_loaded
+from recommend import Recommender
+from state import MAX_PARTICIPANTS, ActiveEventStore
+from writer import GroupCommitWriter
+from routing import (
+	ROUTE_DATETIME,
+	ROUTE_MENU,
+	ROUTE_RANDOM,
+	ROUTE_START,
+	ROUTE_STATS,
+	ROUTE_UPCOMING,
+	route_text,
+)
+from timeutil import (
+	DEFAULT_TIMEZONE,
+	ChatTimezones,
+	format_date_time,
+	format_local,
+	is_valid_timezone,
+	localize_rows,
+	parse_local_datetime,
+	parse_utc,
+)
+from backup import BackupSkipped, create_backup
+from maintenance import run_maintenance
+from snapshot import CHECK_INTERVAL, AnalyticsSnapshot
+from http_settings import HttpSettings
+from intake import IntakeQueue, UpdateIntake
 
 # ---- Helpers for reviews formatting/toggler ----
-def _calc_reviews_stats(reviews: List[dict]) -> tuple[int, Optional[float], str]:
-    count = len(reviews)
-    ratings = [int(r["rating"]) for r in reviews if r["rating"] is not None]
-    avg = round(sum(ratings) / len(ratings), 1) if ratings else None
-    stars = ""
-    if avg is not None:
-        stars = "⭐" * int(round(avg))
-    return count, avg, stars
+REVIEWS_PAGE_SIZE = 5
+# 5 отзывов по 600 символов плюс шапка укладываются в лимит сообщения 4096
+REVIEW_PREVIEW_CHARS = 600
+
 
+def _rating_stars(avg: Optional[float]) -> str:
+    return "⭐" * int(round(avg)) if avg is not None else ""
 
-def _format_event_text(event_row, reviews: List[dict], *, include_reviews: bool) -> str:
+
+def _format_event_text(event_row, summary: tuple[int, Optional[float]], reviews: Optional[List[dict]] = None) -> str:
+    """Карточка события; reviews — текущая страница отзывов (None — отзывы скрыты)."""
     name = event_row["r_name"] or "Без названия"
     address = event_row["r_address"] or "—"
     cuisine = event_row["r_cuisine"] or "—"
-    count, avg, stars = _calc_reviews_stats(reviews)
+    count, avg = summary
 
     lines: List[str] = []
     lines.append(f"<b>{html.escape(name)}</b>")
@@ -95,17 +118,20 @@ def _format_event_text(event_row, reviews: List[dict], *, include_reviews: bool)
 
     rating_line = f"Отзывы: {count}"
     if avg is not None:
-        rating_line += f" — {avg:.1f} {stars}"
+        rating_line += f" — {avg:.1f} {_rating_stars(avg)}"
     lines.append(rating_line)
 
-    if include_reviews:
+    if reviews is not None:
         if reviews:
             lines.append("")
             for rev in reviews:
                 username = rev["username"] or "Аноним"
                 rating = int(rev["rating"]) if rev["rating"] is not None else None
                 rating_stars = "⭐" * rating if rating else ""
-                text = html.escape(rev["text"] or "")
+                raw_text = rev["text"] or ""
+                if len(raw_text) > REVIEW_PREVIEW_CHARS:
+                    raw_text = raw_text[:REVIEW_PREVIEW_CHARS].rstrip() + "…"
+                text = html.escape(raw_text)
                 username_escaped = html.escape(username)
                 entry = f"{username_escaped}: {rating_stars} {text}".strip()
                 lines.append(entry)
@@ -115,12 +141,31 @@ def _format_event_text(event_row, reviews: List[dict], *, include_reviews: bool)
     return "\n".join(lines)
 
 
-def _build_reviews_keyboard(event_id: int, *, show_reviews: bool) -> InlineKeyboardMarkup:
-    label = "Скрыть отзывы" if show_reviews else "Показать отзывы"
-    action = "hide" if show_reviews else "show"
-    return InlineKeyboardMarkup(
-        [[InlineKeyboardButton(label, callback_data=f"reviews:{event_id}:{action}")]]
-    )
+def _build_reviews_keyboard(
+    event_id: int,
+    reviews: Optional[List[dict]] = None,
+    *,
+    has_prev: bool = False,
+    has_next: bool = False,
+) -> InlineKeyboardMarkup:
+    """
+    Кнопки карточки события. Курсор страницы — id крайнего отзыва в callback_data:
+    reviews:<event>:next:<id последнего> / reviews:<event>:prev:<id первого>.
+    """
+    if reviews is None:
+        return InlineKeyboardMarkup(
+            [[InlineKeyboardButton("Показать отзывы", callback_data=f"reviews:{event_id}:show")]]
+        )
+    rows: List[List[InlineKeyboardButton]] = []
+    nav: List[InlineKeyboardButton] = []
+    if has_prev and reviews:
+        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"reviews:{event_id}:prev:{reviews[0]['id']}"))
+    if has_next and reviews:
+        nav.append(InlineKeyboardButton("Далее ▶️", callback_data=f"reviews:{event_id}:next:{reviews[-1]['id']}"))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton("Скрыть отзывы", callback_data=f"reviews:{event_id}:hide")])
+    return InlineKeyboardMarkup(rows)
 
 # загрузка .env
 load_dotenv()
@@ -130,17 +175,58 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bot")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-_tz_env = os.getenv("TIMEZONE", "Europe/Moscow")
-try:
-    ZoneInfo(_tz_env)
-    TIMEZONE = _tz_env
-except Exception:
-    TIMEZONE = "Europe/Moscow"
-    logger.warning("Invalid TIMEZONE env; fallback to Europe/Moscow")
+# часовой пояс по умолчанию (env TIMEZONE); чат может задать свой через /timezone
+TIMEZONE = DEFAULT_TIMEZONE
+CHAT_TZ = ChatTimezones(TIMEZONE)
 # fallback к RENDER_EXTERNAL_URL, если WEBHOOK_BASE_URL не задан
 WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL")
 WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
 PORT = int(os.getenv("PORT", "8080"))
+# пулы httpx для Bot API: отдельно отправки и getUpdates (env HTTP_*, см. http_settings.py)
+HTTP_SETTINGS = HttpSettings.from_env()
+# long polling: Telegram держит запрос до POLL_TIMEOUT_SEC, пока нет апдейтов
+POLL_TIMEOUT_SEC = int(os.getenv("POLL_TIMEOUT_SEC", "30"))
+# вебхук: сколько запросов с апдейтами Telegram шлёт параллельно
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+INTAKE = UpdateIntake()
+# выбор по вкусам чата (/recommend): кэш матрицы признаков и векторов вкуса
+RECOMMENDER = Recommender(
+	top_k=int(os.getenv("RECOMMEND_TOP_K", "10")),
+	temperature=float(os.getenv("RECOMMEND_TEMPERATURE", "0.5")),
+)
+# групповая фиксация служебных записей: пачка до N записей или не дольше M мс
+WRITER = GroupCommitWriter(
+	max_batch=int(os.getenv("WRITER_MAX_BATCH", "64")),
+	max_delay=float(os.getenv("WRITER_MAX_DELAY_MS", "5")) / 1000,
+)
+# активные события чатов в памяти (запись сквозная в БД)
+EVENTS = ActiveEventStore(writer=WRITER)
+# снимок БД в памяти для /stats, /upcoming и /top: не старше N секунд и M записей
+ANALYTICS = AnalyticsSnapshot(
+	max_age=float(os.getenv("ANALYTICS_MAX_AGE_SEC", "30")),
+	max_writes=int(os.getenv("ANALYTICS_MAX_WRITES", "20")),
+)
+# радиус поиска ресторана рядом с присланной геопозицией
+NEAR_RADIUS_KM = float(os.getenv("NEAR_RADIUS_KM", "3"))
+# онлайн-бэкапы: интервал (0 — отключены), число хранимых снимков, порция страниц и пауза между шагами
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24"))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE_MS = float(os.getenv("BACKUP_STEP_PAUSE_MS", "5"))
+# пропущенный бэкап (база менялась всё время копирования) повторяется через столько минут
+BACKUP_RETRY_MINUTES = float(os.getenv("BACKUP_RETRY_MINUTES", "10"))
+# через сколько дней без активности событие считается брошенным и уходит в архив
+ARCHIVE_STALE_DAYS = int(os.getenv("ARCHIVE_STALE_DAYS", "30"))
+
+MAINTENANCE_INTERVAL_HOURS = float(os.getenv("MAINTENANCE_INTERVAL_HOURS", "24"))
+MAINTENANCE_STEP_MS = float(os.getenv("MAINTENANCE_STEP_MS", "5"))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "64"))
+
+
+def _remove_event_jobs(job_queue, event_id: int) -> None:
+	for job_name in (f"reminder_{event_id}", f"feedback_{event_id}", f"daily_reviews_{event_id}"):
+		for job in job_queue.get_jobs_by_name(job_name):
+			job.schedule_removal()
 
 
 def _fmt_restaurant_card(row, participants: List[str]) -> str:
@@ -163,13 +249,23 @@ def _fmt_restaurant_card(row, participants: List[str]) -> str:
 	)
 
 
-async def _send_random_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
+async def _send_random_for_chat(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    cuisine_ids: Optional[List[int]] = None,
+    max_price: Optional[int] = None,
+    recommend: bool = False,
+    near: Optional[tuple[float, float]] = None,
+) -> None:
     # блокировка при незавершённом событии
-    latest = get_latest_event_for_chat(chat_id)
+    latest = EVENTS.latest(chat_id)
     if latest:
-        event_id = int(latest["id"])
-        if is_event_completed(event_id):
-            delete_event_with_relations(event_id)
+        event_id = latest.id
+        if latest.is_completed():
+            # завершённое событие уходит в архив — история нужна для /stats
+            _remove_event_jobs(context.job_queue, event_id)
+            archive_event(event_id)
+            EVENTS.forget(event_id)
         else:
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -180,9 +276,25 @@ async def _send_random_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int
             )
             return
 
-    row = get_random_restaurant_for_chat(chat_id)
+    if near is not None:
+        found = get_random_nearby_restaurant_for_chat(chat_id, near[0], near[1], NEAR_RADIUS_KM)
+        if not found:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"В радиусе {NEAR_RADIUS_KM:g} км нет непосещённых ресторанов с координатами.",
+            )
+            return
+        row = found[0]
+    elif recommend:
+        restaurant_id = RECOMMENDER.pick(chat_id, cuisine_ids=cuisine_ids, max_price=max_price)
+        row = get_restaurant(restaurant_id) if restaurant_id is not None else None
+    else:
+        row = get_random_restaurant_for_chat(chat_id, cuisine_ids=cuisine_ids, max_price=max_price)
     if not row:
-        await context.bot.send_message(chat_id=chat_id, text="Список ресторанов пуст. Загрузите файл JSON/CSV.")
+        if cuisine_ids or max_price is not None:
+            await context.bot.send_message(chat_id=chat_id, text="Нет непосещённых ресторанов под эти условия.")
+        else:
+            await context.bot.send_message(chat_id=chat_id, text="Список ресторанов пуст. Загрузите файл JSON/CSV.")
         return
 
     participants: List[str] = []
@@ -190,14 +302,14 @@ async def _send_random_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Я иду! ✅", callback_data="join:pending")]])
     msg = await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=constants.ParseMode.HTML, reply_markup=keyboard)
 
-    event_id = create_event(chat_id=chat_id, restaurant_id=int(row["id"]), message_id=msg.message_id)
+    event_id = EVENTS.create(chat_id, row, msg.message_id).id
     keyboard2 = InlineKeyboardMarkup([[InlineKeyboardButton("Я иду! ✅", callback_data=f"join:{event_id}")]])
     await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg.message_id, reply_markup=keyboard2)
 
 
 async def _send_stats_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
-    visited, upcoming = get_stats_for_chat(chat_id)
-    total_cnt = count_restaurants()
+    visited, upcoming = ANALYTICS.get_stats_for_chat(chat_id)
+    total_cnt = ANALYTICS.count_restaurants()
     visited_cnt = len(visited)
     percent = (visited_cnt / total_cnt * 100) if total_cnt else 0
 
@@ -207,17 +319,9 @@ async def _send_stats_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int)
     if upcoming:
         lines.append("")
         lines.append("<b>Предстоящие рестораны</b>:")
-        for row in upcoming:
-            name = row["name"]
-            reminder = row["reminder_at_utc"]
-            when = "дата не назначена"
-            if reminder:
-                try:
-                    dt_local = datetime.fromisoformat(reminder).replace(tzinfo=timezone.utc).astimezone(ZoneInfo(TIMEZONE))
-                    when = dt_local.strftime("%d.%m.%Y %H:%M")
-                except Exception:
-                    pass
-            lines.append(f"• {name} — {when}")
+        whens = localize_rows(upcoming, "reminder_at_utc", CHAT_TZ.get(chat_id))
+        for row, when in zip(upcoming, whens):
+            lines.append(f"• {row['name']} — {when or 'дата не назначена'}")
 
     await context.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode=constants.ParseMode.HTML)
 
@@ -229,47 +333,133 @@ async def _send_stats_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int)
 
     for row in visited:
         event_id = int(row["id"])
-        event = get_event_with_details(event_id)
+        event = ANALYTICS.get_event_with_details(event_id, include_archived=True)
         if not event:
             continue
-        reviews = get_reviews_for_event(event_id)
-        text = _format_event_text(event, reviews, include_reviews=False)
-        keyboard = _build_reviews_keyboard(event_id, show_reviews=False)
+        text = _format_event_text(event, ANALYTICS.get_review_summary(event_id))
+        keyboard = _build_reviews_keyboard(event_id)
         await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=constants.ParseMode.HTML, reply_markup=keyboard)
 
 
 async def _send_upcoming_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
-    rows = get_upcoming_events(chat_id)
+    rows = ANALYTICS.get_upcoming_events(chat_id)
     if not rows:
         await context.bot.send_message(chat_id=chat_id, text="Нет предстоящих событий.")
         return
-    local_tz = ZoneInfo(TIMEZONE)
     lines: List[str] = ["<b>Предстоящие события</b>:"]
-    for r in rows:
-        when = "дата не назначена"
-        if r["reminder_at_utc"]:
-            try:
-                dt_local = datetime.fromisoformat(r["reminder_at_utc"]).replace(tzinfo=timezone.utc).astimezone(local_tz)
-                when = dt_local.strftime("%d.%m.%Y %H:%M")
-            except Exception:
-                pass
-        lines.append(f"• {r['r_name']} — {when}")
+    whens = localize_rows(rows, "reminder_at_utc", CHAT_TZ.get(chat_id))
+    for r, when in zip(rows, whens):
+        lines.append(f"• {r['r_name']} — {when or 'дата не назначена'}")
     await context.bot.send_message(chat_id=chat_id, text="\n".join(lines), parse_mode=constants.ParseMode.HTML)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	await update.message.reply_text(
 		"Привет! Я помогу выбрать ресторан. Доступные команды:\n"
-		"/random_restaurant — выбрать случайный ресторан\n"
+		"/random_restaurant [кухня] [до 2000] — выбрать случайный ресторан\n"
+		"/recommend [кухня] [до 2000] — ресторан по вкусам чата\n"
 		"/set_reminder DD.MM.YYYY HH:MM — установить время встречи\n"
-		"/stats — показать статистику\n\n"
+		"/stats — показать статистику\n"
+		"/top [N] — лучшие рестораны по оценкам всех чатов\n"
+		"/search запрос — найти ресторан или отзыв\n"
+		"/timezone [Europe/Moscow] — часовой пояс чата\n"
+		"Отправьте геопозицию — выберу ресторан поблизости.\n\n"
 		"Админ может загрузить JSON/CSV с ресторанами, отправив файл в чат.",
 	)
 
 
-async def random_restaurant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def _parse_random_filters(args: List[str]) -> tuple[str, Optional[int]]:
+	"""['итальянская', 'до', '2000'] -> ('итальянская', 2000): числа — потолок чека, остальное — кухня."""
+	words: List[str] = []
+	max_price: Optional[int] = None
+	for arg in args:
+		digits = arg.rstrip("₽").replace("руб", "")
+		if digits.isdigit():
+			max_price = int(digits)
+		elif arg.casefold() not in ("до", "руб", "₽"):
+			words.append(arg)
+	return " ".join(words), max_price
+
+
+async def _pick_with_filters(update: Update, context: ContextTypes.DEFAULT_TYPE, *, recommend: bool) -> None:
 	chat_id = update.effective_chat.id
-	await _send_random_for_chat(context, chat_id)
+	cuisine_text, max_price = _parse_random_filters(context.args or [])
+	cuisine_ids: Optional[List[int]] = None
+	if cuisine_text:
+		cuisine_ids = find_cuisine_ids(cuisine_text)
+		if not cuisine_ids:
+			await update.message.reply_text(f"Кухня «{cuisine_text}» не найдена.")
+			return
+	await _send_random_for_chat(context, chat_id, cuisine_ids=cuisine_ids, max_price=max_price, recommend=recommend)
+
+
+async def random_restaurant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""/random_restaurant [кухня] [до N] — случайный ресторан с необязательными фильтрами."""
+	await _pick_with_filters(update, context, recommend=False)
+
+
+async def on_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Геопозиция в чате — случайный непосещённый ресторан поблизости."""
+	location = update.message.location if update.message else None
+	if not location:
+		return
+	await _send_random_for_chat(context, update.effective_chat.id, near=(location.latitude, location.longitude))
+
+
+async def recommend_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""/recommend [кухня] [до N] — ресторан с учётом прошлых оценок чата."""
+	await _pick_with_filters(update, context, recommend=True)
+
+
+def _event_card_keyboard(event, user_id: int) -> InlineKeyboardMarkup:
+	# Кнопка "Я иду" всегда есть
+	buttons = [
+		[InlineKeyboardButton("Я иду! ✅", callback_data=f"join:{event.id}")],
+	]
+	# Кнопка "Отменить" показывается только текущему пользователю, если он записан
+	if event.is_participant(user_id):
+		buttons.append([InlineKeyboardButton("Отменить поход ❌", callback_data=f"cancel:{event.id}")])
+	return InlineKeyboardMarkup(buttons)
+
+
+# event_id -> замок перерисовки карточки; запись живёт, пока замок кто-то держит или ждёт
+_CARD_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+async def _refresh_event_card(bot, event, user_id: int, *, ask_for_time: bool = False) -> None:
+	"""
+	Фоновая часть кнопок «Я иду»/«Отменить»: перерисовывает карточку и шлёт
+	следующие сообщения. Текст собирается под замком события, поэтому при
+	нескольких нажатиях подряд последней на карточке остаётся последняя версия.
+	"""
+	lock = _CARD_LOCKS.get(event.id)
+	if lock is None:
+		lock = _CARD_LOCKS[event.id] = asyncio.Lock()
+	async with lock:
+		text = _fmt_restaurant_card(event.restaurant, event.participant_names())
+		try:
+			await bot.edit_message_text(
+				chat_id=event.chat_id,
+				message_id=event.message_id,
+				text=text,
+				parse_mode=constants.ParseMode.HTML,
+				reply_markup=_event_card_keyboard(event, user_id),
+			)
+		except BadRequest as e:
+			# два нажатия подряд могут дать ту же карточку
+			if "not modified" not in str(e).lower():
+				raise
+	# если теперь ровно 3 участника и дата ещё не назначена, просим установить время
+	if ask_for_time:
+		await bot.send_message(
+			chat_id=event.chat_id,
+			text="Все согласны! Отправьте дату и время похода в формате DD.MM.YYYY HH:MM",
+		)
+
+
+def _in_background(context: ContextTypes.DEFAULT_TYPE, update: Update, coroutine) -> None:
+	"""Вызовы Bot API после ответа на кнопку; ошибки уходят в общий error handler."""
+	context.application.create_task(coroutine, update=update)
 
 
 async def on_join_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -288,86 +478,36 @@ async def on_join_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 		await query.answer()
 		return
 
+	event = EVENTS.get(event_id)
+	if not event:
+		await query.answer()
+		return
+
+	# состояние, лимит и штраф — из памяти (ActiveEventStore), в сеть до ответа не ходим
 	user = query.from_user
-	joined, error_msg = toggle_participation(
-		event_id=event_id,
-		user_id=user.id,
-		username=user.username,
-		first_name=user.first_name,
-	)
+	joined, error_msg = EVENTS.toggle(event, user.id, user.username, user.first_name)
 	
 	# Если ошибка (лимит участников), показываем и не обновляем карточку
 	if error_msg:
 		await query.answer(error_msg, show_alert=True)
 		return
 	
-	# обновляем текст карточки
-	event = get_event_with_details(event_id)
-	if not event:
-		await query.answer()
-		return
-	participants = list_participant_usernames(event_id)
-	# Получить ресторан снова для актуального текста
-	restaurant = {
-		"name": event["r_name"],
-		"address": event["r_address"],
-		"cuisine": event["r_cuisine"],
-		"description": event["r_description"],
-		"average_check": event["r_avg_check"],
-	}
-	text = _fmt_restaurant_card(restaurant, participants)
-	
-	# Кнопка "Я иду" всегда есть
-	buttons = [
-		[InlineKeyboardButton("Я иду! ✅", callback_data=f"join:{event_id}")],
-	]
-	# Кнопка "Отменить" показывается только текущему пользователю, если он записан
-	if is_participant(event_id, user.id):
-		buttons.append([InlineKeyboardButton("Отменить поход ❌", callback_data=f"cancel:{event_id}")])
-	
-	keyboard = InlineKeyboardMarkup(buttons)
-	try:
-		await context.bot.edit_message_text(
-			chat_id=event["chat_id"],
-			message_id=event["message_id"],
-			text=text,
-			parse_mode=constants.ParseMode.HTML,
-			reply_markup=keyboard,
-		)
-	except Exception as e:
-		logger.error(f"Failed to update message: {e}")
-	
 	# показываем штраф если есть
-	penalty = get_user_penalty(user.id)
 	answer_text = "Вы записались!" if joined else "Вы передумали."
-	if penalty > 0 and joined:
-		answer_text += f" У вас штраф {penalty}₽ за отмену предыдущего похода."
+	penalty = EVENTS.penalty(user.id) if joined else 0
+	if penalty > 0:
+		answer_text += f" У вас накопленный штраф {penalty}₽ за отмены походов."
+	ask_for_time = event.joined_count == MAX_PARTICIPANTS and event.reminder_at_utc is None
 	await query.answer(answer_text, show_alert=False)
 
-	# если теперь ровно 3 участника и дата ещё не назначена, просим установить время
-	if len(participants) == 3 and event["reminder_at_utc"] is None:
-		await context.bot.send_message(
-			chat_id=event["chat_id"],
-			text="Все согласны! Отправьте дату и время похода в формате DD.MM.YYYY HH:MM",
-		)
+	# карточку и просьбу назначить время отправляем уже после ответа
+	_in_background(context, update, _refresh_event_card(context.bot, event, user.id, ask_for_time=ask_for_time))
 
 
-async def set_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _set_meeting_time(update: Update, context: ContextTypes.DEFAULT_TYPE, dt_local: datetime) -> None:
+	"""Назначает время встречи последнему событию чата и планирует напоминания."""
 	chat_id = update.effective_chat.id
-	args_text = (update.message.text or "").strip()
-	parts = args_text.split(maxsplit=1)
-	if len(parts) < 2:
-		await update.message.reply_text("Формат: /set_reminder DD.MM.YYYY HH:MM")
-		return
-	when_str = parts[1].strip()
-	try:
-		local_tz = ZoneInfo(TIMEZONE)
-		dt_local = datetime.strptime(when_str, "%d.%m.%Y %H:%M").replace(tzinfo=local_tz)
-		dt_utc = dt_local.astimezone(timezone.utc)
-	except Exception as e:
-		logger.error(f"Failed to parse date: {e}")
-		await update.message.reply_text("Неверный формат. Используйте DD.MM.YYYY HH:MM")
-		return
+	dt_utc = dt_local.astimezone(timezone.utc)
 
 	# Проверка на дату в прошлом
 	now_utc = datetime.now(timezone.utc)
@@ -379,23 +519,21 @@ async def set_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 		await update.message.reply_text("Слишком далеко. Максимум на 20 лет вперёд.")
 		return
 
-	event = get_latest_event_for_chat(chat_id)
+	event = EVENTS.latest(chat_id)
 	if not event:
 		await update.message.reply_text("Сначала выберите ресторан через /random_restaurant")
 		return
 
 	# Разрешать установку времени только когда 3 участника подтвердили
-	cnt = get_joined_participants_count(int(event["id"]))
-	if cnt < 3:
+	if event.joined_count < 3:
 		await update.message.reply_text("Время можно выбрать только после подтверждения 3 участников.")
 		return
 
-	event_id = int(event["id"])
-	set_reminder(event_id=event_id, dt_utc=dt_utc)
+	event_id = event.id
+	# подтверждаем пользователю только записанное время
+	await asyncio.wrap_future(EVENTS.set_reminder(event, dt_utc))
 	# Снимаем возможные старые задачи на это событие
-	for job_name in (f"reminder_{event_id}", f"feedback_{event_id}", f"daily_reviews_{event_id}"):
-		for job in context.job_queue.get_jobs_by_name(job_name):
-			job.schedule_removal()
+	_remove_event_jobs(context.job_queue, event_id)
 	# Именованные задачи, чтобы можно было отменять/восстанавливать без дублей
 	context.job_queue.run_once(send_reminder_job, when=dt_utc, data={"event_id": event_id}, name=f"reminder_{event_id}")
 	context.job_queue.run_once(send_feedback_prompt_job, when=dt_utc + timedelta(hours=3), data={"event_id": event_id}, name=f"feedback_{event_id}")
@@ -408,37 +546,43 @@ async def set_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 	)
 
 	await update.message.reply_text(
-		f"✅ Событие подтверждено!\n🍽 Ресторан: {event['r_name']}\n📅 Дата: {dt_local.strftime('%d.%m.%Y %H:%M %Z')}"
+		f"✅ Событие подтверждено!\n🍽 Ресторан: {event.r_name}\n📅 Дата: {format_date_time(dt_local)} {dt_local.tzname()}"
 	)
 
 
+async def set_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	chat_id = update.effective_chat.id
+	args_text = (update.message.text or "").strip()
+	parts = args_text.split(maxsplit=1)
+	if len(parts) < 2:
+		await update.message.reply_text("Формат: /set_reminder DD.MM.YYYY HH:MM")
+		return
+	dt_local = parse_local_datetime(parts[1], CHAT_TZ.get(chat_id))
+	if dt_local is None:
+		await update.message.reply_text("Неверный формат. Используйте DD.MM.YYYY HH:MM")
+		return
+	await _set_meeting_time(update, context, dt_local)
+
+
 async def send_reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 	data = context.job.data or {}
 	event_id = int(data.get("event_id"))
-	event = get_event_with_details(event_id)
+	event = EVENTS.get(event_id)
 	if not event:
 		logger.warning(f"Event {event_id} not found for reminder")
 		return
-	participants = list_participant_usernames(event_id)
+	participants = event.participant_names()
 	participants_line = ", ".join(participants) if participants else "пока никого"
-	# Время в локальном часовом поясе
-	local_tz = ZoneInfo(TIMEZONE)
-	rem_at_utc = event["reminder_at_utc"]
-	desc_time = "время не указано"
-	if rem_at_utc:
-		try:
-			dt_local = datetime.fromisoformat(rem_at_utc).replace(tzinfo=timezone.utc).astimezone(local_tz)
-			desc_time = dt_local.strftime("%H:%M")
-		except Exception as e:
-			logger.error(f"Failed to parse reminder time: {e}")
+	# Время в локальном часовом поясе чата
+	desc_time = format_local(event.reminder_at_utc, CHAT_TZ.get(event.chat_id), time_only=True) or "время не указано"
 
 	text = (
-		f"Напоминание: сегодня в {desc_time} вы идёте в ресторан {event['r_name']}! "
-		f"Адрес: {event['r_address']}. Список участников: {participants_line}"
+		f"Напоминание: сегодня в {desc_time} вы идёте в ресторан {event.r_name}! "
+		f"Адрес: {event.r_address}. Список участников: {participants_line}"
 	)
 	try:
-		await context.bot.send_message(chat_id=event["chat_id"], text=text)
-		mark_reminder_sent(event_id)
+		await context.bot.send_message(chat_id=event.chat_id, text=text)
+		EVENTS.mark_reminder_sent(event)
 		logger.info(f"Reminder sent for event {event_id}")
 	except Exception as e:
 		logger.error(f"Failed to send reminder for event {event_id}: {e}")
@@ -447,16 +591,16 @@ async def send_reminder_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 async def send_feedback_prompt_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 	data = context.job.data or {}
 	event_id = int(data.get("event_id"))
-	event = get_event_with_details(event_id)
+	event = EVENTS.get(event_id)
 	if not event:
 		logger.warning(f"Event {event_id} not found for feedback prompt")
 		return
 	try:
 		msg = await context.bot.send_message(
-			chat_id=event["chat_id"],
-			text=f"Как вам было в {event['r_name']}? Пожалуйста, оставьте свой отзыв, ответив на это сообщение!\n\nФормат: [Рейтинг 1-5 звёзд] Текст отзыва\nПример: 5 Отличное место, вернёмся!",
+			chat_id=event.chat_id,
+			text=f"Как вам было в {event.r_name}? Пожалуйста, оставьте свой отзыв, ответив на это сообщение!\n\nФормат: [Рейтинг 1-5 звёзд] Текст отзыва\nПример: 5 Отличное место, вернёмся!",
 		)
-		mark_feedback_prompt_sent(event_id, feedback_message_id=msg.message_id)
+		EVENTS.mark_feedback_prompt_sent(event, msg.message_id)
 		logger.info(f"Feedback prompt sent for event {event_id}")
 	except Exception as e:
 		logger.error(f"Failed to send feedback prompt for event {event_id}: {e}")
@@ -466,12 +610,14 @@ async def remind_pending_reviews_job(context: ContextTypes.DEFAULT_TYPE) -> None
 	"""Напоминает участникам, не оставившим отзыв."""
 	data = context.job.data or {}
 	event_id = int(data.get("event_id"))
-	event = get_event_with_details(event_id)
+	event = EVENTS.get(event_id)
 	if not event:
 		logger.warning(f"Event {event_id} not found for pending review reminder")
+		# событие удалено или заархивировано — ежедневное напоминание больше не нужно
+		context.job.schedule_removal()
 		return
 	
-	pending = get_participants_without_review(event_id)
+	pending = event.pending_reviewers()
 	if not pending:
 		logger.info(f"No pending reviews for event {event_id}, stopping reminders")
 		# Останавливаем повторяющееся задание если все оставили отзывы
@@ -479,12 +625,12 @@ async def remind_pending_reviews_job(context: ContextTypes.DEFAULT_TYPE) -> None
 		return
 	
 	for p in pending:
-		user_id = int(p["user_id"])
-		username = p["username"] or p["first_name"] or "участник"
+		user_id = p.user_id
+		username = p.username or p.first_name or "участник"
 		try:
 			await context.bot.send_message(
 				chat_id=user_id,
-				text=f"Напоминаем: вы ещё не оставили отзыв о ресторане {event['r_name']}. Пожалуйста, ответьте на сообщение в группе!",
+				text=f"Напоминаем: вы ещё не оставили отзыв о ресторане {event.r_name}. Пожалуйста, ответьте на сообщение в группе!",
 			)
 			logger.info(f"Sent review reminder to user {user_id} for event {event_id}")
 		except Exception as e:
@@ -492,80 +638,132 @@ async def remind_pending_reviews_job(context: ContextTypes.DEFAULT_TYPE) -> None
 			logger.warning(f"Failed to send DM to user {user_id}, sending to group: {e}")
 			try:
 				await context.bot.send_message(
-					chat_id=event["chat_id"],
-					text=f"@{username}, напоминаем оставить отзыв о {event['r_name']}!",
+					chat_id=event.chat_id,
+					text=f"@{username}, напоминаем оставить отзыв о {event.r_name}!",
 				)
 			except Exception as e2:
 				logger.error(f"Failed to send group reminder: {e2}")
 
 
+async def archive_stale_events_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Переносит в архив события, по которым давно нет активности."""
+	cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_STALE_DAYS)
+	try:
+		archived = archive_stale_events(cutoff)
+	except Exception as e:
+		logger.error(f"Failed to archive stale events: {e}")
+		return
+	for event_id, chat_id in archived:
+		_remove_event_jobs(context.job_queue, event_id)
+		EVENTS.forget(event_id)
+		RECOMMENDER.forget_chat(chat_id)
+	if archived:
+		logger.info(f"Archived {len(archived)} stale events")
+
+
+async def refresh_analytics_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Обновляет снимок для отчётов заранее, чтобы команды не ждали копирования."""
+	await asyncio.to_thread(ANALYTICS.refresh_quietly)
+
+
+async def _run_backup() -> dict:
+	return await asyncio.to_thread(
+		create_backup,
+		pages=BACKUP_PAGES_PER_STEP,
+		pause=BACKUP_STEP_PAUSE_MS / 1000,
+		keep=BACKUP_KEEP,
+	)
+
+
+async def backup_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Плановый онлайн-бэкап базы (в отдельном потоке, порциями страниц)."""
+	try:
+		await _run_backup()
+	except BackupSkipped as e:
+		logger.warning(f"Scheduled backup skipped, retrying in {BACKUP_RETRY_MINUTES:g} min: {e}")
+		if not context.job_queue.get_jobs_by_name("backup_retry"):
+			context.job_queue.run_once(backup_job, timedelta(minutes=BACKUP_RETRY_MINUTES), name="backup_retry")
+	except Exception as e:
+		logger.error(f"Scheduled backup failed: {e}")
+
+
+async def _run_maintenance() -> dict:
+	return await asyncio.to_thread(
+		run_maintenance,
+		step_ms=MAINTENANCE_STEP_MS,
+		vacuum_pages=MAINTENANCE_VACUUM_PAGES,
+	)
+
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""ANALYZE, PRAGMA optimize и incremental_vacuum короткими шагами (в отдельном потоке)."""
+	try:
+		await _run_maintenance()
+	except Exception as e:
+		logger.error(f"Scheduled DB maintenance failed: {e}")
+
+
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await _send_stats_for_chat(context, update.effective_chat.id)
 
 
+TOP_DEFAULT_LIMIT = 10
+TOP_MAX_LIMIT = 30
+
+
+async def top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/top [N] — рейтинг ресторанов по байесовской оценке (все чаты)."""
+    limit = TOP_DEFAULT_LIMIT
+    if context.args:
+        try:
+            limit = max(1, min(int(context.args[0]), TOP_MAX_LIMIT))
+        except ValueError:
+            await update.message.reply_text(f"❌ Формат: /top [N], N до {TOP_MAX_LIMIT}")
+            return
+    rows = ANALYTICS.get_top_restaurants(limit)
+    if not rows:
+        await update.message.reply_text("Оценок пока нет.")
+        return
+    lines: List[str] = ["<b>Лучшие рестораны</b>:"]
+    for place, row in enumerate(rows, start=1):
+        name = html.escape(row["name"] or "Без названия")
+        avg = float(row["avg_rating"])
+        lines.append(f"{place}. {name} — {avg:.1f} {_rating_stars(avg)} ({int(row['rating_count'])} оц.)")
+    await update.message.reply_text("\n".join(lines), parse_mode=constants.ParseMode.HTML)
+
+
 async def on_freeform_datetime(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Принимает дату/время формата DD.MM.YYYY HH:MM из обычного сообщения."""
+    """Принимает дату/время формата DD.MM.YYYY HH:MM (разделитель времени : . -) из обычного сообщения."""
     chat_id = update.effective_chat.id
-    when_str = (update.message.text or "").strip()
-    logger.info(f"Processing datetime input: '{when_str}' in chat {chat_id}")
-    
-    try:
-        local_tz = ZoneInfo(TIMEZONE)
-        # Пробуем разные форматы
-        dt_local = None
-        for fmt in ("%d.%m.%Y %H:%M", "%d.%m.%Y %H.%M", "%d.%m.%Y %H-%M"):
-            try:
-                dt_local = datetime.strptime(when_str, fmt).replace(tzinfo=local_tz)
-                break
-            except ValueError:
-                continue
-        
-        if dt_local is None:
-            raise ValueError("No matching format")
-            
-        dt_utc = dt_local.astimezone(timezone.utc)
-    except Exception as e:
-        logger.warning(f"Freeform datetime parse failed for '{when_str}': {e}")
+    when_str = update.message.text or ""
+    logger.info(f"Processing datetime input: '{when_str.strip()}' in chat {chat_id}")
+
+    dt_local = parse_local_datetime(when_str, CHAT_TZ.get(chat_id))
+    if dt_local is None:
+        logger.warning(f"Freeform datetime parse failed for '{when_str.strip()}'")
         await update.message.reply_text("❌ Неверный формат. Используйте DD.MM.YYYY HH:MM\nПример: 25.12.2024 13:00")
         return
+    await _set_meeting_time(update, context, dt_local)
 
-    now_utc = datetime.now(timezone.utc)
-    if dt_utc <= now_utc:
-        await update.message.reply_text("Нельзя установить время в прошлом. Выберите будущую дату и время.")
-        return
-    if dt_utc > now_utc + timedelta(days=365*20):
-        await update.message.reply_text("Слишком далеко. Максимум на 20 лет вперёд.")
-        return
 
-    event = get_latest_event_for_chat(chat_id)
-    if not event:
-        await update.message.reply_text("Сначала выберите ресторан через /random_restaurant")
+async def timezone_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/timezone [Area/City] — показать или сменить часовой пояс чата (в группах — только админы)."""
+    chat = update.effective_chat
+    if not context.args:
+        await update.message.reply_text(
+            f"Часовой пояс чата: {CHAT_TZ.get(chat.id)}\nСменить: /timezone Europe/Moscow"
+        )
         return
-
-    cnt = get_joined_participants_count(int(event["id"]))
-    if cnt < 3:
-        await update.message.reply_text("Время можно выбрать только после подтверждения 3 участников.")
+    if chat.type in ("group", "supergroup") and not await _is_chat_admin(context, chat, update.effective_user):
+        await update.message.reply_text("Только администратор может менять часовой пояс.")
         return
-
-    event_id = int(event["id"])
-    set_reminder(event_id=event_id, dt_utc=dt_utc)
-    # снять возможные старые задачи
-    for job_name in (f"reminder_{event_id}", f"feedback_{event_id}", f"daily_reviews_{event_id}"):
-        for job in context.job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
-    # назначить новые
-    context.job_queue.run_once(send_reminder_job, when=dt_utc, data={"event_id": event_id}, name=f"reminder_{event_id}")
-    context.job_queue.run_once(send_feedback_prompt_job, when=dt_utc + timedelta(hours=3), data={"event_id": event_id}, name=f"feedback_{event_id}")
-    context.job_queue.run_repeating(
-        remind_pending_reviews_job,
-        interval=timedelta(days=1),
-        first=dt_utc + timedelta(days=1),
-        data={"event_id": event_id},
-        name=f"daily_reviews_{event_id}",
-    )
-
+    name = context.args[0]
+    if not is_valid_timezone(name):
+        await update.message.reply_text(f"Неизвестный часовой пояс «{name}». Пример: Europe/Moscow, Asia/Yekaterinburg")
+        return
+    CHAT_TZ.set(chat.id, name)
     await update.message.reply_text(
-        f"✅ Событие подтверждено!\n🍽 Ресторан: {event['r_name']}\n📅 Дата: {dt_local.strftime('%d.%m.%Y %H:%M %Z')}"
+        f"Часовой пояс чата: {name}. Уже назначенные встречи остаются в том же моменте времени."
     )
 
 
@@ -597,6 +795,7 @@ async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 	file_bytes = await file.download_as_bytes()
 	inserted = 0
 	try:
+		duplicates_before = count_restaurant_duplicates()
 		if file_name.endswith(".json"):
 			data = json.loads(file_bytes.decode("utf-8"))
 			inserted = import_restaurants_from_json(data)
@@ -605,7 +804,11 @@ async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 			reader = csv.DictReader(stream)
 			rows = [row for row in reader]
 			inserted = import_restaurants_from_csv_rows(rows)
-		await message.reply_text(f"Импортировано ресторанов: {inserted}")
+		reply = f"Импортировано ресторанов: {inserted}"
+		flagged = count_restaurant_duplicates() - duplicates_before
+		if flagged > 0:
+			reply += f"\nПохожи на уже существующие: {flagged}"
+		await message.reply_text(reply)
 	except Exception as e:
 		await message.reply_text(f"Ошибка импорта: {e}")
 
@@ -613,46 +816,29 @@ async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 async def on_cancel_trip(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	"""Обрабатывает нажатие кнопку 'Отменить поход'."""
 	query = update.callback_query
-	await query.answer()
 	data = query.data or ""
-	if not data.startswith("cancel:"):
-		return
 	parts = data.split(":", 1)
-	if len(parts) != 2:
+	if not data.startswith("cancel:") or len(parts) != 2:
+		await query.answer()
 		return
 	try:
 		event_id = int(parts[1])
 	except ValueError:
+		await query.answer()
 		return
 	
+	event = EVENTS.get(event_id)
+	if not event:
+		await query.answer()
+		return
 	user = query.from_user
 	# отменяем участие и ставим штраф
-	cancel_participation(event_id, user.id)
-	
-	# обновляем карточку
-	event = get_event_with_details(event_id)
-	if not event:
+	if not EVENTS.cancel(event, user.id):
+		# повторное нажатие: штраф уже начислен, карточка уже обновлена
+		await query.answer()
 		return
-	participants = list_participant_usernames(event_id)
-	restaurant = {
-		"name": event["r_name"],
-		"address": event["r_address"],
-		"cuisine": event["r_cuisine"],
-		"description": event["r_description"],
-		"average_check": event["r_avg_check"],
-	}
-	text = _fmt_restaurant_card(restaurant, participants)
-	keyboard = InlineKeyboardMarkup(
-		[[InlineKeyboardButton("Я иду! ✅", callback_data=f"join:{event_id}")]]
-	)
-	await context.bot.edit_message_text(
-		chat_id=event["chat_id"],
-		message_id=event["message_id"],
-		text=text,
-		parse_mode=constants.ParseMode.HTML,
-		reply_markup=keyboard,
-	)
-	await query.answer("Поход отменён. Штраф 500₽ будет учтён в следующем походе.", show_alert=True)
+	await query.answer(f"Поход отменён. Штраф {PENALTY_AMOUNT}₽ будет учтён в следующем походе.", show_alert=True)
+	_in_background(context, update, _refresh_event_card(context.bot, event, user.id))
 
 
 # ---------------------------------------------------------------------------
@@ -663,19 +849,16 @@ async def on_cancel_trip(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def on_reset_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Кнопка ♻️ Сбросить — только администратор."""
     query = update.callback_query
-    await query.answer()
-
     data = query.data or ""
-    if not data.startswith("reset:"):
-        return
-
     parts = data.split(":", 1)
-    if len(parts) != 2:
+    if not data.startswith("reset:") or len(parts) != 2:
+        await query.answer()
         return
 
     try:
         event_id = int(parts[1])
     except ValueError:
+        await query.answer()
         return
 
     user = query.from_user
@@ -694,19 +877,23 @@ async def on_reset_event(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     # Отменяем задачи, затем удаляем событие
-    for job_name in (f"reminder_{event_id}", f"feedback_{event_id}", f"daily_reviews_{event_id}"):
-        for job in context.job_queue.get_jobs_by_name(job_name):
-            job.schedule_removal()
+    _remove_event_jobs(context.job_queue, event_id)
     delete_event_with_relations(event_id)
+    EVENTS.forget(event_id)
+    RECOMMENDER.forget_chat(chat_id)
+    await query.answer("Событие сброшено.")
+    _in_background(context, update, _announce_event_reset(context.bot, chat_id, query.message))
+
 
+async def _announce_event_reset(bot, chat_id: int, card_message) -> None:
     # удаляем сообщение с карточкой, чтобы не висело
-    if query.message:
+    if card_message:
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
+            await bot.delete_message(chat_id=chat_id, message_id=card_message.message_id)
         except Exception:
             pass
 
-    await context.bot.send_message(
+    await bot.send_message(
         chat_id=chat_id,
         text="Событие сброшено администратором. Можно выбрать новый ресторан через /random_restaurant",
     )
@@ -721,7 +908,7 @@ async def on_text_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 	chat_id = update.effective_chat.id
 	reply_id = message.reply_to_message.message_id
 	# ищем событие по feedback_message_id
-	event = get_event_by_feedback_message(chat_id=chat_id, feedback_message_id=reply_id)
+	event = EVENTS.by_feedback_message(chat_id, reply_id)
 	if not event:
 		return
 
@@ -735,32 +922,34 @@ async def on_text_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 		except Exception as e:
 			logger.warning(f"Failed to parse rating: {e}")
 
-	success, reply_msg = save_review(
-		event_id=int(event["id"]),
-		user_id=update.effective_user.id,
-		username=update.effective_user.username,
-		text=text,
-		rating=rating,
-	)
+	user = update.effective_user
+	success, reply_msg = EVENTS.save_review(event, user.id, user.username, user.first_name, text, rating)
 	
 	if not success:
 		await message.reply_text(reply_msg)
 		return
 	
+	RECOMMENDER.observe_rating(
+		chat_id=chat_id,
+		event_id=event.id,
+		user_id=user.id,
+		restaurant_id=event.restaurant_id,
+		rating=rating,
+	)
 	# сбрасываем штраф после оставления отзыва (человек «отработал» поход)
-	clear_user_penalty(update.effective_user.id)
+	EVENTS.clear_penalty(user.id)
 	# автозавершение события: если теперь 3 уникальных отзыва — помечаем завершённым, снимаем ежедневные job'ы и уведомляем чат
-	ev_id = int(event["id"])
-	if count_distinct_reviews(ev_id) >= 3:
-		mark_event_completed(ev_id)
+	ev_id = event.id
+	if len(event.reviewers) >= 3 and not event.completed:
+		EVENTS.mark_completed(event)
 		# снять напоминания
 		for job_name in (f"daily_reviews_{ev_id}",):
 			for job in context.job_queue.get_jobs_by_name(job_name):
 				job.schedule_removal()
 		try:
 			await context.bot.send_message(
-				chat_id=event["chat_id"],
-				text=f"Событие завершено: получено 3 отзыва по ресторану {event['r_name']}. Спасибо!",
+				chat_id=event.chat_id,
+				text=f"Событие завершено: получено 3 отзыва по ресторану {event.r_name}. Спасибо!",
 			)
 		except Exception:
 			pass
@@ -784,19 +973,19 @@ async def cancel_event_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 		await update.message.reply_text("Только администратор может отменить событие.")
 		return
 	
-	event = get_latest_event_for_chat(chat.id)
+	event = EVENTS.latest(chat.id)
 	if not event:
 		await update.message.reply_text("Нет активного события для отмены.")
 		return
 	
-	event_id = int(event["id"])
-	for job_name in (f"reminder_{event_id}", f"feedback_{event_id}", f"daily_reviews_{event_id}"):
-		for job in context.job_queue.get_jobs_by_name(job_name):
-			job.schedule_removal()
+	event_id = event.id
+	_remove_event_jobs(context.job_queue, event_id)
 	delete_event_with_relations(event_id)
+	EVENTS.forget(event_id)
+	RECOMMENDER.forget_chat(chat.id)
 
 	# удаляем карточку ресторана, если сообщение существует
-	message_id = event["message_id"]
+	message_id = event.message_id
 	try:
 		await context.bot.delete_message(chat_id=chat.id, message_id=message_id)
 	except Exception as e:
@@ -833,6 +1022,11 @@ async def clear_reviews_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 	restaurant_name = parts[1].strip()
 	logger.info(f"Clearing reviews for restaurant: '{restaurant_name}'")
 	deleted_count = clear_reviews_by_restaurant_name(restaurant_name)
+	if deleted_count > 0:
+		# отзывы и флаги completed менялись в обход хранилища событий
+		EVENTS.clear()
+		# ресторан мог быть оценён в любом чате
+		RECOMMENDER.forget_all()
 	
 	if deleted_count > 0:
 		await update.message.reply_text(f"✅ Удалено отзывов: {deleted_count} для ресторана '{restaurant_name}'")
@@ -848,39 +1042,225 @@ async def on_reviews_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer()
         return
 
-    parts = data.split(":", 2)
-    if len(parts) != 3:
+    # reviews:<event>:show|hide или reviews:<event>:next|prev:<id отзыва>
+    parts = data.split(":")
+    if len(parts) not in (3, 4):
         await query.answer()
         return
 
-    _, event_id_str, mode = parts
+    mode = parts[2]
     try:
-        event_id = int(event_id_str)
+        event_id = int(parts[1])
+        anchor_id = int(parts[3]) if len(parts) == 4 else None
     except ValueError:
         await query.answer()
         return
+    if (anchor_id is None) != (mode in ("show", "hide")):
+        await query.answer()
+        return
 
-    event = get_event_with_details(event_id)
+    event = get_event_with_details(event_id, include_archived=True)
     if not event:
         await query.answer("Событие не найдено", show_alert=True)
         return
+    await query.answer()
+    _in_background(context, update, _show_reviews_page(context.bot, query.message, event, mode, anchor_id))
 
-    reviews = get_reviews_for_event(event_id)
-    show_reviews = mode == "show"
-    text = _format_event_text(event, reviews, include_reviews=show_reviews)
-    keyboard = _build_reviews_keyboard(event_id, show_reviews=show_reviews)
+
+async def _show_reviews_page(bot, message, event, mode: str, anchor_id: Optional[int]) -> None:
+    """Перерисовывает карточку события со страницей отзывов (после ответа на кнопку)."""
+    event_id = int(event["id"])
+    summary = get_review_summary(event_id)
+    if mode == "hide":
+        text = _format_event_text(event, summary)
+        keyboard = _build_reviews_keyboard(event_id)
+    else:
+        reviews, has_prev, has_next = get_reviews_page(
+            event_id,
+            after_id=anchor_id if mode == "next" else None,
+            before_id=anchor_id if mode == "prev" else None,
+            limit=REVIEWS_PAGE_SIZE,
+        )
+        text = _format_event_text(event, summary, reviews)
+        keyboard = _build_reviews_keyboard(event_id, reviews, has_prev=has_prev, has_next=has_next)
 
     try:
-        await context.bot.edit_message_text(
-            chat_id=query.message.chat_id,
-            message_id=query.message.message_id,
+        await bot.edit_message_text(
+            chat_id=message.chat_id,
+            message_id=message.message_id,
             text=text,
             parse_mode=constants.ParseMode.HTML,
             reply_markup=keyboard,
         )
     except Exception as e:
         logger.error(f"Failed to toggle reviews for event {event_id}: {e}")
-    await query.answer()
+
+
+def _highlight(snippet: Optional[str]) -> str:
+    """Экранирует сниппет FTS и превращает маркеры совпадений в <b>."""
+    return html.escape(snippet or "").replace(SNIPPET_OPEN, "<b>").replace(SNIPPET_CLOSE, "</b>")
+
+
+async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Полнотекстовый поиск по ресторанам и отзывам чата. Формат: /search запрос"""
+    parts = (update.message.text or "").strip().split(maxsplit=1)
+    if len(parts) < 2:
+        await update.message.reply_text("Формат: /search запрос\nПример: /search итальянская Петровка")
+        return
+    query = parts[1].strip()
+    restaurants = search_restaurants(query)
+    reviews = search_reviews(update.effective_chat.id, query)
+    if not restaurants and not reviews:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+
+    lines: List[str] = []
+    if restaurants:
+        lines.append("<b>Рестораны</b>:")
+        for row in restaurants:
+            cuisine = html.escape(row["cuisine"] or "—")
+            lines.append(f"• <b>{html.escape(row['name'])}</b> ({cuisine}) — {_highlight(row['snippet'])}")
+    if reviews:
+        if lines:
+            lines.append("")
+        lines.append("<b>Отзывы</b>:")
+        for row in reviews:
+            author = html.escape(row["username"] or "Аноним")
+            stars = "⭐" * int(row["rating"]) if row["rating"] else ""
+            lines.append(f"• {html.escape(row['r_name'])}, {author}: {stars} {_highlight(row['snippet'])}".rstrip())
+    await update.message.reply_text("\n".join(lines), parse_mode=constants.ParseMode.HTML)
+
+
+async def _is_chat_admin(context: ContextTypes.DEFAULT_TYPE, chat, user) -> bool:
+    """Админ группы; в личном чате любые админские команды разрешены (как в остальных командах)."""
+    if chat.type not in ("group", "supergroup"):
+        return True
+    try:
+        member = await context.bot.get_chat_member(chat_id=chat.id, user_id=user.id)
+        return member.status in ("creator", "administrator")
+    except Exception as e:
+        logger.error(f"Failed to check admin status: {e}")
+        return False
+
+
+def _write_export(chat_id: int, fmt: str, path: str) -> int:
+    """Пишет экспорт построчно из генератора в файл; возвращает число записей."""
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as fh:
+        if fmt == "csv":
+            writer = csv.DictWriter(fh, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+            for item in iter_chat_export(chat_id):
+                writer.writerow(item)
+                count += 1
+        else:
+            for item in iter_chat_export(chat_id):
+                fh.write(json.dumps(item, ensure_ascii=False))
+                fh.write("\n")
+                count += 1
+    return count
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выгружает историю чата файлом (только для админов). Формат: /export [csv|jsonl]"""
+    chat = update.effective_chat
+    if not await _is_chat_admin(context, chat, update.effective_user):
+        await update.message.reply_text("Только администратор может выгружать историю.")
+        return
+    fmt = (context.args[0].lower() if context.args else "csv").lstrip(".")
+    if fmt == "json":
+        fmt = "jsonl"
+    if fmt not in ("csv", "jsonl"):
+        await update.message.reply_text("Формат: /export [csv|jsonl]")
+        return
+
+    fd, path = tempfile.mkstemp(prefix=f"export_{chat.id}_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        # чтение БД и запись файла — в отдельном потоке, чтобы не блокировать обработку апдейтов
+        count = await asyncio.to_thread(_write_export, chat.id, fmt, path)
+        if not count:
+            await update.message.reply_text("История пуста — выгружать нечего.")
+            return
+        with open(path, "rb") as fh:
+            await context.bot.send_document(
+                chat_id=chat.id,
+                document=fh,
+                filename=f"history_{chat.id}.{fmt}",
+                caption=f"Записей: {count}",
+            )
+    except Exception as e:
+        logger.error(f"Export failed for chat {chat.id}: {e}")
+        await update.message.reply_text(f"Ошибка экспорта: {e}")
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def backup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Бэкап базы по требованию (только для админов)."""
+    if not await _is_chat_admin(context, update.effective_chat, update.effective_user):
+        await update.message.reply_text("Только администратор может запускать бэкап.")
+        return
+    await update.message.reply_text("Запускаю бэкап…")
+    try:
+        info = await _run_backup()
+    except BackupSkipped as e:
+        logger.warning(f"On-demand backup skipped: {e}")
+        await update.message.reply_text("⏳ База всё время менялась, бэкап не успел. Попробуйте позже.")
+        return
+    except Exception as e:
+        logger.error(f"On-demand backup failed: {e}")
+        await update.message.reply_text(f"❌ Бэкап не удался: {e}")
+        return
+    await update.message.reply_text(
+        f"✅ Бэкап готов: {os.path.basename(info['path'])}\n"
+        f"Размер: {info['size'] / 1024:.0f} КБ, время: {info['seconds']:.2f} с, удалено старых: {len(info['removed'])}"
+    )
+
+
+async def intake_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сколько апдейтов пришло и сколько отброшено до диспетчера (только для админов)."""
+    if not await _is_chat_admin(context, update.effective_chat, update.effective_user):
+        await update.message.reply_text("Только администратор может смотреть эти счётчики.")
+        return
+    stages = INTAKE.stages
+    lines = [
+        "📥 Входящие апдейты с запуска",
+        f"Запрашиваем у Telegram: {', '.join(INTAKE.allowed_updates) or 'все типы'}",
+        f"Получено: {stages['received']}",
+        f"Отброшено по типу: {stages['type']}",
+        f"Отброшено без обработчика: {stages['unhandled']}",
+        f"Передано диспетчеру: {stages['passed']}",
+    ]
+    if INTAKE.dropped_by_type:
+        lines.append("")
+        lines.extend(f"{key}: {count}" for key, count in sorted(INTAKE.dropped_by_type.items(), key=lambda kv: -kv[1]))
+    await update.message.reply_text("\n".join(lines))
+
+
+async def maintenance_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обслуживание базы по требованию и метрики файла (только для админов)."""
+    if not await _is_chat_admin(context, update.effective_chat, update.effective_user):
+        await update.message.reply_text("Только администратор может запускать обслуживание базы.")
+        return
+    try:
+        info = await _run_maintenance()
+    except Exception as e:
+        logger.error(f"On-demand DB maintenance failed: {e}")
+        await update.message.reply_text(f"❌ Обслуживание не удалось: {e}")
+        return
+    before, after = info["before"], info["after"]
+    await update.message.reply_text(
+        f"🧹 Обслуживание базы: {info['seconds']:.2f} с, шагов {info['steps']} "
+        f"(самый долгий {info['longest_step_ms']} мс, прервано {info['interrupted_steps']})\n"
+        f"ANALYZE: {', '.join(info['analyzed']) or 'статистика актуальна'}\n"
+        f"Свободных страниц: {before['freelist_count']} → {after['freelist_count']} "
+        f"(возвращено {info['vacuumed_pages']})\n"
+        f"Файл: {before['file_size'] / 1024:.0f} КБ → {after['file_size'] / 1024:.0f} КБ"
+    )
 
 
 ## Удалён reviews_ команда: используем только toggler кнопки
@@ -914,26 +1294,21 @@ async def menu_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 	await update.message.reply_text("Быстрые действия:", reply_markup=inline)
 
 
-async def on_menu_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-	text = (update.message.text or "").strip().lower()
-	# алиасы без слеша (работают в группах при отключённом privacy у бота)
-	if text in ("start", "старт", "help", "помощь"):
-		await start(update, context)
-		return
-	if text in ("menu", "меню"):
-		await menu_cmd(update, context)
-		return
-	if text in ("предстоящие события", "upcoming", "upcomming"):
-		await upcoming_cmd(update, context)
-		return
-	# ТОЛЬКО точные пункты меню
-	if text in ("🎲 случайный ресторан", "случайный ресторан"):
-		await random_restaurant(update, context)
-		return
-	if text in ("📊 статистика", "статистика"):
-		await stats_cmd(update, context)
-		return
-	# убираем обработку "установить время" кнопкой
+class _RoutedTextFilter(filters.MessageFilter):
+	"""Пропускает только текст, для которого есть маршрут: обычная переписка отсекается в фильтре."""
+
+	def filter(self, message) -> bool:
+		return route_text(message.text) is not None
+
+
+ROUTED_TEXT = _RoutedTextFilter(name="ROUTED_TEXT")
+
+
+async def on_routed_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+	"""Единый обработчик текста без слеша: дата встречи и алиасы меню (privacy у бота отключён)."""
+	handler = _TEXT_ROUTES.get(route_text(update.message.text))
+	if handler is not None:
+		await handler(update, context)
 
 
 async def upcoming_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -941,23 +1316,42 @@ async def upcoming_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 	await _send_upcoming_for_chat(context, update.effective_chat.id)
 
 
+_TEXT_ROUTES = {
+	ROUTE_DATETIME: on_freeform_datetime,
+	ROUTE_START: start,
+	ROUTE_MENU: menu_cmd,
+	ROUTE_UPCOMING: upcoming_cmd,
+	ROUTE_RANDOM: random_restaurant,
+	ROUTE_STATS: stats_cmd,
+}
+
+
 async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     data = query.data or ""
     chat_id = query.message.chat_id if query.message else update.effective_chat.id
-    if data == "menu:random":
-        await _send_random_for_chat(context, chat_id)
-        await query.answer()
-        return
-    if data == "menu:stats":
-        await _send_stats_for_chat(context, chat_id)
-        await query.answer()
-        return
-    if data == "menu:upcoming":
-        await _send_upcoming_for_chat(context, chat_id)
-        await query.answer()
-        return
     await query.answer()
+    send = _MENU_ACTIONS.get(data)
+    if send is not None:
+        _in_background(context, update, send(context, chat_id))
+
+
+_MENU_ACTIONS = {
+    "menu:random": _send_random_for_chat,
+    "menu:stats": _send_stats_for_chat,
+    "menu:upcoming": _send_upcoming_for_chat,
+}
+
+
+async def _ensure_initial_import(application: Application) -> None:
+	"""Подгружает restaurants.json, только если файл изменился с прошлого запуска."""
+	try:
+		changed = ensure_seed_loaded()
+	except Exception as e:
+		logger.error(f"Initial restaurants import failed: {e}")
+		return
+	if changed is None:
+		logger.info("Seed file unchanged, initial import skipped")
 
 
 async def _startup(application: Application) -> None:
@@ -967,14 +1361,28 @@ async def _startup(application: Application) -> None:
 	await _ensure_initial_import(application)
 	# убираем демо-данные (по просьбе) и не создаём новые
 	cleanup_demo_data()
+	logger.info(f"Open feedback prompts: {EVENTS.load_feedback_prompts()}")
+	# первый снимок для отчётов, чтобы команды не строили его в цикле событий
+	try:
+		await asyncio.to_thread(ANALYTICS.refresh)
+	except Exception as e:
+		logger.error(f"Initial analytics snapshot failed: {e}")
 	# настроим список команд
 	await application.bot.set_my_commands([
 		BotCommand("menu", "Открыть меню"),
 		BotCommand("random_restaurant", "Выбрать случайный ресторан"),
+		BotCommand("recommend", "Ресторан по вкусам чата"),
 		BotCommand("stats", "Показать статистику"),
 		BotCommand("upcoming", "Предстоящие события"),
+		BotCommand("top", "Лучшие рестораны"),
+		BotCommand("search", "Поиск по ресторанам и отзывам"),
+		BotCommand("timezone", "Часовой пояс чата"),
 		BotCommand("cancel_event", "Отменить текущее событие (только админы)"),
 		BotCommand("clear_reviews", "Очистить отзывы ресторана (только админы)"),
+		BotCommand("export", "Выгрузить историю чата (только админы)"),
+		BotCommand("backup", "Сделать бэкап базы (только админы)"),
+		BotCommand("intake", "Счётчики входящих апдейтов (только админы)"),
+		BotCommand("maintenance", "Обслуживание базы (только админы)"),
 	])
 	# восстановим отложенные задачи из БД
 	now = datetime.now(timezone.utc)
@@ -982,7 +1390,7 @@ async def _startup(application: Application) -> None:
 	for ev in get_due_reminders(now + timedelta(days=365)):
 		if ev["reminder_at_utc"] and int(ev["reminder_sent"]) == 0:
 			try:
-				dt = datetime.fromisoformat(ev["reminder_at_utc"]).replace(tzinfo=timezone.utc)
+				dt = parse_utc(ev["reminder_at_utc"])
 				when = max(dt, now)
 				ev_id = int(ev["id"])
 				for job in application.job_queue.get_jobs_by_name(f"reminder_{ev_id}"):
@@ -997,13 +1405,13 @@ async def _startup(application: Application) -> None:
 	for ev in get_all_feedback_to_schedule():
 		try:
 			ev_id = int(ev["id"])
-			dt = datetime.fromisoformat(ev["reminder_at_utc"]).replace(tzinfo=timezone.utc) + timedelta(hours=3)
+			dt = parse_utc(ev["reminder_at_utc"]) + timedelta(hours=3)
 			when = max(dt, now)
 			for job in application.job_queue.get_jobs_by_name(f"feedback_{ev_id}"):
 				job.schedule_removal()
 			application.job_queue.run_once(send_feedback_prompt_job, when=when, data={"event_id": ev_id}, name=f"feedback_{ev_id}")
 			# ежедневные персональные напоминания
-			dt_remind = datetime.fromisoformat(ev["reminder_at_utc"]).replace(tzinfo=timezone.utc) + timedelta(days=1)
+			dt_remind = parse_utc(ev["reminder_at_utc"]) + timedelta(days=1)
 			when_remind = max(dt_remind, now)
 			for job in application.job_queue.get_jobs_by_name(f"daily_reviews_{ev_id}"):
 				job.schedule_removal()
@@ -1018,32 +1426,84 @@ async def _startup(application: Application) -> None:
 		except Exception as e:
 			logger.error(f"Failed to restore feedback job for event {ev['id']}: {e}")
 	logger.info(f"Restored {restored_feedback} feedback jobs")
+	if BACKUP_INTERVAL_HOURS > 0:
+		application.job_queue.run_repeating(
+			backup_job,
+			interval=timedelta(hours=BACKUP_INTERVAL_HOURS),
+			first=timedelta(minutes=5),
+			name="backup",
+		)
+	application.job_queue.run_repeating(
+		refresh_analytics_job,
+		interval=CHECK_INTERVAL,
+		first=timedelta(seconds=1),
+		name="refresh_analytics",
+	)
+	if MAINTENANCE_INTERVAL_HOURS > 0:
+		application.job_queue.run_repeating(
+			maintenance_job,
+			interval=timedelta(hours=MAINTENANCE_INTERVAL_HOURS),
+			first=timedelta(minutes=15),
+			name="db_maintenance",
+		)
+	# ежедневная архивация брошенных событий
+	application.job_queue.run_repeating(
+		archive_stale_events_job,
+		interval=timedelta(days=1),
+		first=timedelta(minutes=1),
+		name="archive_stale_events",
+	)
+
+
+async def _shutdown(application: Application) -> None:
+	# дописываем поставленные в очередь служебные записи
+	await asyncio.to_thread(WRITER.stop)
+	ANALYTICS.close()
+	logger.info(f"Update intake: {INTAKE.summary()}")
 
 
 def build_app() -> Application:
 	if not BOT_TOKEN:
 		raise RuntimeError("Не задан BOT_TOKEN (переменная окружения)")
-	application = ApplicationBuilder().token(BOT_TOKEN).post_init(_startup).build()
+	builder = (
+		ApplicationBuilder()
+		.token(BOT_TOKEN)
+		.update_queue(IntakeQueue(INTAKE))
+		.post_init(_startup)
+		.post_shutdown(_shutdown)
+	)
+	application = HTTP_SETTINGS.apply(builder).build()
+	logger.info(f"Bot API client: {HTTP_SETTINGS!r}")
 	application.bot_data["timezone"] = TIMEZONE
 	application.add_handler(CommandHandler("start", start))
 	application.add_handler(CommandHandler("menu", menu_cmd))
 	application.add_handler(CommandHandler("random_restaurant", random_restaurant))
+	application.add_handler(CommandHandler("recommend", recommend_cmd))
 	application.add_handler(CommandHandler("set_reminder", set_reminder_cmd))
 	application.add_handler(CommandHandler("stats", stats_cmd))
 	application.add_handler(CommandHandler("upcoming", upcoming_cmd))
+	application.add_handler(CommandHandler("top", top_cmd))
 	application.add_handler(CommandHandler("cancel_event", cancel_event_cmd))
 	application.add_handler(CommandHandler("clear_reviews", clear_reviews_cmd))
+	application.add_handler(CommandHandler("search", search_cmd))
+	application.add_handler(CommandHandler("timezone", timezone_cmd))
+	application.add_handler(CommandHandler("export", export_cmd))
+	application.add_handler(CommandHandler("backup", backup_cmd))
+	application.add_handler(CommandHandler("intake", intake_cmd))
+	application.add_handler(CommandHandler("maintenance", maintenance_cmd))
 	application.add_handler(CallbackQueryHandler(on_join_toggle, pattern=r"^join:"))
 	application.add_handler(CallbackQueryHandler(on_cancel_trip, pattern=r"^cancel:"))
 	application.add_handler(CallbackQueryHandler(on_reset_event, pattern=r"^reset:"))
 	application.add_handler(CallbackQueryHandler(on_reviews_toggle, pattern=r"^reviews:"))
 	application.add_handler(CallbackQueryHandler(on_menu_click, pattern=r"^menu:"))
 	application.add_handler(MessageHandler(filters.Document.ALL, on_document))
-	# свободный ввод даты/времени DD.MM.YYYY HH:MM (более гибкий regex: поддержка : . - разделителей времени)
-	application.add_handler(MessageHandler(filters.Regex(r"^\s*\d{1,2}\.\d{1,2}\.\d{4}\s+\d{1,2}[:\.\-]\d{2}\s*$") & ~filters.REPLY, on_freeform_datetime))
-	# reviews_ команда удалена — используем toggler
-	application.add_handler(MessageHandler(filters.TEXT & ~filters.REPLY, on_menu_text))
+	application.add_handler(MessageHandler(filters.LOCATION, on_location))
+	# свободный ввод даты/времени DD.MM.YYYY HH:MM и пункты меню без слеша — один диспетчер (routing.py)
+	application.add_handler(MessageHandler(ROUTED_TEXT & ~filters.REPLY, on_routed_text))
 	application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, on_text_review))
+	# allowed_updates и фильтр очереди выводятся из обработчиков выше
+	INTAKE.bind(application)
+	logger.info(f"Allowed updates: {INTAKE.allowed_updates}")
 	return application
 
 
@@ -1062,10 +1522,12 @@ def main() -> None:
 			port=PORT,
 			url_path=url_path,
 			webhook_url=webhook_url,
+			allowed_updates=INTAKE.allowed_updates,
+			max_connections=WEBHOOK_MAX_CONNECTIONS,
 		)
 	else:
 		# локальный режим — long polling
-		application.run_polling()
+		application.run_polling(allowed_updates=INTAKE.allowed_updates, timeout=POLL_TIMEOUT_SEC)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,286 @@
+"""
+Плановое обслуживание bot.db: статистика планировщика и возврат свободных
+страниц.
+
+- ANALYZE по таблицам, которые заметно выросли с прошлого ANALYZE (или
+  статистики ещё нет), с PRAGMA analysis_limit — выборка, а не полный проход
+  по индексам. Таблицы не пересчитываются (COUNT(*) большой таблицы сам не
+  уложился бы в бюджет шага): рост оценивается по MAX(rowid) — поиск по B-дереву —
+  против отметки, записанной в meta при прошлом ANALYZE, и числа строк из
+  sqlite_stat1. Таблицы WITHOUT ROWID (триграммы и дубли ресторанов) меняются
+  только с каталогом — для них отметка — версия каталога. Одни удаления
+  MAX(rowid) не сдвигают; такие таблицы остаются на PRAGMA optimize.
+- PRAGMA optimize — до SQLite 3.46 он смотрит только на таблицы, которыми
+  пользовалось это соединение, поэтому изменённые таблицы выбираем сами.
+- PRAGMA incremental_vacuum порциями страниц (БД переведена в
+  auto_vacuum=INCREMENTAL миграцией): удаления событий и демо-данных больше не
+  оставляют файл раздутым.
+
+Каждый шаг — отдельная короткая транзакция под _DB_LOCK, ограниченная
+step_ms через progress handler: превысивший бюджет шаг прерывается и
+откатывается, порция вакуума уменьшается вдвое. Таблица, чей ANALYZE
+пропускается ESCALATE_AFTER_SKIPS запусков подряд, один раз получает бюджет в
+ESCALATED_BUDGET_FACTOR раз больше. Между шагами — пауза, чтобы
+запросы бота проходили. fsync при COMMIT progress handler не прерывает — его
+длительность зависит от диска, а не от бюджета.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from db import _DB_LOCK, AUTO_VACUUM_INCREMENTAL, CATALOGUE_VERSION_KEY, _connect, _get_db_path
+
+logger = logging.getLogger("bot.maintenance")
+
+_T = TypeVar("_T")
+
+# ANALYZE читает не больше стольких строк на индекс
+ANALYSIS_LIMIT = 1000
+# таблица считается изменённой, если выросла с прошлого ANALYZE больше чем на 10%
+CHANGED_ROWS_RATIO = 0.1
+CHANGED_ROWS_MIN = 50
+# после стольких пропусков подряд ANALYZE таблицы один раз идёт с увеличенным бюджетом
+ESCALATE_AFTER_SKIPS = 3
+ESCALATED_BUDGET_FACTOR = 20
+# meta: table -> {"marker": MAX(rowid) или версия каталога при прошлом ANALYZE, "skips": пропуски подряд}
+STATE_KEY = "maintenance_tables"
+# проверять прерывание каждые N инструкций виртуальной машины SQLite
+_PROGRESS_OPS = 1000
+
+
+def database_stats(conn: Optional[sqlite3.Connection] = None) -> Dict[str, int]:
+    """Размер файла и страниц: page_size, page_count, freelist_count, file_size, auto_vacuum."""
+    own = conn is None
+    conn = conn or _connect()
+    try:
+        stats = {
+            name: int(conn.execute(f"PRAGMA {name}").fetchone()[0])
+            for name in ("page_size", "page_count", "freelist_count", "auto_vacuum")
+        }
+    finally:
+        if own:
+            conn.close()
+    try:
+        stats["file_size"] = os.path.getsize(_get_db_path())
+    except OSError:
+        stats["file_size"] = 0
+    return stats
+
+
+class _Maintenance:
+    def __init__(self, conn: sqlite3.Connection, step_ms: float, pause: float, deadline: float) -> None:
+        self.conn = conn
+        self.step_seconds = step_ms / 1000
+        self.pause = pause
+        self.deadline = deadline
+        self.steps = 0
+        self.interrupted = 0
+        self.longest_step_ms = 0.0
+
+    def step(self, action: Callable[[sqlite3.Cursor], _T], budget: float = 1.0) -> Tuple[bool, Optional[_T]]:
+        """Выполняет action(cur) в пределах step_ms × budget. (False, None) — шаг прерван и откачен."""
+        if self.steps and self.pause > 0:
+            time.sleep(self.pause)
+        with _DB_LOCK:
+            started = time.monotonic()
+            step_deadline = started + self.step_seconds * budget
+            self.conn.set_progress_handler(lambda: int(time.monotonic() > step_deadline), _PROGRESS_OPS)
+            try:
+                return True, action(self.conn.cursor())
+            except sqlite3.OperationalError as e:
+                if "interrupt" not in str(e).lower():
+                    raise
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                self.interrupted += 1
+                return False, None
+            finally:
+                self.conn.set_progress_handler(None, 0)
+                self.steps += 1
+                self.longest_step_ms = max(self.longest_step_ms, (time.monotonic() - started) * 1000)
+
+    def out_of_time(self) -> bool:
+        return time.monotonic() > self.deadline
+
+
+def _analyzable_tables(cur: sqlite3.Cursor) -> Dict[str, bool]:
+    """Таблица -> есть ли у неё rowid."""
+    cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    rows = cur.fetchall()
+    virtual = [name for name, sql in rows if (sql or "").upper().startswith("CREATE VIRTUAL TABLE")]
+    # служебные таблицы FTS5 (<имя>_data, _idx, _content, _docsize, _config) ведёт сам SQLite
+    return {
+        name: "WITHOUT ROWID" not in " ".join((sql or "").upper().split())
+        for name, sql in sorted(tuple(r) for r in rows)
+        if name not in virtual and not any(name.startswith(f"{v}_") for v in virtual)
+    }
+
+
+def _analyzed_rows(cur: sqlite3.Cursor) -> Dict[str, int]:
+    """Число строк таблиц на момент последнего ANALYZE (первое число stat в sqlite_stat1)."""
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+    if cur.fetchone() is None:
+        return {}
+    cur.execute("SELECT tbl, stat FROM sqlite_stat1")
+    rows: Dict[str, int] = {}
+    for table, stat in cur.fetchall():
+        head = (stat or "").split(" ", 1)[0]
+        if head.isdigit():
+            rows[table] = max(rows.get(table, 0), int(head))
+    return rows
+
+
+def _load_state(cur: sqlite3.Cursor) -> Dict[str, Dict[str, Any]]:
+    cur.execute("SELECT value FROM meta WHERE key = ?", (STATE_KEY,))
+    row = cur.fetchone()
+    try:
+        return json.loads(row[0]) if row else {}
+    except ValueError:
+        return {}
+
+
+def _save_state(state: Dict[str, Dict[str, Any]]) -> Callable[[sqlite3.Cursor], None]:
+    def action(cur: sqlite3.Cursor) -> None:
+        cur.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (STATE_KEY, json.dumps(state, sort_keys=True)),
+        )
+        cur.connection.commit()
+    return action
+
+
+def _change_marker(table: str, has_rowid: bool) -> Callable[[sqlite3.Cursor], Any]:
+    """MAX(rowid) (None — таблица пуста) или, для WITHOUT ROWID, версия каталога."""
+    def action(cur: sqlite3.Cursor) -> Any:
+        if has_rowid:
+            cur.execute(f'SELECT MAX(rowid) FROM "{table}"')
+        else:
+            cur.execute("SELECT value FROM meta WHERE key = ?", (CATALOGUE_VERSION_KEY,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    return action
+
+
+def _is_changed(marker: Any, recorded: Any, analyzed: Optional[int], has_rowid: bool) -> bool:
+    if marker is None:
+        # пустая таблица (или каталог ещё не загружался) — статистика не нужна
+        return False
+    if analyzed is None or recorded is None or not has_rowid:
+        return marker != recorded or analyzed is None
+    if marker < recorded:
+        # таблицу пересобрали или очистили
+        return True
+    return marker - recorded > max(analyzed * CHANGED_ROWS_RATIO, CHANGED_ROWS_MIN)
+
+
+def _analyze(table: str) -> Callable[[sqlite3.Cursor], None]:
+    def action(cur: sqlite3.Cursor) -> None:
+        cur.execute(f'ANALYZE "{table}"')
+    return action
+
+
+def _optimize(cur: sqlite3.Cursor) -> None:
+    cur.execute("PRAGMA optimize")
+
+
+def _vacuum_pages(pages: int) -> Callable[[sqlite3.Cursor], int]:
+    def action(cur: sqlite3.Cursor) -> int:
+        cur.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        cur.execute("PRAGMA freelist_count")
+        return int(cur.fetchone()[0])
+    return action
+
+
+def run_maintenance(
+    *,
+    step_ms: float = 5.0,
+    vacuum_pages: int = 64,
+    pause: float = 0.005,
+    max_seconds: float = 30.0,
+) -> Dict[str, Any]:
+    """
+    ANALYZE изменённых таблиц, PRAGMA optimize и incremental_vacuum с бюджетом
+    step_ms на шаг и max_seconds на всё. Возвращает метрики до/после и что сделано.
+    """
+    started = time.monotonic()
+    conn = _connect()
+    try:
+        before = database_stats(conn)
+        work = _Maintenance(conn, step_ms, pause, started + max_seconds)
+        conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+
+        analyzed: List[str] = []
+        skipped: List[str] = []
+        escalated: List[str] = []
+        previous = _analyzed_rows(conn.cursor())
+        state = _load_state(conn.cursor())
+        tables = _analyzable_tables(conn.cursor())
+        for table, has_rowid in tables.items():
+            entry = state.setdefault(table, {"marker": None, "skips": 0})
+            ok, marker = (False, None) if work.out_of_time() else work.step(_change_marker(table, has_rowid))
+            if ok and not _is_changed(marker, entry.get("marker"), previous.get(table), has_rowid):
+                entry["skips"] = 0
+                continue
+            budget = 1.0
+            if entry.get("skips", 0) >= ESCALATE_AFTER_SKIPS:
+                # иначе большая таблица так и не получила бы статистику
+                budget = ESCALATED_BUDGET_FACTOR
+                escalated.append(table)
+            attempted = ok and not work.out_of_time()
+            if attempted and work.step(_analyze(table), budget)[0]:
+                analyzed.append(table)
+                entry.update(marker=marker, skips=0)
+                continue
+            skipped.append(table)
+            # увеличенный бюджет даётся один раз, дальше снова копим пропуски
+            entry["skips"] = 0 if attempted and budget > 1.0 else entry.get("skips", 0) + 1
+        for table in set(state) - set(tables):
+            del state[table]
+        work.step(_save_state(state))
+        optimized = not work.out_of_time() and work.step(_optimize)[0]
+
+        vacuumed = 0
+        free = before["freelist_count"]
+        pages = max(vacuum_pages, 1)
+        if before["auto_vacuum"] == AUTO_VACUUM_INCREMENTAL:
+            while free > 0 and not work.out_of_time():
+                ok, left = work.step(_vacuum_pages(min(pages, free)))
+                if not ok:
+                    # порция не уложилась в бюджет — дальше шагами вдвое меньше
+                    if pages == 1:
+                        break
+                    pages = max(pages // 2, 1)
+                    continue
+                vacuumed += free - left
+                free = left
+        after = database_stats(conn)
+    finally:
+        conn.close()
+
+    info = {
+        "seconds": round(time.monotonic() - started, 3),
+        "analyzed": analyzed,
+        "skipped": skipped,
+        "escalated": escalated,
+        "optimized": optimized,
+        "vacuumed_pages": vacuumed,
+        "steps": work.steps,
+        "interrupted_steps": work.interrupted,
+        "longest_step_ms": round(work.longest_step_ms, 2),
+        "before": before,
+        "after": after,
+    }
+    logger.info(
+        f"DB maintenance: analyzed {analyzed or 'nothing'}, skipped {skipped or 'nothing'}"
+        f"{f' (larger budget for {escalated})' if escalated else ''}, vacuumed {vacuumed} pages, "
+        f"free pages {before['freelist_count']} -> {after['freelist_count']}, "
+        f"file {before['file_size']} -> {after['file_size']} bytes, {work.steps} steps "
+        f"(longest {info['longest_step_ms']} ms, interrupted {work.interrupted}), {info['seconds']}s"
+    )
+    if before["auto_vacuum"] != AUTO_VACUUM_INCREMENTAL:
+        logger.warning("auto_vacuum is not INCREMENTAL; free pages stay in the file until migrate_schema runs")
+    return info
@@ -0,0 +1,81 @@
+"""
+Маршрутизация обычного текста в группе (без слеша и не ответом).
+
+При отключённом privacy-режиме боту приходит каждое сообщение чата, и почти
+все они — обычная переписка. route_text() отбрасывает её дешёвыми проверками
+первого символа и длины, и только потом нормализует строку или запускает
+регулярное выражение даты. Алиасы меню лежат в одном неизменяемом словаре.
+"""
+
+import re
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+ROUTE_DATETIME = "datetime"
+ROUTE_START = "start"
+ROUTE_MENU = "menu"
+ROUTE_UPCOMING = "upcoming"
+ROUTE_RANDOM = "random"
+ROUTE_STATS = "stats"
+
+# нормализованный текст (strip + lower) -> маршрут; только точные пункты меню
+MENU_ALIASES: Mapping[str, str] = MappingProxyType({
+    "start": ROUTE_START,
+    "старт": ROUTE_START,
+    "help": ROUTE_START,
+    "помощь": ROUTE_START,
+    "menu": ROUTE_MENU,
+    "меню": ROUTE_MENU,
+    "предстоящие события": ROUTE_UPCOMING,
+    "upcoming": ROUTE_UPCOMING,
+    "upcomming": ROUTE_UPCOMING,
+    "🎲 случайный ресторан": ROUTE_RANDOM,
+    "случайный ресторан": ROUTE_RANDOM,
+    "📊 статистика": ROUTE_STATS,
+    "статистика": ROUTE_STATS,
+})
+
+# DD.MM.YYYY HH:MM, разделитель времени «:», «.» или «-»
+DATETIME_RE = re.compile(r"^\s*(\d{1,2})\.(\d{1,2})\.(\d{4})\s+(\d{1,2})[:.\-](\d{2})\s*$")
+
+_ALIAS_FIRST_CHARS = frozenset(
+    ch for alias in MENU_ALIASES for ch in (alias[0], alias[0].upper())
+)
+_ALIAS_MAX_LEN = max(len(alias) for alias in MENU_ALIASES)
+_DIGITS = frozenset("0123456789")
+_DATETIME_MIN_LEN = len("1.1.2024 1:00")
+# с этих символов может начинаться хоть что-то маршрутизируемое (плюс пробелы)
+_ROUTABLE_FIRST_CHARS = _ALIAS_FIRST_CHARS | _DIGITS
+
+
+def looks_like_datetime(text: str) -> bool:
+    """Быстрая проверка «похоже на дату встречи»: цифра по краям, затем regex."""
+    if len(text) < _DATETIME_MIN_LEN:
+        return False
+    first, last = text[0], text[-1]
+    if (first not in _DIGITS and not first.isspace()) or (last not in _DIGITS and not last.isspace()):
+        return False
+    return DATETIME_RE.match(text) is not None
+
+
+def match_menu_alias(text: str) -> Optional[str]:
+    """Маршрут пункта меню или None; строка нормализуется только после префильтра."""
+    first = text[0]
+    if first not in _ALIAS_FIRST_CHARS:
+        if not first.isspace():
+            return None
+    elif len(text) > _ALIAS_MAX_LEN and not text[-1].isspace():
+        return None
+    return MENU_ALIASES.get(text.strip().lower())
+
+
+def route_text(text: Optional[str]) -> Optional[str]:
+    """Маршрут для текста сообщения или None, если сообщение боту не адресовано."""
+    if not text:
+        return None
+    first = text[0]
+    if first not in _ROUTABLE_FIRST_CHARS and not first.isspace():
+        return None
+    if looks_like_datetime(text):
+        return ROUTE_DATETIME
+    return match_menu_alias(text)
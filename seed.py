@@ -0,0 +1,72 @@
+"""
+Идемпотентная загрузка начального каталога ресторанов (restaurants.json).
+
+Отпечаток файла (размер, mtime, sha256) хранится в таблице meta. Если размер и
+mtime не изменились, файл даже не читается; если изменился только mtime, а
+содержимое то же — обновляется лишь отпечаток.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from db import get_meta, set_meta, import_seed_restaurants
+
+logger = logging.getLogger("bot.seed")
+
+SEED_FINGERPRINT_KEY = "seed_fingerprint"
+
+
+def _get_seed_path() -> str:
+    return os.getenv("SEED_PATH", os.path.join(os.path.dirname(__file__), "restaurants.json"))
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_stored_fingerprint() -> Optional[Dict[str, Any]]:
+    raw = get_meta(SEED_FINGERPRINT_KEY)
+    if not raw:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def ensure_seed_loaded(path: Optional[str] = None) -> Optional[int]:
+    """
+    Загружает seed, если он изменился с прошлого запуска.
+    Возвращает число изменённых ресторанов или None, если импорт не понадобился.
+    """
+    path = path or _get_seed_path()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        logger.info(f"Seed file {path} not found, skipping initial import")
+        return None
+
+    stored = _load_stored_fingerprint() or {}
+    if stored.get("size") == st.st_size and stored.get("mtime_ns") == st.st_mtime_ns:
+        return None
+
+    fingerprint = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": _sha256(path)}
+    encoded = json.dumps(fingerprint, sort_keys=True)
+    if stored.get("sha256") == fingerprint["sha256"]:
+        # файл «тронули», но содержимое то же — запоминаем новый mtime и выходим
+        set_meta(SEED_FINGERPRINT_KEY, encoded)
+        return None
+
+    with open(path, "r", encoding="utf-8") as fh:
+        data = json.load(fh)
+    items = data.get("restaurants", []) if isinstance(data, dict) else data
+    changed = import_seed_restaurants(items, SEED_FINGERPRINT_KEY, encoded)
+    logger.info(f"Seed {path} imported: {changed} restaurants inserted/updated")
+    return changed
@@ -0,0 +1,208 @@
+"""
+Снимок bot.db в памяти для отчётов: /stats, списки предстоящих событий, /top.
+
+Агрегирующие запросы по событиям, участникам и отзывам не должны ждать
+_DB_LOCK и блокировку файла, которые нужны кнопкам и отзывам. Снимок
+копируется из файла backup API в :memory: и отдаёт запросы оттуда, пока он
+свежий: не старше max_age секунд и с момента копии прошло меньше max_writes
+COMMIT (db.commit_count()). Копирование внутри обработчика остановило бы цикл
+событий, поэтому устаревший снимок обновляется в отдельном потоке: его запускает
+первое же чтение, заметившее устаревание (так срабатывает и max_writes), и
+refresh_analytics_job раз в CHECK_INTERVAL секунд. Пока идёт копия, чтения
+отдаются с прежнего снимка. Синхронно снимок строится, только если его ещё нет.
+
+Худший случай для отданного отчёта: снимок старше max_age не больше чем на
+CHECK_INTERVAL плюс время одной копии (до max_seconds), а по записям — пропущено
+больше max_writes COMMIT только на время этой копии. Если копии раз за разом не
+успевают (BackupSkipped), прежний снимок служит до первой удачной.
+
+Новая копия собирается в отдельном соединении порциями страниц с паузой между
+шагами (как backup.py) и подменяет старую целиком: чтения не ждут копирования,
+а писатели — только один шаг backup. Копия, не успевшая за max_seconds (записи
+перезапускают её), бросается — до следующей попытки служит прежний снимок, а
+пока снимка нет вовсе, запросы идут к файлу. Снимок только для чтения (PRAGMA query_only).
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+from backup import BackupSkipped, _copy_in_steps
+from db import (
+    _connect,
+    _get_db_path,
+    _query_count_restaurants,
+    _query_event_with_details,
+    _query_review_summary,
+    _query_stats,
+    _query_stats_for_chat,
+    _query_top_restaurants,
+    _query_upcoming_events,
+    _read,
+    commit_count,
+)
+
+logger = logging.getLogger("bot.snapshot")
+
+_T = TypeVar("_T")
+
+# как часто refresh_analytics_job проверяет свежесть (проверка — арифметика и stat файла)
+CHECK_INTERVAL = 1.0
+
+
+class AnalyticsSnapshot:
+    def __init__(
+        self,
+        max_age: float = 30.0,
+        max_writes: int = 20,
+        *,
+        pages: int = 256,
+        pause: float = 0.002,
+        max_seconds: float = 10.0,
+    ) -> None:
+        self.max_age = max_age
+        self.max_writes = max_writes
+        self.pages = pages
+        self.pause = pause
+        self.max_seconds = max_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._taken_at = 0.0
+        self._commits_at = 0
+        self._file_sig: Optional[Tuple[int, int]] = None
+        # _lock — чтения со снимка и подмена соединения; _refresh_lock — одна копия за раз
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._background: Optional[threading.Thread] = None
+        self.refreshes = 0
+        self.skipped = 0
+
+    # ---- свежесть ----
+
+    def age(self) -> Optional[float]:
+        """Возраст снимка в секундах (None, если снимка ещё нет)."""
+        return time.monotonic() - self._taken_at if self._conn is not None else None
+
+    def is_stale(self) -> bool:
+        if self._conn is None:
+            return True
+        if time.monotonic() - self._taken_at > self.max_age:
+            return True
+        return commit_count() - self._commits_at >= self.max_writes
+
+    def refresh(self, *, force: bool = True) -> bool:
+        """Копирует bot.db в новую базу в памяти. С force=False — только если снимок устарел."""
+        with self._refresh_lock:
+            if not force and not self.is_stale():
+                return False
+            # счётчик и время берём до копии: записи во время копирования считаются новыми
+            commits = commit_count()
+            started = time.monotonic()
+            file_sig = self._db_file_signature()
+            if not force and self._conn is not None and commits == self._commits_at and file_sig == self._file_sig:
+                # истёк только срок, а файл не менялся (ни этим процессом, ни другими) — копия та же
+                self._taken_at = started
+                return False
+            snapshot = sqlite3.connect(":memory:", check_same_thread=False)
+            source = _connect()
+            try:
+                _copy_in_steps(source, snapshot, self.pages, self.pause, started + self.max_seconds)
+            except Exception:
+                snapshot.close()
+                raise
+            finally:
+                source.close()
+            snapshot.row_factory = sqlite3.Row
+            snapshot.execute("PRAGMA query_only = ON")
+            with self._lock:
+                previous, self._conn = self._conn, snapshot
+                self._taken_at = started
+                self._commits_at = commits
+                self._file_sig = file_sig
+            if previous is not None:
+                previous.close()
+            self.refreshes += 1
+            logger.debug(f"Analytics snapshot refreshed in {(time.monotonic() - started) * 1000:.1f} ms")
+            return True
+
+    @staticmethod
+    def _db_file_signature() -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(_get_db_path())
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def refresh_if_stale(self) -> bool:
+        return self.refresh(force=False)
+
+    def refresh_quietly(self) -> bool:
+        """refresh_if_stale() для фоновых вызовов: ошибки пишутся в лог, а не наружу."""
+        try:
+            return self.refresh_if_stale()
+        except BackupSkipped as e:
+            # до следующей попытки отчёты читают прежний снимок
+            self.skipped += 1
+            logger.info(f"Analytics snapshot refresh skipped: {e}")
+        except Exception as e:
+            logger.error(f"Analytics snapshot refresh failed: {e}")
+        return False
+
+    def refresh_in_background(self) -> None:
+        """Запускает обновление в отдельном потоке, если оно ещё не идёт."""
+        with self._lock:
+            if self._background is not None and self._background.is_alive():
+                return
+            self._background = threading.Thread(
+                target=self.refresh_quietly, name="analytics-refresh", daemon=True
+            )
+            self._background.start()
+
+    def close(self) -> None:
+        with self._lock:
+            conn, self._conn = self._conn, None
+        if conn is not None:
+            conn.close()
+
+    # ---- чтения ----
+
+    def query(self, query: Callable[..., _T], *args: Any) -> _T:
+        """
+        Выполняет query(cur, *args) (курсорная функция из db.py) на снимке. Устаревший
+        снимок отдаёт как есть, запустив его обновление в фоне.
+        """
+        if self._conn is not None and self.is_stale():
+            self.refresh_in_background()
+        if self._conn is None:
+            try:
+                self.refresh_if_stale()
+            except BackupSkipped:
+                # первая копия не успела — этот запрос идёт к файлу напрямую
+                return _read(query, *args)
+        with self._lock:
+            if self._conn is None:
+                raise RuntimeError("Analytics snapshot is closed")
+            return query(self._conn.cursor(), *args)
+
+    def count_restaurants(self) -> int:
+        return self.query(_query_count_restaurants)
+
+    def get_stats(self) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+        return self.query(_query_stats)
+
+    def get_stats_for_chat(self, chat_id: int) -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+        return self.query(_query_stats_for_chat, chat_id)
+
+    def get_upcoming_events(self, chat_id: int) -> List[sqlite3.Row]:
+        return self.query(_query_upcoming_events, chat_id)
+
+    def get_top_restaurants(self, limit: int = 10, min_count: int = 1) -> List[sqlite3.Row]:
+        return self.query(_query_top_restaurants, limit, min_count)
+
+    def get_event_with_details(self, event_id: int, *, include_archived: bool = False) -> Optional[sqlite3.Row]:
+        return self.query(_query_event_with_details, event_id, include_archived)
+
+    def get_review_summary(self, event_id: int) -> Tuple[int, Optional[float]]:
+        return self.query(_query_review_summary, event_id)
@@ -0,0 +1,420 @@
+"""
+Состояние активных событий чатов в памяти.
+
+Для каждого чата держится последнее живое событие: ресторан, участники, время
+встречи, id сообщения с просьбой об отзыве и кто уже оставил отзыв. Состояние
+подгружается из БД лениво (один запрос на чат) и дальше меняется только через
+методы ActiveEventStore, которые сначала пишут в db.py, а затем обновляют
+память — поэтому чтения на горячем пути (кнопки, дата, отзывы) в БД не ходят.
+
+Служебные отметки (время встречи, «напоминание отправлено», просьба об отзыве)
+при заданном writer уходят в групповую фиксацию: память меняется сразу, а
+возвращённый Future завершается после COMMIT.
+
+Текущие штрафы участников тоже кэшируются: отмена похода добавляет
+PENALTY_AMOUNT, отзыв обнуляет, так что ответ на кнопку «Я иду» читает штраф
+из памяти.
+
+Открытые просьбы об отзыве дополнительно индексируются по чатам
+(FeedbackPromptIndex): ответ на любое другое сообщение отбрасывается проверкой
+множества, без загрузки события.
+
+Хранилище рассчитано на один процесс бота: изменения событий в обход него
+(удаление, архивация, очистка отзывов) нужно сопровождать forget()/clear().
+"""
+
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from db import (
+    PENALTY_AMOUNT,
+    cancel_participation,
+    clear_user_penalty,
+    create_event,
+    get_open_feedback_prompts,
+    get_user_penalty,
+    load_event_snapshot,
+    mark_event_completed,
+    mark_feedback_prompt_sent,
+    mark_reminder_sent,
+    save_review,
+    set_reminder,
+    toggle_participation,
+)
+from writer import GroupCommitWriter
+
+MAX_PARTICIPANTS = 3
+
+
+class Participant:
+    __slots__ = ("user_id", "username", "first_name", "joined", "joined_at_utc", "review_left")
+
+    def __init__(
+        self,
+        user_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        joined: bool,
+        joined_at_utc: Optional[str],
+        review_left: bool = False,
+    ) -> None:
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.joined = joined
+        self.joined_at_utc = joined_at_utc
+        self.review_left = review_left
+
+    @property
+    def display_name(self) -> str:
+        if self.username:
+            return f"@{self.username}"
+        return self.first_name or "Без имени"
+
+
+class ActiveEvent:
+    __slots__ = (
+        "id",
+        "chat_id",
+        "message_id",
+        "restaurant_id",
+        "restaurant",
+        "reminder_at_utc",
+        "reminder_sent",
+        "feedback_prompt_sent",
+        "feedback_message_id",
+        "completed",
+        "participants",
+        "reviewers",
+    )
+
+    def __init__(self, row: Any, restaurant: Dict[str, Any]) -> None:
+        self.id = int(row["id"])
+        self.chat_id = int(row["chat_id"])
+        self.message_id = row["message_id"]
+        self.restaurant_id = int(row["restaurant_id"])
+        # ключи совпадают с колонками restaurants — словарь сразу годится для карточки
+        self.restaurant = restaurant
+        self.reminder_at_utc: Optional[str] = row["reminder_at_utc"]
+        self.reminder_sent = bool(row["reminder_sent"])
+        self.feedback_prompt_sent = bool(row["feedback_prompt_sent"])
+        self.feedback_message_id: Optional[int] = row["feedback_message_id"]
+        self.completed = bool(row["completed"])
+        # user_id -> участник (включая передумавших), в порядке записи
+        self.participants: Dict[int, Participant] = {}
+        self.reviewers: Set[int] = set()
+
+    @property
+    def r_name(self) -> str:
+        return self.restaurant["name"]
+
+    @property
+    def r_address(self) -> Optional[str]:
+        return self.restaurant["address"]
+
+    def joined(self) -> List[Participant]:
+        return sorted(
+            (p for p in self.participants.values() if p.joined),
+            key=lambda p: p.joined_at_utc or "",
+        )
+
+    @property
+    def joined_count(self) -> int:
+        return sum(1 for p in self.participants.values() if p.joined)
+
+    def participant_names(self) -> List[str]:
+        return [p.display_name for p in self.joined()]
+
+    def is_participant(self, user_id: int) -> bool:
+        p = self.participants.get(user_id)
+        return p is not None and p.joined
+
+    def pending_reviewers(self) -> List[Participant]:
+        return [p for p in self.joined() if not p.review_left]
+
+    def is_completed(self) -> bool:
+        """Та же логика, что db.is_event_completed: флаг completed или ≥3 отзыва участников."""
+        return self.completed or sum(1 for p in self.participants.values() if p.review_left) >= MAX_PARTICIPANTS
+
+
+def _restaurant_from_event_row(row: Any) -> Dict[str, Any]:
+    return {
+        "name": row["r_name"],
+        "address": row["r_address"],
+        "cuisine": row["r_cuisine"],
+        "description": row["r_description"],
+        "average_check": row["r_avg_check"],
+    }
+
+
+class FeedbackPromptIndex:
+    """chat_id -> id сообщений с открытыми просьбами об отзыве (событие ещё не завершено)."""
+
+    def __init__(self) -> None:
+        self._by_chat: Dict[int, Set[int]] = {}
+        # event_id -> (chat_id, message_id), чтобы закрывать просьбу по id события
+        self._by_event: Dict[int, Tuple[int, int]] = {}
+
+    def load(self, *, keep_open: bool = False) -> int:
+        """
+        Перечитывает открытые просьбы из БД. keep_open — сохранить и уже открытые в
+        памяти: их запись в БД может ещё стоять в очереди GroupCommitWriter.
+        """
+        pending = list(self._by_event.items()) if keep_open else []
+        self._by_chat.clear()
+        self._by_event.clear()
+        rows = get_open_feedback_prompts()
+        for r in rows:
+            self.open(int(r["id"]), int(r["chat_id"]), int(r["feedback_message_id"]))
+        # память не старее БД: все отметки о просьбах идут через хранилище
+        for event_id, (chat_id, message_id) in pending:
+            self.open(event_id, chat_id, message_id)
+        return len(self._by_event)
+
+    def open(self, event_id: int, chat_id: int, message_id: int) -> None:
+        self.close(event_id)
+        self._by_chat.setdefault(chat_id, set()).add(message_id)
+        self._by_event[event_id] = (chat_id, message_id)
+
+    def close(self, event_id: int) -> None:
+        entry = self._by_event.pop(event_id, None)
+        if entry is None:
+            return
+        chat_id, message_id = entry
+        messages = self._by_chat.get(chat_id)
+        if messages is not None:
+            messages.discard(message_id)
+            if not messages:
+                del self._by_chat[chat_id]
+
+    def is_open(self, chat_id: int, message_id: int) -> bool:
+        messages = self._by_chat.get(chat_id)
+        return messages is not None and message_id in messages
+
+
+def _done(write: Callable[..., Any], *args: Any) -> Future:
+    """Синхронная запись, обёрнутая в уже завершённый Future."""
+    future: Future = Future()
+    try:
+        future.set_result(write(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class ActiveEventStore:
+    def __init__(self, writer: Optional[GroupCommitWriter] = None) -> None:
+        self._writer = writer
+        self._lock = threading.Lock()
+        # chat_id -> id последнего живого события (None — событий нет, это тоже кэшируется)
+        self._latest: Dict[int, Optional[int]] = {}
+        self._events: Dict[int, ActiveEvent] = {}
+        self._prompts = FeedbackPromptIndex()
+        # user_id -> текущий штраф (остаток по журналу)
+        self._penalties: Dict[int, int] = {}
+
+    # ---- загрузка ----
+
+    def _load(self, *, event_id: Optional[int] = None, chat_id: Optional[int] = None) -> Optional[ActiveEvent]:
+        snapshot = load_event_snapshot(event_id=event_id, chat_id=chat_id)
+        if snapshot is None:
+            return None
+        row, participants, reviewers = snapshot
+        event = ActiveEvent(row, _restaurant_from_event_row(row))
+        for p in participants:
+            event.participants[int(p["user_id"])] = Participant(
+                int(p["user_id"]),
+                p["username"],
+                p["first_name"],
+                bool(p["joined"]),
+                p["joined_at_utc"],
+                bool(p["review_left"]),
+            )
+        event.reviewers.update(reviewers)
+        self._events[event.id] = event
+        return event
+
+    def latest(self, chat_id: int) -> Optional[ActiveEvent]:
+        """Последнее живое событие чата."""
+        with self._lock:
+            if chat_id in self._latest:
+                event_id = self._latest[chat_id]
+                return self._events.get(event_id) if event_id is not None else None
+            event = self._load(chat_id=chat_id)
+            self._latest[chat_id] = event.id if event else None
+            return event
+
+    def get(self, event_id: int) -> Optional[ActiveEvent]:
+        """Живое событие по id (архивные и удалённые — None)."""
+        with self._lock:
+            event = self._events.get(event_id)
+            if event is None:
+                event = self._load(event_id=event_id)
+            return event
+
+    def penalty(self, user_id: int) -> int:
+        """Текущий штраф пользователя; из БД читается один раз."""
+        with self._lock:
+            balance = self._penalties.get(user_id)
+            if balance is None:
+                balance = self._penalties[user_id] = get_user_penalty(user_id)
+            return balance
+
+    def load_feedback_prompts(self) -> int:
+        """Строит индекс открытых просьб об отзыве из БД (при старте). Возвращает их число."""
+        with self._lock:
+            return self._prompts.load()
+
+    def by_feedback_message(self, chat_id: int, message_id: int) -> Optional[ActiveEvent]:
+        # обычные ответы в группе отсекаются здесь, без обращения к БД
+        with self._lock:
+            if not self._prompts.is_open(chat_id, message_id):
+                return None
+        # новое событие создаётся только после архивации предыдущего, так что
+        # просьба об отзыве может относиться лишь к последнему событию чата
+        event = self.latest(chat_id)
+        if event is not None and event.feedback_message_id == message_id:
+            return event
+        return None
+
+    # ---- изменения (сначала БД, затем память) ----
+
+    def create(self, chat_id: int, restaurant: Any, message_id: int) -> ActiveEvent:
+        event_id = create_event(chat_id=chat_id, restaurant_id=int(restaurant["id"]), message_id=message_id)
+        row = {
+            "id": event_id,
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "restaurant_id": int(restaurant["id"]),
+            "reminder_at_utc": None,
+            "reminder_sent": 0,
+            "feedback_prompt_sent": 0,
+            "feedback_message_id": None,
+            "completed": 0,
+        }
+        card = {key: restaurant[key] for key in ("name", "address", "cuisine", "description", "average_check")}
+        event = ActiveEvent(row, card)
+        with self._lock:
+            self._events[event_id] = event
+            self._latest[chat_id] = event_id
+        return event
+
+    def toggle(
+        self, event: ActiveEvent, user_id: int, username: Optional[str], first_name: Optional[str]
+    ) -> Tuple[bool, Optional[str]]:
+        """Записывает/выписывает участника; лимит проверяется в памяти до похода в БД."""
+        with self._lock:
+            current = event.participants.get(user_id)
+            if (current is None or not current.joined) and event.joined_count >= MAX_PARTICIPANTS:
+                return False, "Уже набрано максимум 3 участника"
+            joined, error = toggle_participation(event.id, user_id, username, first_name)
+            if error:
+                return joined, error
+            now = datetime.now(timezone.utc).isoformat()
+            if current is None:
+                event.participants[user_id] = Participant(user_id, username, first_name, joined, now)
+            else:
+                current.joined = joined
+                current.joined_at_utc = now
+                current.username = username
+                current.first_name = first_name
+            return joined, None
+
+    def cancel(self, event: ActiveEvent, user_id: int) -> bool:
+        with self._lock:
+            cancelled = cancel_participation(event.id, user_id)
+            if cancelled:
+                event.participants[user_id].joined = False
+                if user_id in self._penalties:
+                    self._penalties[user_id] += PENALTY_AMOUNT
+            return cancelled
+
+    def clear_penalty(self, user_id: int) -> Future:
+        """Штраф погашен отзывом."""
+        with self._lock:
+            self._penalties[user_id] = 0
+        if self._writer is not None:
+            return self._writer.clear_user_penalty(user_id)
+        return _done(clear_user_penalty, user_id)
+
+    def set_reminder(self, event: ActiveEvent, dt_utc: datetime) -> Future:
+        with self._lock:
+            event.reminder_at_utc = dt_utc.isoformat()
+            event.reminder_sent = False
+        if self._writer is not None:
+            return self._writer.set_reminder(event.id, dt_utc)
+        return _done(set_reminder, event.id, dt_utc)
+
+    def mark_reminder_sent(self, event: ActiveEvent) -> Future:
+        with self._lock:
+            event.reminder_sent = True
+        if self._writer is not None:
+            return self._writer.mark_reminder_sent(event.id)
+        return _done(mark_reminder_sent, event.id)
+
+    def mark_feedback_prompt_sent(self, event: ActiveEvent, feedback_message_id: int) -> Future:
+        with self._lock:
+            event.feedback_prompt_sent = True
+            event.feedback_message_id = feedback_message_id
+            if not event.completed:
+                self._prompts.open(event.id, event.chat_id, feedback_message_id)
+        if self._writer is not None:
+            return self._writer.mark_feedback_prompt_sent(event.id, feedback_message_id)
+        return _done(mark_feedback_prompt_sent, event.id, feedback_message_id)
+
+    def save_review(
+        self,
+        event: ActiveEvent,
+        user_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        text: str,
+        rating: Optional[int],
+    ) -> Tuple[bool, str]:
+        with self._lock:
+            if not event.is_participant(user_id):
+                return False, "Вы не участвовали в этом походе"
+            success, message = save_review(
+                event_id=event.id,
+                user_id=user_id,
+                username=username,
+                text=text,
+                rating=rating,
+                first_name=first_name,
+            )
+            if success:
+                participant = event.participants[user_id]
+                participant.review_left = True
+                participant.username = username
+                participant.first_name = first_name
+                event.reviewers.add(user_id)
+            return success, message
+
+    def mark_completed(self, event: ActiveEvent) -> None:
+        with self._lock:
+            mark_event_completed(event.id)
+            event.completed = True
+            self._prompts.close(event.id)
+
+    # ---- сброс ----
+
+    def forget(self, event_id: int) -> None:
+        """Событие удалено или ушло в архив."""
+        with self._lock:
+            self._prompts.close(event_id)
+            event = self._events.pop(event_id, None)
+            if event is not None and self._latest.get(event.chat_id) == event_id:
+                # следующее обращение перечитает чат из БД
+                del self._latest[event.chat_id]
+
+    def clear(self) -> None:
+        """Сбрасывает всё состояние (после массовых изменений в обход хранилища)."""
+        with self._lock:
+            self._latest.clear()
+            self._events.clear()
+            # штрафы меняются только через хранилище, а списание может ещё стоять в
+            # очереди GroupCommitWriter: перечитав его из БД, вернули бы старый остаток
+            # события могли снова стать незавершёнными — их просьбы об отзыве открыты
+            self._prompts.load(keep_open=True)
@@ -0,0 +1,146 @@
+"""
+Разбор и форматирование времени встреч.
+
+- Ввод «DD.MM.YYYY HH:MM» (разделитель времени «:», «.» или «-») разбирается
+  одним скомпилированным выражением routing.DATETIME_RE, без перебора форматов
+  strptime.
+- ZoneInfo кэшируются по имени, смещение от UTC — по (зона, сутки UTC): в
+  сутки без перехода на летнее/зимнее время локальное время получается простым
+  сложением. Готовые строки времени встреч тоже кэшируются.
+- Часовой пояс чата хранится в chat_settings (команда /timezone) и кэшируется
+  в ChatTimezones; без настройки действует TIMEZONE из окружения.
+"""
+
+import logging
+import os
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+from zoneinfo import ZoneInfo
+
+from db import get_chat_timezone, set_chat_timezone
+from routing import DATETIME_RE
+
+logger = logging.getLogger("bot.timeutil")
+
+FALLBACK_TIMEZONE = "Europe/Moscow"
+_ONE_DAY = timedelta(days=1)
+
+
+@lru_cache(maxsize=64)
+def get_zone(name: str) -> ZoneInfo:
+    """ZoneInfo по имени (исключение, если зоны нет)."""
+    return ZoneInfo(name)
+
+
+def is_valid_timezone(name: str) -> bool:
+    try:
+        get_zone(name)
+    except Exception:
+        return False
+    return True
+
+
+def _default_timezone() -> str:
+    name = os.getenv("TIMEZONE", FALLBACK_TIMEZONE)
+    if is_valid_timezone(name):
+        return name
+    logger.warning("Invalid TIMEZONE env; fallback to Europe/Moscow")
+    return FALLBACK_TIMEZONE
+
+
+DEFAULT_TIMEZONE = _default_timezone()
+
+
+# ---- разбор ввода ----
+
+def parse_local_datetime(text: str, tz_name: str) -> Optional[datetime]:
+    """«25.12.2025 19:00» -> aware datetime в зоне tz_name; None, если формат или дата неверны."""
+    m = DATETIME_RE.match(text)
+    if m is None:
+        return None
+    day, month, year, hour, minute = map(int, m.groups())
+    try:
+        return datetime(year, month, day, hour, minute, tzinfo=get_zone(tz_name))
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=1024)
+def parse_utc(iso: str) -> datetime:
+    """Время из БД (isoformat UTC) -> aware datetime в UTC."""
+    return datetime.fromisoformat(iso).replace(tzinfo=timezone.utc)
+
+
+# ---- перевод в локальное время ----
+
+@lru_cache(maxsize=4096)
+def _day_offset(tz_name: str, utc_day: date) -> Optional[timedelta]:
+    """Смещение зоны на сутки UTC или None, если в эти сутки оно меняется."""
+    zone = get_zone(tz_name)
+    start = datetime(utc_day.year, utc_day.month, utc_day.day, tzinfo=timezone.utc)
+    first = start.astimezone(zone).utcoffset()
+    last = (start + _ONE_DAY - timedelta(microseconds=1)).astimezone(zone).utcoffset()
+    return first if first == last else None
+
+
+def to_local(dt_utc: datetime, tz_name: str) -> datetime:
+    """UTC -> локальное «настенное» время зоны (naive)."""
+    offset = _day_offset(tz_name, dt_utc.date())
+    if offset is None:
+        return dt_utc.astimezone(get_zone(tz_name)).replace(tzinfo=None)
+    return (dt_utc + offset).replace(tzinfo=None)
+
+
+def format_date_time(dt: datetime) -> str:
+    """DD.MM.YYYY HH:MM без strftime."""
+    return f"{dt.day:02d}.{dt.month:02d}.{dt.year} {dt.hour:02d}:{dt.minute:02d}"
+
+
+def format_time(dt: datetime) -> str:
+    return f"{dt.hour:02d}:{dt.minute:02d}"
+
+
+@lru_cache(maxsize=4096)
+def format_local(iso_utc: Optional[str], tz_name: str, *, time_only: bool = False) -> Optional[str]:
+    """
+    Время из БД в локальном виде; None для пустого или битого значения.
+    Результат кэшируется: одни и те же времена встреч показываются многократно.
+    """
+    if not iso_utc:
+        return None
+    try:
+        local = to_local(parse_utc(iso_utc), tz_name)
+    except ValueError:
+        logger.error(f"Failed to parse stored time: {iso_utc!r}")
+        return None
+    return format_time(local) if time_only else format_date_time(local)
+
+
+def localize_rows(rows: Iterable[Any], column: str, tz_name: str) -> List[Optional[str]]:
+    """Пакетно форматирует столбец времени UTC у списка строк (порядок сохраняется)."""
+    return [format_local(row[column], tz_name) for row in rows]
+
+
+# ---- часовой пояс чата ----
+
+class ChatTimezones:
+    """Кэш часовых поясов чатов поверх chat_settings."""
+
+    def __init__(self, default: str = DEFAULT_TIMEZONE) -> None:
+        self.default = default
+        self._by_chat: Dict[int, str] = {}
+
+    def get(self, chat_id: int) -> str:
+        name = self._by_chat.get(chat_id)
+        if name is None:
+            name = get_chat_timezone(chat_id) or self.default
+            if not is_valid_timezone(name):
+                name = self.default
+            self._by_chat[chat_id] = name
+        return name
+
+    def set(self, chat_id: int, name: str) -> None:
+        """Сохраняет пояс чата (имя должно пройти is_valid_timezone)."""
+        set_chat_timezone(chat_id, name)
+        self._by_chat[chat_id] = name
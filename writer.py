@@ -0,0 +1,158 @@
+"""
+Групповая фиксация мелких служебных записей.
+
+Отметки «напоминание отправлено», id просьбы об отзыве, время встречи и
+списание штрафа не требуют отдельного commit каждая: они ставятся в очередь,
+а фоновый поток собирает пачку (до max_batch записей или max_delay секунд с
+первой) и выполняет её одной транзакцией — один fsync на пачку вместо одного
+на запись. Каждая запись идёт в своём SAVEPOINT, так что ошибка одной не
+откатывает остальные.
+
+submit() возвращает concurrent.futures.Future, который завершается после
+COMMIT; в asyncio-коде дождаться записи можно через asyncio.wrap_future().
+"""
+
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Tuple
+
+from db import (
+    _DB_LOCK,
+    _clear_user_penalty,
+    _connect,
+    _mark_feedback_prompt_sent,
+    _mark_reminder_sent,
+    _note_commit,
+    _set_reminder,
+)
+
+logger = logging.getLogger("bot.writer")
+
+_Op = Callable[..., Any]
+_Item = Tuple[_Op, Tuple[Any, ...], Future]
+
+
+class GroupCommitWriter:
+    def __init__(self, max_batch: int = 64, max_delay: float = 0.005) -> None:
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: "queue.Queue[Optional[_Item]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    # ---- жизненный цикл ----
+
+    def start(self) -> None:
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: Optional[float] = 5.0) -> None:
+        """Дописывает всё, что уже в очереди, и останавливает поток."""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout)
+
+    # ---- постановка записей ----
+
+    def submit(self, op: _Op, *args: Any) -> Future:
+        """
+        Ставит op(cur, *args) в очередь. op работает на переданном курсоре и не коммитит.
+        Результат Future — значение op после COMMIT пачки (или исключение).
+        """
+        future: Future = Future()
+        self.start()
+        self._queue.put((op, args, future))
+        return future
+
+    def set_reminder(self, event_id: int, dt_utc: datetime) -> Future:
+        return self.submit(_set_reminder, event_id, dt_utc)
+
+    def mark_reminder_sent(self, event_id: int) -> Future:
+        return self.submit(_mark_reminder_sent, event_id)
+
+    def mark_feedback_prompt_sent(self, event_id: int, feedback_message_id: int) -> Future:
+        return self.submit(_mark_feedback_prompt_sent, event_id, feedback_message_id)
+
+    def clear_user_penalty(self, user_id: int) -> Future:
+        return self.submit(_clear_user_penalty, user_id)
+
+    # ---- поток записи ----
+
+    def _collect(self, first: _Item) -> Tuple[List[_Item], bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        conn = _connect()
+        # транзакциями управляем сами: BEGIN/SAVEPOINT/COMMIT
+        conn.isolation_level = None
+        try:
+            stopping = False
+            while not stopping:
+                first = self._queue.get()
+                if first is None:
+                    break
+                batch, stopping = self._collect(first)
+                self._flush(conn, batch)
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection, batch: List[_Item]) -> None:
+        results: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        cur = conn.cursor()
+        try:
+            with _DB_LOCK:
+                cur.execute("BEGIN IMMEDIATE")
+                try:
+                    for op, args, future in batch:
+                        cur.execute("SAVEPOINT write_op")
+                        try:
+                            value = op(cur, *args)
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO write_op")
+                            results.append((future, None, e))
+                        else:
+                            results.append((future, value, None))
+                        cur.execute("RELEASE write_op")
+                    cur.execute("COMMIT")
+                    _note_commit()
+                except BaseException:
+                    cur.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            logger.error(f"Group commit of {len(batch)} writes failed: {e}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for future, value, error in results:
+            if error is not None:
+                logger.error(f"Deferred write failed: {error}")
+                future.set_exception(error)
+            else:
+                future.set_result(value)